@@ -33,6 +33,16 @@ from NNIF_adv_defense.tools.utils import one_hot
 from sklearn.neighbors import NearestNeighbors
 import matplotlib.pyplot as plt
 from NNIF_adv_defense.datasets.influence_feeder import MyFeederValTest
+from NNIF_adv_defense.influence.nnif_influence import NNIFInfluence
+from NNIF_adv_defense.influence.per_example_grads import PerExampleScorer
+from NNIF_adv_defense.influence.ihvp_solvers import make_solver, append_solver_log
+from NNIF_adv_defense.influence.train_grad_cache import TrainGradientCache, checkpoint_key
+from NNIF_adv_defense.influence.score_files import save_scores, scores_exist
+from NNIF_adv_defense.influence.shards import select_indices, shard_indices
+from NNIF_adv_defense.influence.param_scope import parse_scope, scope_variables, scope_scores_name
+from NNIF_adv_defense.influence.rank_lookup import rank_table
+from NNIF_adv_defense.influence.result_cache import InfluenceResultCache, RESULT_CACHE_DIR, config_key, train_subset_key
+import copy
 import pickle
 from cleverhans.utils import random_targets
 from cleverhans.evaluation import batch_eval
@@ -45,7 +55,33 @@ flags.DEFINE_string('dataset', 'cifar10', 'datasset: cifar10/100 or svhn')
 flags.DEFINE_string('set', 'val', 'val or test set to evaluate')
 flags.DEFINE_string('attack', 'deepfool', 'adversarial attack: deepfool, jsma, cw, cw_nnif')
 flags.DEFINE_string('checkpoint_dir', '', 'Checkpoint dir, the path to the saved model architecture and weights')
-
+flags.DEFINE_bool('train_grad_cache', False, 'calculate the per-training-sample gradients once and reuse them')
+flags.DEFINE_string('train_grad_cache_dtype', 'float32', 'storage dtype of the train gradients cache: float32/float16')
+flags.DEFINE_string('per_example_grads', '', 'if pfor or map_fn, calculate the per-training-sample gradients of a '
+                                              'whole training batch in a single graph execution')
+flags.DEFINE_string('ihvp_solver', 'lissa', 'inverse HVP solver: lissa (approx_params), cg, arnoldi, kfac or ekfac')
+flags.DEFINE_integer('ihvp_max_iters', 100, 'maximum CG iterations / number of Arnoldi iterations')
+flags.DEFINE_float('ihvp_tol', 1e-3, 'CG relative residual tolerance')
+flags.DEFINE_integer('arnoldi_top_k', 50, 'number of Hessian eigenpairs kept by the arnoldi solver')
+flags.DEFINE_integer('hvp_num_batches', 5, 'number of training mini-batches of the Hessian used by cg/arnoldi')
+flags.DEFINE_integer('scores_top_k', 0, 'if > 0, save only the top k helpful/harmful training samples (scores_topk.npz)')
+flags.DEFINE_float('lissa_tol', 0.0, 'if > 0, stop a LiSSA repeat once the relative change of a step is below it')
+flags.DEFINE_float('lissa_repeats_tol', 0.0, 'if > 0, stop the LiSSA repeats once the relative standard error of '
+                                             'their average is below it (at most num_repeats repeats)')
+flags.DEFINE_integer('lissa_min_repeats', 2, 'minimal number of LiSSA repeats with --lissa_repeats_tol')
+flags.DEFINE_string('ihvp_store', '', 'if float32 or float16, keep the inverse HVPs compressed in a packed store per '
+                                        'workspace (see influence/ihvp_store.py) instead of a .npz file per sample')
+flags.DEFINE_bool('result_cache', False, 'reuse the scores of identical (checkpoint, image, label, scores config) '
+                                          'across sets and attacks, see influence/result_cache.py')
+flags.DEFINE_string('influence_scope', '', 'comma separated variable scopes of the parameters of the influence '
+                                            'functions, e.g. conv3_*,fc (see influence/param_scope.py). Empty for all')
+
+flags.DEFINE_string('selection', 'all', 'samples to run: all, net_succ (the only ones read by extract_characteristics.py) '
+                                       'or net_succ_and_attack_succ')
+flags.DEFINE_integer('num_shards', 1, 'split the val/test samples deterministically into this number of shards')
+flags.DEFINE_integer('shard_id', 0, 'the shard to run, in [0, num_shards)')
+flags.DEFINE_string('shard_index_file', '', 'file with the sub indices to run (one index or range first-last per line). '
+                                            'Replaces --num_shards/--shard_id')
 
 # TODO: remove
 flags.DEFINE_string('mode', 'null', 'to bypass pycharm bug')
@@ -61,6 +97,7 @@ else:
     USE_TRAIN_MINI = True
 
 TARGETED = FLAGS.attack != 'deepfool'  # we use targeted attacks everywhere except deepfool
+SCORES_NAME = scope_scores_name('all', parse_scope(FLAGS.influence_scope))  # the scores files
 
 _classes = {
     'cifar10': (
@@ -442,22 +479,6 @@ feeder.reset()
 pred_feeder.reset()
 adv_feeder.reset()
 
-inspector_pred = darkon.Influence(
-    workspace=os.path.join(workspace_dir, 'pred'),
-    feeder=pred_feeder,
-    loss_op_train=full_loss.fprop(x=x, y=y),
-    loss_op_test=loss.fprop(x=x, y=y),
-    x_placeholder=x,
-    y_placeholder=y)
-
-inspector_adv = darkon.Influence(
-    workspace=os.path.join(workspace_dir, 'adv', FLAGS.attack),
-    feeder=adv_feeder,
-    loss_op_train=full_loss.fprop(x=x, y=y),
-    loss_op_test=loss.fprop(x=x, y=y),
-    x_placeholder=x,
-    y_placeholder=y)
-
 # some optimizations for the darkon influence function implementations
 testset_batch_size = 100
 train_batch_size = 200
@@ -469,9 +490,73 @@ approx_params = {
     'recursion_batch_size': 200
 }
 
-sub_relevant_indices = [ind for ind in info[FLAGS.set]]
+ihvp_solver = make_solver(FLAGS.ihvp_solver, approx_params, max_iters=FLAGS.ihvp_max_iters, tol=FLAGS.ihvp_tol,
+                          top_k=FLAGS.arnoldi_top_k, num_batches=FLAGS.hvp_num_batches,
+                          cache_dir=os.path.join(model_dir, 'ihvp_' + FLAGS.ihvp_solver), lissa_tol=FLAGS.lissa_tol,
+                          lissa_repeats_tol=FLAGS.lissa_repeats_tol, lissa_min_repeats=FLAGS.lissa_min_repeats)
+
+# the parameters of the influence functions: all the trainable variables, or the subset of --influence_scope
+influence_variables = scope_variables(tf.get_collection(tf.GraphKeys.TRAINABLE_VARIABLES) +
+                                      tf.get_collection(tf.GraphKeys.TRAINABLE_RESOURCE_VARIABLES),
+                                      parse_scope(FLAGS.influence_scope))
+
+inspector_pred = NNIFInfluence(
+    workspace=os.path.join(workspace_dir, 'pred'),
+    feeder=pred_feeder,
+    loss_op_train=full_loss.fprop(x=x, y=y),
+    loss_op_test=loss.fprop(x=x, y=y),
+    x_placeholder=x,
+    y_placeholder=y,
+    solver=ihvp_solver,
+    trainable_variables=influence_variables,
+    ihvp_store_dtype=FLAGS.ihvp_store or None)
+
+# the adv inspector shares the loss, gradient and HVP ops of the pred inspector, only its feeder is different
+inspector_adv = inspector_pred.clone(workspace=os.path.join(workspace_dir, 'adv', FLAGS.attack), feeder=adv_feeder)
+
+sub_relevant_indices = shard_indices(select_indices(info[FLAGS.set], FLAGS.selection), FLAGS.num_shards,
+                                     FLAGS.shard_id, FLAGS.shard_index_file)
+print('running {} out of {} {} samples'.format(len(sub_relevant_indices), len(info[FLAGS.set]), FLAGS.set))
 relevant_indices     = [info[FLAGS.set][ind]['global_index'] for ind in sub_relevant_indices]
 
+# The gradients of the training samples do not depend on the val/test sample. Calculate them once for this checkpoint
+train_grad_cache = None
+if FLAGS.train_grad_cache:
+    train_grad_cache = TrainGradientCache.for_checkpoint(
+        cache_dir=os.path.join(model_dir, 'train_grad_cache'),
+        sess=sess,
+        variables=inspector_pred.trainable_variables,
+        train_set='train_mini' if USE_TRAIN_MINI else 'train',
+        num_train=train_batch_size * train_iterations,
+        dtype=FLAGS.train_grad_cache_dtype)
+    if not train_grad_cache.is_complete():
+        print('Calculating the train gradients cache {}...'.format(train_grad_cache.path))
+        train_grad_cache.build(sess, inspector_pred.grad_op_train, x, y, copy.deepcopy(feeder), train_batch_size)
+
+# The per-training-sample gradients of a whole training batch in a single graph execution (shared by pred and adv)
+per_example_scorer = None
+if FLAGS.per_example_grads != '' and train_grad_cache is None:
+    per_example_scorer = PerExampleScorer(lambda xx, yy: full_loss.fprop(x=xx, y=yy), x, y,
+                                          inspector_pred.trainable_variables, train_batch_size, FLAGS.per_example_grads)
+
+# A content-addressed cache of the scores, shared by all the sets and attacks of this checkpoint
+result_cache = None
+if FLAGS.result_cache:
+    result_cache = InfluenceResultCache(
+        dir=os.path.join(model_dir, RESULT_CACHE_DIR),
+        checkpoint_key=checkpoint_key(sess, tf.get_collection(tf.GraphKeys.TRAINABLE_VARIABLES) +
+                                      tf.get_collection(tf.GraphKeys.TRAINABLE_RESOURCE_VARIABLES)),
+        config_key=config_key({
+            'scores_name': SCORES_NAME,
+            'variables': [v.name for v in influence_variables],
+            'approx_params': approx_params,
+            'ihvp_solver': {'name': ihvp_solver.name, 'config': ihvp_solver.config()},
+            'train_subset': train_subset_key(feeder.mini_train_inds if USE_TRAIN_MINI else feeder.train_inds),
+            'num_train': train_batch_size * train_iterations,
+            'loss': {'label_smoothing': LABEL_SMOOTHING[FLAGS.dataset], 'weight_decay': weight_decay},
+            'sketch_dim': 0,
+            'train_grad_cache_dtype': None if train_grad_cache is None else FLAGS.train_grad_cache_dtype}))
+
 # calculate knn_ranks
 def find_ranks(sub_index, sorted_influence_indices, adversarial=False):
     print('Finding ranks for sub_index={} (adversarial={})'.format(sub_index, adversarial))
@@ -482,17 +567,13 @@ def find_ranks(sub_index, sorted_influence_indices, adversarial=False):
         ni = all_neighbor_indices
         nd = all_neighbor_dists
 
-    ranks = -1 * np.ones(len(sorted_influence_indices), dtype=np.int32)
-    dists = -1 * np.ones(len(sorted_influence_indices), dtype=np.float32)
-    for target_idx in range(ranks.shape[0]):
-        idx = sorted_influence_indices[target_idx]
-        loc_in_knn = np.where(ni[sub_index] == idx)[0][0]
-        knn_dist = nd[sub_index, loc_in_knn]
-        ranks[target_idx] = loc_in_knn
-        dists[target_idx] = knn_dist
+    # the inverse permutation of the neighbors list (train index -> rank) turns all the lookups into one indexing
+    ranks = rank_table(ni[sub_index])[np.asarray(sorted_influence_indices)].astype(np.int32)
+    dists = nd[sub_index, ranks].astype(np.float32)
     return ranks, dists
 
 
+ihvp_log_file = os.path.join(workspace_dir, 'ihvp_solver_log.jsonl')  # per-sample iterations and timings
 for i in tqdm(range(len(sub_relevant_indices))):
     sub_index = sub_relevant_indices[i]
     if test_val_set:
@@ -545,22 +626,52 @@ for i in tqdm(range(len(sub_relevant_indices))):
         if not os.path.exists(dir):
             os.makedirs(dir)
 
-        if os.path.exists(os.path.join(dir, 'scores.npy')):
+        key = None
+        if result_cache is not None:
+            image, label = feed.test_indices(sub_index)
+            key = result_cache.key(image, label)
+        if scores_exist(dir, SCORES_NAME) and (key is None or result_cache.contains(key)):
             print('calcaulation for global index {} was already done. Leaving it'.format(global_index))
             continue
 
-        start_time = time.time()
-        scores = insp.upweighting_influence_batch(
-            sess=sess,
-            test_indices=[sub_index],
-            test_batch_size=testset_batch_size,
-            approx_params=approx_params,
-            train_batch_size=train_batch_size,
-            train_iterations=train_iterations)
-        print('ihvp + scores calculation time: {} secs. global_index: {} (sub: {}), case: {}'
-              .format(time.time() - start_time, global_index, sub_index, case))
-
-        np.save(os.path.join(dir, 'scores.npy'), scores)
+        scores = None if key is None else result_cache.get(key)
+        if scores is not None:
+            print('scores of global_index: {} (sub: {}), case: {} are served from the result cache'
+                  .format(global_index, sub_index, case))
+        else:
+            start_time = time.time()
+            if train_grad_cache is not None:
+                scores = insp.upweighting_influence_cached(
+                    sess=sess,
+                    test_indices=[sub_index],
+                    test_batch_size=testset_batch_size,
+                    approx_params=approx_params,
+                    train_grad_cache=train_grad_cache)
+            elif per_example_scorer is not None:
+                scores = insp.upweighting_influence_vectorized(
+                    sess=sess,
+                    test_indices=[sub_index],
+                    test_batch_size=testset_batch_size,
+                    approx_params=approx_params,
+                    scorer=per_example_scorer,
+                    train_iterations=train_iterations)
+            else:
+                scores = insp.upweighting_influence_batch(
+                    sess=sess,
+                    test_indices=[sub_index],
+                    test_batch_size=testset_batch_size,
+                    approx_params=approx_params,
+                    train_batch_size=train_batch_size,
+                    train_iterations=train_iterations)
+            print('ihvp + scores calculation time: {} secs. global_index: {} (sub: {}), case: {}'
+                  .format(time.time() - start_time, global_index, sub_index, case))
+            if insp.last_solve_stats is not None:
+                append_solver_log(ihvp_log_file, dict(insp.last_solve_stats, set=FLAGS.set, case=case,
+                                                      sub_index=int(sub_index), global_index=int(global_index)))
+            if result_cache is not None:
+                result_cache.put(key, scores)
+
+        save_scores(dir, scores, SCORES_NAME, FLAGS.scores_top_k)
 
 
         # Just plotting and extra information. Not mandatory to go over it, but useful for visualization and debugging.
@@ -614,6 +725,7 @@ for i in tqdm(range(len(sub_relevant_indices))):
         np.save(os.path.join(dir, 'harmful_ranks.npy'), harmful_ranks)
         np.save(os.path.join(dir, 'harmful_dists.npy'), harmful_dists)
 
+        knn_ranks = rank_table(ni[sub_index])  # train index -> location in the knn of the sample
         fig, axes1 = plt.subplots(5, 10, figsize=(30, 10))
         target_idx = 0
         for j in range(5):
@@ -622,7 +734,7 @@ for i in tqdm(range(len(sub_relevant_indices))):
                 axes1[j][k].set_axis_off()
                 axes1[j][k].imshow(X_train[idx])
                 label_str = _classes[FLAGS.dataset][y_train_sparse[idx]]
-                loc_in_knn = np.where(ni[sub_index] == idx)[0][0]
+                loc_in_knn = knn_ranks[idx]
                 axes1[j][k].set_title('[{}]: {} #nn:{}'.format(feed.get_global_index('train', idx), label_str, loc_in_knn))
                 target_idx += 1
         plt.savefig(os.path.join(dir, 'helpful.png'), dpi=350)
@@ -636,7 +748,7 @@ for i in tqdm(range(len(sub_relevant_indices))):
                 axes1[j][k].set_axis_off()
                 axes1[j][k].imshow(X_train[idx])
                 label_str = _classes[FLAGS.dataset][y_train_sparse[idx]]
-                loc_in_knn = np.where(ni[sub_index] == idx)[0][0]
+                loc_in_knn = knn_ranks[idx]
                 axes1[j][k].set_title('[{}]: {} #nn:{}'.format(feed.get_global_index('train', idx), label_str, loc_in_knn))
                 target_idx += 1
         plt.savefig(os.path.join(dir, 'harmful.png'), dpi=350)
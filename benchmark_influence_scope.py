@@ -0,0 +1,135 @@
+"""
+Benchmarking the parameter subsets of the influence functions (--influence_scope, see influence/param_scope.py).
+
+For every scope of --scopes, the inverse HVPs and the scores of the first --num_samples validation samples are
+calculated over the first --train_iterations training batches. The script prints the number of parameters, the inverse
+HVP and scores time per sample, and the overlap of the top-k helpful/harmful training samples with the first scope
+(by default all the parameters), which helps to pick a cheaper scope for production.
+Run with:
+python NNIF_adv_defense/benchmark_influence_scope.py --dataset cifar10 --scopes "all;conv3_*,fc;conv3_4,fc;fc"
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import os
+import time
+import shutil
+import tempfile
+import numpy as np
+import tensorflow as tf
+from tensorflow.python.platform import flags
+from cleverhans.loss import CrossEntropy, WeightDecay, WeightedSum
+from NNIF_adv_defense.models.darkon_resnet34_model import DarkonReplica
+from NNIF_adv_defense.datasets.influence_feeder import MyFeederValTest
+from NNIF_adv_defense.influence.nnif_influence import NNIFInfluence
+from NNIF_adv_defense.influence.ihvp_solvers import make_solver
+from NNIF_adv_defense.influence.param_scope import parse_scope, scope_variables
+from NNIF_adv_defense.influence.per_example_grads import PerExampleScorer
+
+FLAGS = flags.FLAGS
+
+flags.DEFINE_string('dataset', 'cifar10', 'dataset: cifar10/100 or svhn')
+flags.DEFINE_string('checkpoint_dir', '', 'Checkpoint dir, the path to the saved model architecture and weights')
+flags.DEFINE_string('scopes', 'all;conv3_*,fc;conv3_4,fc;fc', 'semicolon separated --influence_scope values to '
+                                                              'compare. all stands for all the parameters')
+flags.DEFINE_integer('num_samples', 5, 'number of validation samples')
+flags.DEFINE_integer('train_iterations', 25, 'number of training batches to score')
+flags.DEFINE_integer('top_k', 50, 'size of the helpful/harmful heads compared between the scopes')
+flags.DEFINE_string('ihvp_solver', 'lissa', 'inverse HVP solver: lissa (approx_params), cg, arnoldi, kfac or ekfac')
+flags.DEFINE_string('per_example_grads', '', 'if pfor or map_fn, score with the vectorized per-training-sample gradients')
+
+ARCH_NAME = {'cifar10': 'model1', 'cifar100': 'model_cifar_100', 'svhn': 'model_svhn'}
+weight_decay = 0.0004
+LABEL_SMOOTHING = {'cifar10': 0.1, 'cifar100': 0.01, 'svhn': 0.1}
+
+superseed = 123456789
+rand_gen = np.random.RandomState(superseed)
+tf.set_random_seed(superseed)
+
+if FLAGS.checkpoint_dir != '':
+    model_dir = FLAGS.checkpoint_dir                          # set user specified dir
+else:
+    model_dir = os.path.join(FLAGS.dataset, 'trained_model')  # set default dir
+
+val_indices = np.load(os.path.join(model_dir, 'val_indices.npy'))
+feeder = MyFeederValTest(dataset=FLAGS.dataset, rand_gen=rand_gen, as_one_hot=True, val_inds=val_indices,
+                         test_val_set=True, mini_train_inds=None)
+
+x = tf.placeholder(tf.float32, shape=(None, 32, 32, 3), name='x')
+y = tf.placeholder(tf.float32, shape=(None, feeder.num_classes), name='y')
+model = DarkonReplica(scope=ARCH_NAME[FLAGS.dataset], nb_classes=feeder.num_classes, n=5, input_shape=[32, 32, 3])
+loss = CrossEntropy(model, smoothing=LABEL_SMOOTHING[FLAGS.dataset])
+regu_losses = WeightDecay(model)
+full_loss = WeightedSum(model, [(1.0, loss), (weight_decay, regu_losses)])
+
+testset_batch_size = 100
+train_batch_size = 200
+approx_params = {
+    'scale': 200,
+    'num_repeats': 5,
+    'recursion_depth': 5,
+    'recursion_batch_size': 200
+}
+all_variables = tf.get_collection(tf.GraphKeys.TRAINABLE_VARIABLES) + \
+                tf.get_collection(tf.GraphKeys.TRAINABLE_RESOURCE_VARIABLES)
+
+workspace = tempfile.mkdtemp()
+scopes = [scope.strip() for scope in FLAGS.scopes.split(';') if scope.strip() != '']
+inspectors = []
+for k, scope in enumerate(scopes):
+    variables = scope_variables(all_variables, [] if scope == 'all' else parse_scope(scope))
+    ihvp_solver = make_solver(FLAGS.ihvp_solver, approx_params, cache_dir=os.path.join(workspace, 'ihvp_cache'))
+    insp = NNIFInfluence(workspace=os.path.join(workspace, 'scope_{}'.format(k)), feeder=feeder,
+                         loss_op_train=full_loss.fprop(x=x, y=y), loss_op_test=loss.fprop(x=x, y=y),
+                         x_placeholder=x, y_placeholder=y, solver=ihvp_solver, trainable_variables=variables)
+    scorer = None
+    if FLAGS.per_example_grads != '':
+        scorer = PerExampleScorer(lambda xx, yy: full_loss.fprop(x=xx, y=yy), x, y, variables, train_batch_size,
+                                  FLAGS.per_example_grads)
+    inspectors.append((insp, scorer))
+
+sess = tf.Session(config=tf.ConfigProto(allow_soft_placement=True))
+saver = tf.train.Saver()
+saver.restore(sess, os.path.join(model_dir, 'best_model.ckpt'))
+
+results = []
+for scope, (insp, scorer) in zip(scopes, inspectors):
+    num_params = int(sum(np.prod(v.get_shape().as_list()) for v in insp.trainable_variables))
+    ihvp_time = 0.0
+    scores_time = 0.0
+    scores = []
+    for sub_index in range(FLAGS.num_samples):
+        start_time = time.time()
+        insp._prepare(sess, [sub_index], testset_batch_size, approx_params, force_refresh=True)
+        ihvp_time += time.time() - start_time
+        start_time = time.time()
+        if scorer is not None:
+            scores.append(insp.upweighting_influence_vectorized(sess, [sub_index], testset_batch_size, approx_params,
+                                                                scorer, FLAGS.train_iterations))
+        else:
+            scores.append(insp.upweighting_influence_batch(sess, [sub_index], testset_batch_size, approx_params,
+                                                           train_batch_size, FLAGS.train_iterations))
+        scores_time += time.time() - start_time
+    results.append((scope, num_params, ihvp_time / FLAGS.num_samples, scores_time / FLAGS.num_samples, scores))
+    print('scope {}: {} parameters, done'.format(scope, num_params))
+
+print('{:<24} {:>10} {:>12} {:>14} {:>18}'.format('scope', 'params', 'ihvp secs', 'scores secs',
+                                                  'top {} help/harm'.format(FLAGS.top_k)))
+reference_scores = results[0][4]
+for scope, num_params, ihvp_time, scores_time, scores in results:
+    helpful_overlap = []
+    harmful_overlap = []
+    for sample_scores, sample_reference in zip(scores, reference_scores):
+        order = np.argsort(sample_scores)
+        reference_order = np.argsort(sample_reference)
+        helpful_overlap.append(len(np.intersect1d(order[-FLAGS.top_k:], reference_order[-FLAGS.top_k:])) / FLAGS.top_k)
+        harmful_overlap.append(len(np.intersect1d(order[:FLAGS.top_k], reference_order[:FLAGS.top_k])) / FLAGS.top_k)
+    print('{:<24} {:>10} {:>12.2f} {:>14.2f} {:>18}'.format(scope, num_params, ihvp_time, scores_time, '{:.2f}/{:.2f}'
+          .format(np.mean(helpful_overlap), np.mean(harmful_overlap))))
+print('top-k overlaps are relative to the scope {}, averaged over {} validation samples'
+      .format(scopes[0], FLAGS.num_samples))
+
+shutil.rmtree(workspace)
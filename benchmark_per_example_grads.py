@@ -0,0 +1,98 @@
+"""
+Benchmarking the vectorized per-training-sample gradients (--per_example_grads, see influence/per_example_grads.py)
+against darkon's per-sample loop used by upweighting_influence_batch().
+
+Both paths score the first --num_batches training batches against the same vector (the test loss gradient of a
+validation sample, standing for an inverse HVP). The script prints the time per training batch of every path and how
+close the vectorized scores are to darkon's.
+Run with:
+python NNIF_adv_defense/benchmark_per_example_grads.py --dataset cifar10 --num_batches 5
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import os
+import time
+import shutil
+import tempfile
+import numpy as np
+import tensorflow as tf
+from tensorflow.python.platform import flags
+from cleverhans.loss import CrossEntropy, WeightDecay, WeightedSum
+from NNIF_adv_defense.models.darkon_resnet34_model import DarkonReplica
+from NNIF_adv_defense.datasets.influence_feeder import MyFeederValTest
+from NNIF_adv_defense.influence.nnif_influence import NNIFInfluence
+from NNIF_adv_defense.influence.per_example_grads import PerExampleScorer, PER_EXAMPLE_METHODS
+
+FLAGS = flags.FLAGS
+
+flags.DEFINE_string('dataset', 'cifar10', 'dataset: cifar10/100 or svhn')
+flags.DEFINE_string('checkpoint_dir', '', 'Checkpoint dir, the path to the saved model architecture and weights')
+flags.DEFINE_integer('num_batches', 5, 'number of training batches to score')
+flags.DEFINE_integer('train_batch_size', 200, 'training batch size')
+flags.DEFINE_integer('top_k', 50, 'size of the helpful/harmful heads compared between the paths')
+
+ARCH_NAME = {'cifar10': 'model1', 'cifar100': 'model_cifar_100', 'svhn': 'model_svhn'}
+weight_decay = 0.0004
+LABEL_SMOOTHING = {'cifar10': 0.1, 'cifar100': 0.01, 'svhn': 0.1}
+
+superseed = 123456789
+rand_gen = np.random.RandomState(superseed)
+tf.set_random_seed(superseed)
+
+if FLAGS.checkpoint_dir != '':
+    model_dir = FLAGS.checkpoint_dir                          # set user specified dir
+else:
+    model_dir = os.path.join(FLAGS.dataset, 'trained_model')  # set default dir
+
+val_indices = np.load(os.path.join(model_dir, 'val_indices.npy'))
+feeder = MyFeederValTest(dataset=FLAGS.dataset, rand_gen=rand_gen, as_one_hot=True, val_inds=val_indices,
+                         test_val_set=True, mini_train_inds=None)
+
+x = tf.placeholder(tf.float32, shape=(None, 32, 32, 3), name='x')
+y = tf.placeholder(tf.float32, shape=(None, feeder.num_classes), name='y')
+model = DarkonReplica(scope=ARCH_NAME[FLAGS.dataset], nb_classes=feeder.num_classes, n=5, input_shape=[32, 32, 3])
+loss = CrossEntropy(model, smoothing=LABEL_SMOOTHING[FLAGS.dataset])
+regu_losses = WeightDecay(model)
+full_loss = WeightedSum(model, [(1.0, loss), (weight_decay, regu_losses)])
+
+workspace = tempfile.mkdtemp()
+insp = NNIFInfluence(workspace=workspace, feeder=feeder, loss_op_train=full_loss.fprop(x=x, y=y),
+                     loss_op_test=loss.fprop(x=x, y=y), x_placeholder=x, y_placeholder=y)
+scorers = [(method, PerExampleScorer(lambda xx, yy: full_loss.fprop(x=xx, y=yy), x, y, insp.trainable_variables,
+                                     FLAGS.train_batch_size, method)) for method in PER_EXAMPLE_METHODS]
+
+sess = tf.Session(config=tf.ConfigProto(allow_soft_placement=True))
+saver = tf.train.Saver()
+saver.restore(sess, os.path.join(model_dir, 'best_model.ckpt'))
+
+# the inverse HVP does not matter for the comparison, any vector in the parameter space will do
+insp.inverse_hvp = insp._get_test_grad_loss(sess, [0], 1)
+vector = np.concatenate([a.reshape(-1) for a in insp.inverse_hvp])
+print('{} parameters, {} training batches of {} samples'.format(len(vector), FLAGS.num_batches, FLAGS.train_batch_size))
+
+feeder.reset()
+start_time = time.time()
+darkon_scores = insp._grad_diffs_all(sess, FLAGS.train_batch_size, FLAGS.num_batches, -1)
+darkon_time = (time.time() - start_time) / FLAGS.num_batches
+print('darkon per-sample loop: {:.3f} secs per batch'.format(darkon_time))
+darkon_order = np.argsort(darkon_scores)
+
+for method, scorer in scorers:
+    scorer.scores(sess, feeder, vector, 1)  # warm up
+    start_time = time.time()
+    scores = scorer.scores(sess, feeder, vector, FLAGS.num_batches)
+    scorer_time = (time.time() - start_time) / FLAGS.num_batches
+    order = np.argsort(scores)
+    helpful_overlap = len(np.intersect1d(order[-FLAGS.top_k:], darkon_order[-FLAGS.top_k:])) / FLAGS.top_k
+    harmful_overlap = len(np.intersect1d(order[:FLAGS.top_k], darkon_order[:FLAGS.top_k])) / FLAGS.top_k
+    print('{} (built as {}): {:.3f} secs per batch ({:.1f}x). max relative error: {:.2e}. '
+          'top {} helpful/harmful overlap: {:.2f}/{:.2f}'
+          .format(method, scorer.method, scorer_time, darkon_time / scorer_time,
+                  np.abs(scores - darkon_scores).max() / np.abs(darkon_scores).max(), FLAGS.top_k,
+                  helpful_overlap, harmful_overlap))
+
+shutil.rmtree(workspace)
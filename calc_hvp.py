@@ -37,6 +37,11 @@ from cleverhans.utils import AccuracyReport, set_log_level
 from NNIF_adv_defense.tools.utils import one_hot
 from sklearn.neighbors import NearestNeighbors
 from NNIF_adv_defense.datasets.influence_feeder import MyFeederValTest
+from NNIF_adv_defense.influence.nnif_influence import NNIFInfluence
+from NNIF_adv_defense.influence.ihvp_solvers import make_solver, append_solver_log
+from NNIF_adv_defense.influence.last_layer import LastLayerInfluence, get_fc_params, lissa_damping
+from NNIF_adv_defense.influence.shards import select_indices, shard_indices
+from NNIF_adv_defense.influence.param_scope import parse_scope, scope_variables, scope_scores_name
 import pickle
 from cleverhans.utils import random_targets
 from cleverhans.evaluation import batch_eval
@@ -49,7 +54,29 @@ flags.DEFINE_string('dataset', 'cifar10', 'datasset: cifar10/100 or svhn')
 flags.DEFINE_string('set', 'val', 'val or test set to evaluate')
 flags.DEFINE_string('attack', 'deepfool', 'adversarial attack: deepfool, jsma, cw, cw_nnif')
 flags.DEFINE_string('checkpoint_dir', '', 'Checkpoint dir, the path to the saved model architecture and weights')
-
+flags.DEFINE_integer('ihvp_block_size', 1, 'number of val/test samples that share a single LiSSA recursion')
+flags.DEFINE_string('ihvp_solver', 'lissa', 'inverse HVP solver: lissa (approx_params), cg, arnoldi, kfac or ekfac')
+flags.DEFINE_integer('ihvp_max_iters', 100, 'maximum CG iterations / number of Arnoldi iterations')
+flags.DEFINE_float('ihvp_tol', 1e-3, 'CG relative residual tolerance')
+flags.DEFINE_integer('arnoldi_top_k', 50, 'number of Hessian eigenpairs kept by the arnoldi solver')
+flags.DEFINE_integer('hvp_num_batches', 5, 'number of training mini-batches of the Hessian used by cg/arnoldi')
+flags.DEFINE_float('lissa_tol', 0.0, 'if > 0, stop a LiSSA repeat once the relative change of a step is below it')
+flags.DEFINE_float('lissa_repeats_tol', 0.0, 'if > 0, stop the LiSSA repeats once the relative standard error of '
+                                             'their average is below it (at most num_repeats repeats)')
+flags.DEFINE_integer('lissa_min_repeats', 2, 'minimal number of LiSSA repeats with --lissa_repeats_tol')
+flags.DEFINE_string('ihvp_store', '', 'if float32 or float16, keep the inverse HVPs compressed in a packed store per '
+                                        'workspace (see influence/ihvp_store.py) instead of a .npz file per sample')
+flags.DEFINE_string('influence_params', 'all', 'parameters of the influence functions: all (LiSSA) or last_layer '
+                                               '(exact, only the fc layer)')
+flags.DEFINE_string('influence_scope', '', 'comma separated variable scopes of the parameters of the influence '
+                                            'functions, e.g. conv3_*,fc (see influence/param_scope.py). Empty for all')
+
+flags.DEFINE_string('selection', 'all', 'samples to run: all, net_succ (the only ones read by extract_characteristics.py) '
+                                       'or net_succ_and_attack_succ')
+flags.DEFINE_integer('num_shards', 1, 'split the val/test samples deterministically into this number of shards')
+flags.DEFINE_integer('shard_id', 0, 'the shard to run, in [0, num_shards)')
+flags.DEFINE_string('shard_index_file', '', 'file with the sub indices to run (one index or range first-last per line). '
+                                            'Replaces --num_shards/--shard_id')
 
 # TODO: remove
 flags.DEFINE_string('mode', 'null', 'to bypass pycharm bug')
@@ -442,22 +469,6 @@ feeder.reset()
 pred_feeder.reset()
 adv_feeder.reset()
 
-inspector_pred = darkon.Influence(
-    workspace=os.path.join(workspace_dir, 'pred'),
-    feeder=pred_feeder,
-    loss_op_train=full_loss.fprop(x=x, y=y),
-    loss_op_test=loss.fprop(x=x, y=y),
-    x_placeholder=x,
-    y_placeholder=y)
-
-inspector_adv = darkon.Influence(
-    workspace=os.path.join(workspace_dir, 'adv', FLAGS.attack),
-    feeder=adv_feeder,
-    loss_op_train=full_loss.fprop(x=x, y=y),
-    loss_op_test=loss.fprop(x=x, y=y),
-    x_placeholder=x,
-    y_placeholder=y)
-
 # some optimizations for the darkon influence function implementations
 testset_batch_size = 100
 approx_params = {
@@ -467,63 +478,140 @@ approx_params = {
     'recursion_batch_size': 200
 }
 
-sub_relevant_indices = [ind for ind in info[FLAGS.set]]
-relevant_indices     = [info[FLAGS.set][ind]['global_index'] for ind in sub_relevant_indices]
+ihvp_solver = make_solver(FLAGS.ihvp_solver, approx_params, max_iters=FLAGS.ihvp_max_iters, tol=FLAGS.ihvp_tol,
+                          top_k=FLAGS.arnoldi_top_k, num_batches=FLAGS.hvp_num_batches,
+                          cache_dir=os.path.join(model_dir, 'ihvp_' + FLAGS.ihvp_solver), lissa_tol=FLAGS.lissa_tol,
+                          lissa_repeats_tol=FLAGS.lissa_repeats_tol, lissa_min_repeats=FLAGS.lissa_min_repeats)
 
-for i in tqdm(range(len(sub_relevant_indices))):
-    sub_index = sub_relevant_indices[i]
-    if test_val_set:
-        global_index = feeder.val_inds[sub_index]
-    else:
-        global_index = feeder.test_inds[sub_index]
-    assert global_index == relevant_indices[i]
-
-    _, real_label = feeder.test_indices(sub_index)
-    real_label = np.argmax(real_label)
+# the parameters of the influence functions: all the trainable variables, or the subset of --influence_scope
+influence_variables = scope_variables(tf.get_collection(tf.GraphKeys.TRAINABLE_VARIABLES) +
+                                      tf.get_collection(tf.GraphKeys.TRAINABLE_RESOURCE_VARIABLES),
+                                      parse_scope(FLAGS.influence_scope))
+scope_scores_name(FLAGS.influence_params, parse_scope(FLAGS.influence_scope))  # checks the flags
 
-    if test_val_set:
-        pred_label = x_val_preds[sub_index]
-    else:
-        pred_label = x_test_preds[sub_index]
-
-    _, adv_label = adv_feeder.test_indices(sub_index)
-    adv_label = np.argmax(adv_label)
-
-    if info[FLAGS.set][sub_index]['attack_succ']:
-        assert pred_label != adv_label, 'failed for i={}, sub_index={}, global_index={}'.format(i, sub_index, global_index)
-    if info[FLAGS.set][sub_index]['net_succ']:
-        assert pred_label == real_label, 'failed for i={}, sub_index={}, global_index={}'.format(i, sub_index, global_index)
-
-    progress_str = 'sample {}/{}: calculating HVP matrices for {} index {} (sub={}).\n' \
-                   'real label: {}, adv label: {}, pred label: {}. net_succ={}, attack_succ={}' \
-        .format(i + 1, len(sub_relevant_indices), FLAGS.set, global_index, sub_index,
-                _classes[FLAGS.dataset][real_label], _classes[FLAGS.dataset][adv_label], _classes[FLAGS.dataset][pred_label],
-                info[FLAGS.set][sub_index]['net_succ'], info[FLAGS.set][sub_index]['attack_succ'])
-    logging.info(progress_str)
-    print(progress_str)
+inspector_pred = NNIFInfluence(
+    workspace=os.path.join(workspace_dir, 'pred'),
+    feeder=pred_feeder,
+    loss_op_train=full_loss.fprop(x=x, y=y),
+    loss_op_test=loss.fprop(x=x, y=y),
+    x_placeholder=x,
+    y_placeholder=y,
+    block_size=FLAGS.ihvp_block_size,
+    solver=ihvp_solver,
+    trainable_variables=influence_variables,
+    ihvp_store_dtype=FLAGS.ihvp_store or None)
+
+# the adv inspector shares the loss, gradient and HVP ops of the pred inspector, only its feeder is different
+inspector_adv = inspector_pred.clone(workspace=os.path.join(workspace_dir, 'adv', FLAGS.attack), feeder=adv_feeder)
+
+sub_relevant_indices = shard_indices(select_indices(info[FLAGS.set], FLAGS.selection), FLAGS.num_shards,
+                                     FLAGS.shard_id, FLAGS.shard_index_file)
+print('running {} out of {} {} samples'.format(len(sub_relevant_indices), len(info[FLAGS.set]), FLAGS.set))
+relevant_indices     = [info[FLAGS.set][ind]['global_index'] for ind in sub_relevant_indices]
 
+if FLAGS.influence_params == 'last_layer':
+    # exact inverse HVPs w.r.t. the fc layer only, for all the val/test samples at once (no LiSSA)
+    fc_weights, fc_bias = get_fc_params(sess, model)
+    last_layer_insp = LastLayerInfluence(fc_weights, fc_bias, LABEL_SMOOTHING[FLAGS.dataset], weight_decay,
+                                         damping=lissa_damping(approx_params))
     start_time = time.time()
-    for insp in [inspector_pred, inspector_adv]:
-        try:
-            insp._prepare(
+    for insp, case_features in [(inspector_pred, features), (inspector_adv, features_adv)]:
+        _, case_labels = insp.feeder.test_indices(range(insp.feeder.get_test_size()))
+        last_layer_insp.load_or_calc_inverse_hvps(insp.workspace, x_train_features, case_features, case_labels)
+    print('last layer ihvp calculation time: {} secs for {} samples'.format(time.time() - start_time, len(features)))
+elif FLAGS.influence_params != 'all':
+    raise AssertionError('influence_params {} is not supported'.format(FLAGS.influence_params))
+elif FLAGS.ihvp_block_size > 1:
+    assert FLAGS.ihvp_solver == 'lissa', '--ihvp_block_size is only supported with the lissa solver'
+    assert FLAGS.lissa_repeats_tol == 0, '--ihvp_block_size runs all the num_repeats LiSSA repeats'
+    assert FLAGS.lissa_tol == 0, '--ihvp_block_size runs the full LiSSA recursion, do not set --lissa_tol'
+    # block mode: a single LiSSA recursion calculates the HVP matrices of FLAGS.ihvp_block_size samples at once.
+    # The per-sample HVP files are written to the same darkon workspace, so calc_scores.py is unaffected.
+    ihvp_log_file = os.path.join(workspace_dir, 'ihvp_solver_log.jsonl')  # per-sample steps and timings
+    for start in tqdm(range(0, len(sub_relevant_indices), FLAGS.ihvp_block_size)):
+        block = sub_relevant_indices[start:start + FLAGS.ihvp_block_size]
+        print('samples {}-{}/{}: calculating HVP matrices for {} sub indices {}'
+              .format(start + 1, start + len(block), len(sub_relevant_indices), FLAGS.set, block))
+
+        start_time = time.time()
+        for case, insp in [('pred', inspector_pred), ('adv', inspector_adv)]:
+            block_stats = insp.prepare_block(
                 sess=sess,
-                test_indices=[sub_index],
+                test_indices=block,
                 test_batch_size=testset_batch_size,
                 approx_params=approx_params,
-                force_refresh=False  # Maybe there is already a prior calculation. If so, load its numpy
+                force_refresh=False  # samples with a prior calculation are skipped
             )
-        except Exception as e:
-            print('Error with influence _prepare for sub_index={} (global_idex={}): {}. Forcing...'.format(sub_index, global_index, e))
-            insp._prepare(
-                sess=sess,
-                test_indices=[sub_index],
-                test_batch_size=testset_batch_size,
-                approx_params=approx_params,
-                force_refresh=True
-            )
-    end_time = time.time() - start_time
-    end_time_single_case = end_time / 2.0
-    print('ihvp calculation time: {} secs. global_index: {} (sub: {})'
-          .format(end_time_single_case, global_index, sub_index))
+            for sub_index in block:
+                if sub_index in block_stats:
+                    append_solver_log(ihvp_log_file, dict(block_stats[sub_index], set=FLAGS.set, case=case,
+                                                          sub_index=int(sub_index),
+                                                          global_index=int(info[FLAGS.set][sub_index]['global_index'])))
+        end_time = time.time() - start_time
+        end_time_single_case = end_time / (2.0 * len(block))
+        print('ihvp calculation time: {} secs per sample. block sub indices: {}'.format(end_time_single_case, block))
+else:
+    ihvp_log_file = os.path.join(workspace_dir, 'ihvp_solver_log.jsonl')  # per-sample iterations and timings
+    for i in tqdm(range(len(sub_relevant_indices))):
+        sub_index = sub_relevant_indices[i]
+        if test_val_set:
+            global_index = feeder.val_inds[sub_index]
+        else:
+            global_index = feeder.test_inds[sub_index]
+        assert global_index == relevant_indices[i]
+
+        _, real_label = feeder.test_indices(sub_index)
+        real_label = np.argmax(real_label)
+
+        if test_val_set:
+            pred_label = x_val_preds[sub_index]
+        else:
+            pred_label = x_test_preds[sub_index]
+
+        _, adv_label = adv_feeder.test_indices(sub_index)
+        adv_label = np.argmax(adv_label)
+
+        if info[FLAGS.set][sub_index]['attack_succ']:
+            assert pred_label != adv_label, 'failed for i={}, sub_index={}, global_index={}'.format(i, sub_index, global_index)
+        if info[FLAGS.set][sub_index]['net_succ']:
+            assert pred_label == real_label, 'failed for i={}, sub_index={}, global_index={}'.format(i, sub_index, global_index)
+
+        progress_str = 'sample {}/{}: calculating HVP matrices for {} index {} (sub={}).\n' \
+                       'real label: {}, adv label: {}, pred label: {}. net_succ={}, attack_succ={}' \
+            .format(i + 1, len(sub_relevant_indices), FLAGS.set, global_index, sub_index,
+                    _classes[FLAGS.dataset][real_label], _classes[FLAGS.dataset][adv_label], _classes[FLAGS.dataset][pred_label],
+                    info[FLAGS.set][sub_index]['net_succ'], info[FLAGS.set][sub_index]['attack_succ'])
+        logging.info(progress_str)
+        print(progress_str)
+
+        start_time = time.time()
+        for case, insp in [('pred', inspector_pred), ('adv', inspector_adv)]:
+            try:
+                insp._prepare(
+                    sess=sess,
+                    test_indices=[sub_index],
+                    test_batch_size=testset_batch_size,
+                    approx_params=approx_params,
+                    force_refresh=False  # Maybe there is already a prior calculation. If so, load its numpy
+                )
+            except Exception as e:
+                print('Error with influence _prepare for sub_index={} (global_idex={}): {}. Forcing...'.format(sub_index, global_index, e))
+                insp._prepare(
+                    sess=sess,
+                    test_indices=[sub_index],
+                    test_batch_size=testset_batch_size,
+                    approx_params=approx_params,
+                    force_refresh=True
+                )
+            if insp.last_solve_stats is not None:
+                append_solver_log(ihvp_log_file, dict(insp.last_solve_stats, set=FLAGS.set, case=case,
+                                                      sub_index=int(sub_index), global_index=int(global_index)))
+                if FLAGS.lissa_repeats_tol > 0:
+                    print('case {}: {}/{} LiSSA repeats used'.format(case, insp.last_solve_stats['repeats'],
+                                                                     approx_params['num_repeats']))
+        end_time = time.time() - start_time
+        end_time_single_case = end_time / 2.0
+        print('ihvp calculation time: {} secs. global_index: {} (sub: {})'
+              .format(end_time_single_case, global_index, sub_index))
 
 print('Done creating all HVP successfully.')
\ No newline at end of file
@@ -24,6 +24,8 @@ import logging
 import numpy as np
 import tensorflow as tf
 import os
+import shutil
+import tempfile
 import imageio
 import darkon
 from cleverhans.attacks import FastGradientMethod, DeepFool, SaliencyMapMethod, CarliniWagnerL2, MadryEtAl, ElasticNetMethod
@@ -32,15 +34,28 @@ from cleverhans.loss import CrossEntropy, WeightDecay, WeightedSum
 from NNIF_adv_defense.models.darkon_resnet34_model import DarkonReplica
 from cleverhans.utils import AccuracyReport, set_log_level
 from NNIF_adv_defense.tools.utils import one_hot
-from sklearn.neighbors import NearestNeighbors
 from NNIF_adv_defense.datasets.influence_feeder import MyFeederValTest
+from NNIF_adv_defense.influence.score_workers import ScoreWorkerPool, save_shared_arrays, save_image, scores_dir
+from NNIF_adv_defense.influence.train_grad_cache import TrainGradientCache, checkpoint_key
+from NNIF_adv_defense.influence.nnif_influence import NNIFInfluence
+from NNIF_adv_defense.influence.per_example_grads import PerExampleScorer
+from NNIF_adv_defense.influence.ihvp_solvers import make_solver, append_solver_log, KFAC_SOLVERS
+from NNIF_adv_defense.influence.last_layer import LastLayerInfluence, get_fc_params, lissa_damping
+from NNIF_adv_defense.influence.score_files import save_scores, scores_complete
+from NNIF_adv_defense.influence.score_store import ScoreStore, store_dir
+from NNIF_adv_defense.influence.work_ledger import WorkLedger, owner_name, PENDING, CLAIMED, DONE
+from NNIF_adv_defense.influence.shards import select_indices, shard_indices, shard_suffix
+from NNIF_adv_defense.influence.param_scope import parse_scope, scope_variables, scope_scores_name
+from NNIF_adv_defense.influence.result_cache import InfluenceResultCache, RESULT_CACHE_DIR, config_key, train_subset_key
 import pickle
 from cleverhans.utils import random_targets
 from cleverhans.evaluation import batch_eval
 
 import copy
+from tqdm import tqdm
 from threading import Thread
 from Queue import Queue
+from collections import deque
 import time
 
 FLAGS = flags.FLAGS
@@ -51,6 +66,45 @@ flags.DEFINE_string('set', 'val', 'val or test set to evaluate')
 flags.DEFINE_string('attack', 'deepfool', 'adversarial attack: deepfool, jsma, cw, cw_nnif')
 flags.DEFINE_string('checkpoint_dir', '', 'Checkpoint dir, the path to the saved model architecture and weights')
 flags.DEFINE_integer('num_threads', 1, 'number of threads')
+flags.DEFINE_integer('num_processes', 0, 'number of worker processes. If > 0, replaces the threads (--num_threads)')
+flags.DEFINE_integer('threads_per_process', 1, 'number of TF intra-op threads of every worker process')
+flags.DEFINE_bool('train_grad_cache', False, 'calculate the per-training-sample gradients once and reuse them')
+flags.DEFINE_string('train_grad_cache_dtype', 'float32', 'storage dtype of the train gradients cache: float32/float16')
+flags.DEFINE_integer('sketch_dim', 0, 'if > 0, estimate the scores in a random projection of the gradients to this '
+                                      'dimension (e.g. 2000-8000). Implies --train_grad_cache')
+flags.DEFINE_string('per_example_grads', '', 'if pfor or map_fn, calculate the per-training-sample gradients of a '
+                                              'whole training batch in a single graph execution')
+flags.DEFINE_string('ihvp_solver', 'lissa', 'inverse HVP solver: lissa (approx_params), cg, arnoldi, kfac or ekfac')
+flags.DEFINE_integer('ihvp_max_iters', 100, 'maximum CG iterations / number of Arnoldi iterations')
+flags.DEFINE_float('ihvp_tol', 1e-3, 'CG relative residual tolerance')
+flags.DEFINE_integer('arnoldi_top_k', 50, 'number of Hessian eigenpairs kept by the arnoldi solver')
+flags.DEFINE_integer('hvp_num_batches', 5, 'number of training mini-batches of the Hessian used by cg/arnoldi')
+flags.DEFINE_float('lissa_tol', 0.0, 'if > 0, stop a LiSSA repeat once the relative change of a step is below it')
+flags.DEFINE_float('lissa_repeats_tol', 0.0, 'if > 0, stop the LiSSA repeats once the relative standard error of '
+                                             'their average is below it (at most num_repeats repeats)')
+flags.DEFINE_integer('lissa_min_repeats', 2, 'minimal number of LiSSA repeats with --lissa_repeats_tol')
+flags.DEFINE_string('ihvp_store', '', 'if float32 or float16, keep the inverse HVPs compressed in a packed store per '
+                                        'workspace (see influence/ihvp_store.py) instead of a .npz file per sample')
+flags.DEFINE_integer('scores_top_k', 0, 'if > 0, save only the top k helpful/harmful training samples (scores_topk.npz)')
+flags.DEFINE_bool('score_store', False, 'write the scores to a single memory mapped store per case instead of a '
+                                        'scores file per val/test index')
+flags.DEFINE_bool('result_cache', False, 'reuse the scores of identical (checkpoint, image, label, scores config) '
+                                          'across sets and attacks, see influence/result_cache.py')
+flags.DEFINE_integer('max_attempts', 3, 'number of times a failed (val/test sample, case) is retried, across restarts')
+flags.DEFINE_string('influence_params', 'all', 'parameters of the influence functions: all (LiSSA) or last_layer '
+                                               '(exact, only the fc layer)')
+flags.DEFINE_string('influence_scope', '', 'comma separated variable scopes of the parameters of the influence '
+                                            'functions, e.g. conv3_*,fc (see influence/param_scope.py). Empty for all')
+
+flags.DEFINE_bool('pipeline', False, 'calculate the HVP matrices (STAGE A) in this run too, concurrently with the scores')
+flags.DEFINE_integer('num_hvp_threads', 1, 'number of threads calculating the HVP matrices with --pipeline')
+flags.DEFINE_integer('pipeline_queue_size', 16, 'max number of samples with HVP matrices waiting to be scored')
+flags.DEFINE_string('selection', 'all', 'samples to run: all, net_succ (the only ones read by extract_characteristics.py) '
+                                       'or net_succ_and_attack_succ')
+flags.DEFINE_integer('num_shards', 1, 'split the val/test samples deterministically into this number of shards')
+flags.DEFINE_integer('shard_id', 0, 'the shard to run, in [0, num_shards)')
+flags.DEFINE_string('shard_index_file', '', 'file with the sub indices to run (one index or range first-last per line). '
+                                            'Replaces --num_shards/--shard_id')
 
 # TODO: remove
 flags.DEFINE_string('mode', 'null', 'to bypass pycharm bug')
@@ -65,7 +119,11 @@ else:
     WORKSPACE = 'influence_workspace_test_mini'
     USE_TRAIN_MINI = True
 
+assert not (FLAGS.pipeline and FLAGS.num_processes > 0), '--pipeline runs the scores with threads (--num_threads)'
+
 TARGETED = FLAGS.attack != 'deepfool'  # we use targeted attacks everywhere except deepfool
+SHARD_SUFFIX = shard_suffix(FLAGS.num_shards, FLAGS.shard_id, FLAGS.shard_index_file)
+SCORES_NAME = scope_scores_name(FLAGS.influence_params, parse_scope(FLAGS.influence_scope))  # the scores files/stores
 
 _classes = {
     'cifar10': (
@@ -111,6 +169,10 @@ tf.set_random_seed(superseed)
 # Set logging level to see debug information
 set_log_level(logging.DEBUG)
 
+# Fork the worker processes (if used) before this process creates its TF session
+if FLAGS.num_processes > 0 and FLAGS.influence_params == 'all':
+    worker_pool = ScoreWorkerPool(num_processes=FLAGS.num_processes, threads_per_process=FLAGS.threads_per_process)
+
 # Create TF session
 config_args = dict(allow_soft_placement=True)
 sess = tf.Session(config=tf.ConfigProto(**config_args))
@@ -406,21 +468,13 @@ else:
         info_old = pickle.load(handle)
     assert info == info_old
 
-# start the knn observation
-knn = NearestNeighbors(n_neighbors=feeder.get_train_size(), p=2, n_jobs=20)
-knn.fit(x_train_features)
+# the embeddings of the val/test set (the scores do not need their nearest neighbors, see extract_characteristics.py)
 if test_val_set:
-    print('predicting knn for all val set')
     features     = x_val_features
     features_adv = x_val_features_adv
 else:
-    print('predicting knn for all test set')
     features     = x_test_features
     features_adv = x_test_features_adv
-print('predicting knn dist/indices for normal image')
-all_neighbor_dists    , all_neighbor_indices     = knn.kneighbors(features, return_distance=True)
-print('predicting knn dist/indices for adv image')
-all_neighbor_dists_adv, all_neighbor_indices_adv = knn.kneighbors(features_adv, return_distance=True)
 
 # setting pred feeder. This is our feeder which is used to generate the features for the natural images
 pred_feeder = MyFeederValTest(dataset=FLAGS.dataset, rand_gen=rand_gen, as_one_hot=True,
@@ -447,31 +501,6 @@ feeder.reset()
 pred_feeder.reset()
 adv_feeder.reset()
 
-inspector_list = []
-inspector_pred_list = []
-inspector_adv_list = []
-
-for ii in range(FLAGS.num_threads):
-    print('Setting feeders for thread #{}...'.format(ii+1))
-    inspector_pred_list.append(
-        darkon.Influence(
-            workspace=os.path.join(workspace_dir, 'pred'),
-            feeder=copy.deepcopy(pred_feeder),
-            loss_op_train=full_loss.fprop(x=x, y=y),
-            loss_op_test=loss.fprop(x=x, y=y),
-            x_placeholder=x,
-            y_placeholder=y)
-    )
-    inspector_adv_list.append(
-        darkon.Influence(
-            workspace=os.path.join(workspace_dir, 'adv', FLAGS.attack),
-            feeder=copy.deepcopy(adv_feeder),
-            loss_op_train=full_loss.fprop(x=x, y=y),
-            loss_op_test=loss.fprop(x=x, y=y),
-            x_placeholder=x,
-            y_placeholder=y)
-    )
-
 # some optimizations for the darkon influence function implementations
 testset_batch_size = 100
 train_batch_size = 200
@@ -483,99 +512,442 @@ approx_params = {
     'recursion_batch_size': 200
 }
 
-sub_relevant_indices = [ind for ind in info[FLAGS.set]]
+ihvp_solver = make_solver(FLAGS.ihvp_solver, approx_params, max_iters=FLAGS.ihvp_max_iters, tol=FLAGS.ihvp_tol,
+                          top_k=FLAGS.arnoldi_top_k, num_batches=FLAGS.hvp_num_batches,
+                          cache_dir=os.path.join(model_dir, 'ihvp_' + FLAGS.ihvp_solver), lissa_tol=FLAGS.lissa_tol,
+                          lissa_repeats_tol=FLAGS.lissa_repeats_tol, lissa_min_repeats=FLAGS.lissa_min_repeats)
+
+# the parameters of the influence functions: all the trainable variables, or the subset of --influence_scope
+influence_variables = scope_variables(tf.get_collection(tf.GraphKeys.TRAINABLE_VARIABLES) +
+                                      tf.get_collection(tf.GraphKeys.TRAINABLE_RESOURCE_VARIABLES),
+                                      parse_scope(FLAGS.influence_scope))
+
+inspector_list = []
+inspector_pred_list = []
+inspector_adv_list = []
+hvp_inspector_pred_list = []  # STAGE A inspectors of --pipeline
+hvp_inspector_adv_list = []
+
+if FLAGS.num_processes == 0 and FLAGS.influence_params == 'all':  # the worker processes build their own inspectors
+    # the loss, gradient and HVP ops are built once and shared by all the inspectors. Only the feeders are per thread
+    base_inspector = NNIFInfluence(
+        workspace=os.path.join(workspace_dir, 'pred'),
+        feeder=pred_feeder,
+        loss_op_train=full_loss.fprop(x=x, y=y),
+        loss_op_test=loss.fprop(x=x, y=y),
+        x_placeholder=x,
+        y_placeholder=y,
+        solver=ihvp_solver,
+        trainable_variables=influence_variables,
+        ihvp_store_dtype=FLAGS.ihvp_store or None)
+    for ii in range(FLAGS.num_threads):
+        print('Setting feeders for thread #{}...'.format(ii+1))
+        inspector_pred_list.append(base_inspector.clone(workspace=os.path.join(workspace_dir, 'pred'),
+                                                        feeder=copy.deepcopy(pred_feeder)))
+        inspector_adv_list.append(base_inspector.clone(workspace=os.path.join(workspace_dir, 'adv', FLAGS.attack),
+                                                       feeder=copy.deepcopy(adv_feeder)))
+    if FLAGS.pipeline:
+        for ii in range(FLAGS.num_hvp_threads):
+            hvp_inspector_pred_list.append(base_inspector.clone(workspace=os.path.join(workspace_dir, 'pred'),
+                                                                feeder=copy.deepcopy(pred_feeder)))
+            hvp_inspector_adv_list.append(base_inspector.clone(workspace=os.path.join(workspace_dir, 'adv', FLAGS.attack),
+                                                               feeder=copy.deepcopy(adv_feeder)))
+
+sub_relevant_indices = shard_indices(select_indices(info[FLAGS.set], FLAGS.selection), FLAGS.num_shards,
+                                     FLAGS.shard_id, FLAGS.shard_index_file)
+print('running {} out of {} {} samples'.format(len(sub_relevant_indices), len(info[FLAGS.set]), FLAGS.set))
 relevant_indices     = [info[FLAGS.set][ind]['global_index'] for ind in sub_relevant_indices]
 
-def collect_influence(q, thread_id):
-    while not q.empty():
-        work = q.get()
-        i = work[0]
-        try:
-            sub_index = sub_relevant_indices[i]
-            if test_val_set:
-                global_index = feeder.val_inds[sub_index]
-            else:
-                global_index = feeder.test_inds[sub_index]
-            assert global_index == relevant_indices[i]
-
-            _, real_label = feeder.test_indices(sub_index)
-            real_label = np.argmax(real_label)
-
-            if test_val_set:
-                pred_label = x_val_preds[sub_index]
-            else:
-                pred_label = x_test_preds[sub_index]
-
-            _, adv_label = adv_feeder.test_indices(sub_index)
-            adv_label = np.argmax(adv_label)
-
-            if info[FLAGS.set][sub_index]['attack_succ']:
-                assert pred_label != adv_label, 'failed for i={}, sub_index={}, global_index={}'.format(i, sub_index, global_index)
-            if info[FLAGS.set][sub_index]['net_succ']:
-                assert pred_label == real_label, 'failed for i={}, sub_index={}, global_index={}'.format(i, sub_index, global_index)
-            progress_str = 'thread_id: {}. sample {}/{}: calculating scores for {} index {} (sub={}).\n' \
-                           'real label: {}, adv label: {}, pred label: {}. net_succ={}, attack_succ={}' \
-                .format(thread_id, i + 1, len(sub_relevant_indices), FLAGS.set, global_index, sub_index, _classes[real_label],
-                        _classes[adv_label], _classes[pred_label], info[FLAGS.set][sub_index]['net_succ'], info[FLAGS.set][sub_index]['attack_succ'])
-            logging.info(progress_str)
-            print(progress_str)
-
-            cases = ['pred', 'adv']
-
-            for case in cases:
-                if case == 'pred':
-                    insp = inspector_pred_list[thread_id]
-                    feed = pred_feeder
-                elif case == 'adv':
-                    insp = inspector_adv_list[thread_id]
-                    feed = adv_feeder
-
-                # creating the relevant index folders
-                dir = os.path.join(model_dir, FLAGS.set, FLAGS.set + '_index_{}'.format(global_index), case)
-                if case == 'adv':
-                    dir = os.path.join(dir, FLAGS.attack)
-                if not os.path.exists(dir):
-                    os.makedirs(dir)
+# The gradients of the training samples do not depend on the val/test sample. Calculate them once for this checkpoint
+train_grad_cache = None
+if FLAGS.influence_params == 'all' and (FLAGS.train_grad_cache or FLAGS.sketch_dim > 0):
+    train_grad_cache = TrainGradientCache.for_checkpoint(
+        cache_dir=os.path.join(model_dir, 'train_grad_cache'),
+        sess=sess,
+        variables=influence_variables,
+        train_set='train_mini' if USE_TRAIN_MINI else 'train',
+        num_train=train_batch_size * train_iterations,
+        dtype=FLAGS.train_grad_cache_dtype,
+        sketch_dim=FLAGS.sketch_dim)
+    if not train_grad_cache.is_complete():
+        print('Calculating the train gradients cache {}...'.format(train_grad_cache.path))
+        if len(inspector_pred_list) > 0:
+            train_grad_op = base_inspector.grad_op_train  # the same gradients, already in the graph
+        else:
+            train_grad_op = tf.gradients(full_loss.fprop(x=x, y=y), influence_variables)
+        train_grad_cache.build(sess, train_grad_op, x, y, copy.deepcopy(feeder), train_batch_size)
+
+# The K-FAC factors also depend only on the checkpoint. They are calculated (or loaded) here, since the threads share
+# the solver and the worker processes finalize their graphs
+if FLAGS.influence_params == 'all' and FLAGS.ihvp_solver in KFAC_SOLVERS:
+    if len(inspector_pred_list) > 0:
+        kfac_loss_op = base_inspector.loss_op_train  # the training loss of the shared graph
+    else:
+        kfac_loss_op = full_loss.fprop(x=x, y=y)
+    ihvp_solver.prepare_factors(sess, kfac_loss_op, x, y, influence_variables, copy.deepcopy(feeder))
+
+# So is the Arnoldi eigenbasis. The worker processes load it from its file instead of all calculating it
+if FLAGS.influence_params == 'all' and FLAGS.ihvp_solver == 'arnoldi':
+    if len(inspector_pred_list) > 0:
+        arnoldi_inspector = base_inspector
+    else:
+        arnoldi_inspector = NNIFInfluence(
+            workspace=os.path.join(workspace_dir, 'pred'),
+            feeder=copy.deepcopy(pred_feeder),
+            loss_op_train=full_loss.fprop(x=x, y=y),
+            loss_op_test=loss.fprop(x=x, y=y),
+            x_placeholder=x,
+            y_placeholder=y,
+            solver=ihvp_solver,
+            trainable_variables=influence_variables)
+    ihvp_solver.prepare(sess, arnoldi_inspector)
+
+# The per-training-sample gradients of a whole training batch in a single graph execution (shared by all threads)
+per_example_scorer = None
+if len(inspector_pred_list) > 0 and FLAGS.per_example_grads != '' and train_grad_cache is None:
+    per_example_scorer = PerExampleScorer(lambda xx, yy: full_loss.fprop(x=xx, y=yy), x, y,
+                                          base_inspector.trainable_variables, train_batch_size, FLAGS.per_example_grads)
+
+# A single preallocated score store per case, instead of a directory per val/test index
+score_stores = None
+if FLAGS.score_store:
+    assert FLAGS.scores_top_k == 0, '--score_store holds the full scores, do not set --scores_top_k'
+    score_stores = {}
+    for case in ['pred', 'adv']:
+        score_stores[case] = ScoreStore(store_dir(model_dir, FLAGS.set, case, FLAGS.attack, SCORES_NAME) +
+                                        SHARD_SUFFIX)  # a store per shard, merged by merge_shards.py
+        score_stores[case].create(num_samples=len(info[FLAGS.set]), num_train=feeder.get_train_size())
+        score_stores[case].open(writable=True)
+        print('score store {}: {}/{} samples are done'
+              .format(score_stores[case].dir, score_stores[case].num_done(), len(info[FLAGS.set])))
+
+# A content-addressed cache of the scores, shared by all the sets and attacks of this checkpoint
+result_cache = None
+if FLAGS.result_cache and FLAGS.influence_params == 'all':
+    result_cache = InfluenceResultCache(
+        dir=os.path.join(model_dir, RESULT_CACHE_DIR),
+        checkpoint_key=checkpoint_key(sess, tf.get_collection(tf.GraphKeys.TRAINABLE_VARIABLES) +
+                                      tf.get_collection(tf.GraphKeys.TRAINABLE_RESOURCE_VARIABLES)),
+        config_key=config_key({
+            'scores_name': SCORES_NAME,
+            'variables': [v.name for v in influence_variables],
+            'approx_params': approx_params,
+            'ihvp_solver': {'name': ihvp_solver.name, 'config': ihvp_solver.config()},
+            'train_subset': train_subset_key(feeder.mini_train_inds if USE_TRAIN_MINI else feeder.train_inds),
+            'num_train': train_batch_size * train_iterations,
+            'loss': {'label_smoothing': LABEL_SMOOTHING[FLAGS.dataset], 'weight_decay': weight_decay},
+            'sketch_dim': FLAGS.sketch_dim,
+            'train_grad_cache_dtype': None if train_grad_cache is None else FLAGS.train_grad_cache_dtype}))
+    print('influence result cache {}: checkpoint {}, config {}'
+          .format(result_cache.dir, result_cache.checkpoint_key[:8], result_cache.config_key[:8]))
+
+def result_key(sub_index, case):
+    """The result cache key of the pred/adv image of a val/test sample"""
+    image, label = (pred_feeder if case == 'pred' else adv_feeder).test_indices(sub_index)
+    return result_cache.key(image, label)
+
+# A durable ledger of the (sub_index, case) work items, so a restarted run resumes exactly where it stopped
+ledger = None
+if FLAGS.influence_params == 'all':
+    ledger_name = FLAGS.attack if SCORES_NAME == 'all' else FLAGS.attack + '_' + SCORES_NAME
+    ledger = WorkLedger(os.path.join(workspace_dir, 'score_ledger_{}{}.sqlite'.format(ledger_name, SHARD_SUFFIX)),
+                        max_attempts=FLAGS.max_attempts)
+    ledger.register([(sub_index, case) for sub_index in sub_relevant_indices for case in ['pred', 'adv']])
+
+    def is_complete(sub_index, case):
+        if result_cache is not None and not result_cache.contains(result_key(sub_index, case)):
+            return False  # the scores on disk (if any) were not calculated for this checkpoint, image and config
+        if score_stores is not None:
+            return score_stores[case].is_done(sub_index)
+        return scores_complete(scores_dir(model_dir, FLAGS.set, info[FLAGS.set][sub_index]['global_index'], case,
+                                          FLAGS.attack), SCORES_NAME)
+    ledger.reconcile(is_complete)
+    print('work ledger {}: {}'.format(ledger.path, ledger.summary()))
+
+sub_index_to_i = {sub_index: i for i, sub_index in enumerate(sub_relevant_indices)}
+
+def score_item(thread_id, sub_index, case):
+    i = sub_index_to_i[sub_index]
+    if test_val_set:
+        global_index = feeder.val_inds[sub_index]
+    else:
+        global_index = feeder.test_inds[sub_index]
+    assert global_index == relevant_indices[i]
+
+    _, real_label = feeder.test_indices(sub_index)
+    real_label = np.argmax(real_label)
 
-                if os.path.isfile(os.path.join(dir, 'scores.npy')):
-                    print('scores already exists in {}'.format(os.path.join(dir, 'scores.npy')))
-                else:
-                    start_time = time.time()
-                    scores = insp.upweighting_influence_batch(
-                        sess=sess,
-                        test_indices=[sub_index],
-                        test_batch_size=testset_batch_size,
-                        approx_params=approx_params,
-                        train_batch_size=train_batch_size,
-                        train_iterations=train_iterations)
-                    print('scores calculation time: {} secs. thread_id: {}, global_index: {} (sub: {}), case: {}'
-                          .format(time.time()-start_time, thread_id, global_index, sub_index, case))
-                    np.save(os.path.join(dir, 'scores.npy'), scores)
-
-                print('saving image to {}'.format(os.path.join(dir, 'image.npy/png')))
-                image, _ = feed.test_indices(sub_index)
-                imageio.imwrite(os.path.join(dir, 'image.png'), image)
-                np.save(os.path.join(dir, 'image.npy'), image)
-        except Exception as e:
-            print('Error with influence collect function for i={}: {}'.format(i, e))
-            exit(1)
-            raise AssertionError('Error with influence collect function for i={}!'.format(i))
-
-        # signal to the queue that task has been processed
-        q.task_done()
+    if test_val_set:
+        pred_label = x_val_preds[sub_index]
+    else:
+        pred_label = x_test_preds[sub_index]
+
+    _, adv_label = adv_feeder.test_indices(sub_index)
+    adv_label = np.argmax(adv_label)
+
+    if info[FLAGS.set][sub_index]['attack_succ']:
+        assert pred_label != adv_label, 'failed for i={}, sub_index={}, global_index={}'.format(i, sub_index, global_index)
+    if info[FLAGS.set][sub_index]['net_succ']:
+        assert pred_label == real_label, 'failed for i={}, sub_index={}, global_index={}'.format(i, sub_index, global_index)
+    progress_str = 'thread_id: {}. sample {}/{}: calculating {} scores for {} index {} (sub={}).\n' \
+                   'real label: {}, adv label: {}, pred label: {}. net_succ={}, attack_succ={}' \
+        .format(thread_id, i + 1, len(sub_relevant_indices), case, FLAGS.set, global_index, sub_index, _classes[real_label],
+                _classes[adv_label], _classes[pred_label], info[FLAGS.set][sub_index]['net_succ'], info[FLAGS.set][sub_index]['attack_succ'])
+    logging.info(progress_str)
+    print(progress_str)
+
+    if case == 'pred':
+        insp = inspector_pred_list[thread_id]
+        feed = pred_feeder
+    elif case == 'adv':
+        insp = inspector_adv_list[thread_id]
+        feed = adv_feeder
+
+    key    = None
+    scores = None
+    if result_cache is not None:
+        key    = result_key(sub_index, case)
+        scores = result_cache.get(key)
+        if scores is not None:
+            print('scores of global_index: {} (sub: {}), case: {} are served from the result cache'
+                  .format(global_index, sub_index, case))
+    if scores is None:
+        start_time = time.time()
+        if train_grad_cache is not None:
+            scores = insp.upweighting_influence_cached(
+                sess=sess,
+                test_indices=[sub_index],
+                test_batch_size=testset_batch_size,
+                approx_params=approx_params,
+                train_grad_cache=train_grad_cache)
+        elif per_example_scorer is not None:
+            scores = insp.upweighting_influence_vectorized(
+                sess=sess,
+                test_indices=[sub_index],
+                test_batch_size=testset_batch_size,
+                approx_params=approx_params,
+                scorer=per_example_scorer,
+                train_iterations=train_iterations)
+        else:
+            scores = insp.upweighting_influence_batch(
+                sess=sess,
+                test_indices=[sub_index],
+                test_batch_size=testset_batch_size,
+                approx_params=approx_params,
+                train_batch_size=train_batch_size,
+                train_iterations=train_iterations)
+        print('scores calculation time: {} secs. thread_id: {}, global_index: {} (sub: {}), case: {}'
+              .format(time.time()-start_time, thread_id, global_index, sub_index, case))
+        if result_cache is not None:
+            result_cache.put(key, scores)
+
+    if score_stores is not None:
+        score_stores[case].write(sub_index, scores)
+    else:
+        # creating the relevant index folders (unless the scores are written to the score store)
+        dir = scores_dir(model_dir, FLAGS.set, global_index, case, FLAGS.attack)
+        if not os.path.exists(dir):
+            os.makedirs(dir)
+        print('saving image to {}'.format(os.path.join(dir, 'image.npy/png')))
+        image, _ = feed.test_indices(sub_index)
+        save_image(dir, image)  # before the scores, which mark the sample as complete
+        save_scores(dir, scores, SCORES_NAME, FLAGS.scores_top_k)
+
+def run_item(thread_id, sub_index, case):
+    """Scoring a claimed item and recording the outcome in the ledger"""
+    try:
+        score_item(thread_id, sub_index, case)
+        ledger.done(sub_index, case)
+    except Exception as e:
+        logging.exception('Error with influence collect function for sub_index={}, case: {}'.format(sub_index, case))
+        print('Error with influence collect function for sub_index={}, case: {}: {}'.format(sub_index, case, e))
+        ledger.fail(sub_index, case, str(e))
+
+def collect_influence(thread_id):
+    owner = owner_name(thread_id)
+    while True:
+        item = ledger.claim(owner)
+        if item is None:
+            break
+        sub_index, case = item
+        run_item(thread_id, sub_index, case)
     return True
 
-print('Start setting up the queue...')
-# set up a queue to hold all the jobs:
-q = Queue(maxsize=0)
-for i in range(len(sub_relevant_indices)):
-    q.put((i,))
+def produce_ihvps(producer_id, todo, ready_queue):
+    """STAGE A of --pipeline: calculating the HVP matrices of the samples and queueing the ready ones"""
+    ihvp_log_file = os.path.join(workspace_dir, 'ihvp_solver_log.jsonl')  # per-sample iterations and timings
+    while True:
+        try:
+            sub_index = todo.popleft()
+        except IndexError:
+            break
+        start_time = time.time()
+        for case, insp in [('pred', hvp_inspector_pred_list[producer_id]), ('adv', hvp_inspector_adv_list[producer_id])]:
+            if result_cache is not None and result_cache.contains(result_key(sub_index, case)):
+                continue  # served from the result cache, no HVP matrix is needed
+            try:
+                insp._prepare(
+                    sess=sess,
+                    test_indices=[sub_index],
+                    test_batch_size=testset_batch_size,
+                    approx_params=approx_params,
+                    force_refresh=False  # Maybe there is already a prior calculation. If so, load its numpy
+                )
+            except Exception as e:
+                # the scoring thread calculates the missing HVP matrix itself
+                print('Error with influence _prepare for sub_index={}, case: {}: {}'.format(sub_index, case, e))
+                continue
+            if insp.last_solve_stats is not None:
+                append_solver_log(ihvp_log_file, dict(insp.last_solve_stats, set=FLAGS.set, case=case,
+                                                      sub_index=int(sub_index),
+                                                      global_index=int(info[FLAGS.set][sub_index]['global_index'])))
+        print('ihvp calculation time: {} secs. producer: {}, sub_index: {}. {} samples are waiting to be scored'
+              .format(time.time() - start_time, producer_id, sub_index, ready_queue.qsize()))
+        ready_queue.put(sub_index)  # blocks while the scoring threads are behind
+    return True
 
-for thread_id in range(FLAGS.num_threads):
-    print('Starting thread {}'.format(thread_id))
-    worker = Thread(target=collect_influence, args=(q, thread_id))
-    worker.setDaemon(True)
-    worker.start()
+def consume_ihvps(thread_id, ready_queue):
+    """STAGE B of --pipeline: scoring the samples whose HVP matrices are ready"""
+    owner = owner_name(thread_id)
+    while True:
+        sub_index = ready_queue.get()
+        if sub_index is None:
+            break
+        for case in ['pred', 'adv']:
+            if ledger.claim_item(sub_index, case, owner):
+                run_item(thread_id, sub_index, case)
+    return True
 
-q.join()
-print('All tasks completed.')
+def run_pipeline():
+    """
+    Running STAGE A and STAGE B concurrently: FLAGS.num_hvp_threads threads calculate the HVP matrices and pass the
+    ready samples through a bounded queue to FLAGS.num_threads scoring threads
+    """
+    todo = deque([sub_index for sub_index in sub_relevant_indices
+                  if any(ledger.state(sub_index, case) != DONE for case in ['pred', 'adv'])])
+    print('Start the pipeline for {} samples...'.format(len(todo)))
+    ready_queue = Queue(maxsize=FLAGS.pipeline_queue_size)
+    producers = [Thread(target=produce_ihvps, args=(producer_id, todo, ready_queue))
+                 for producer_id in range(FLAGS.num_hvp_threads)]
+    consumers = [Thread(target=consume_ihvps, args=(thread_id, ready_queue)) for thread_id in range(FLAGS.num_threads)]
+    for worker in producers + consumers:
+        worker.setDaemon(True)
+        worker.start()
+    for worker in producers:
+        worker.join()
+    for _ in consumers:
+        ready_queue.put(None)
+    for worker in consumers:
+        worker.join()
+
+def report_ledger():
+    failures = ledger.failures()
+    for sub_index, case, attempts, error in failures:
+        print('sub_index={}, case: {} failed after {} attempts: {}'.format(sub_index, case, attempts, error))
+    summary = ledger.summary()
+    print('work ledger {}: {}'.format(ledger.path, summary))
+    if len(failures) > 0:
+        raise AssertionError('{} items failed. Run again to retry the items with attempts left (--max_attempts)'
+                             .format(len(failures)))
+    # e.g. all the workers died before claiming anything: nothing failed, but nothing was scored either
+    unfinished = summary[PENDING] + summary[CLAIMED]
+    if unfinished > 0:
+        raise AssertionError('{} items were not scored. Run again to score them'.format(unfinished))
+    print('All tasks completed.')
+
+if FLAGS.influence_params == 'last_layer':
+    # exact scores w.r.t. the fc layer only, all the val/test samples in one vectorized pass
+    fc_weights, fc_bias = get_fc_params(sess, model)
+    last_layer_insp = LastLayerInfluence(fc_weights, fc_bias, LABEL_SMOOTHING[FLAGS.dataset], weight_decay,
+                                         damping=lissa_damping(approx_params))
+    scores_block_size = 500  # number of val/test samples scored at a time, bounds the [block, #train] scores matrix
+    for case, case_feeder, case_features, workspace in [
+            ('pred', pred_feeder, features    , os.path.join(workspace_dir, 'pred')),
+            ('adv' , adv_feeder , features_adv, os.path.join(workspace_dir, 'adv', FLAGS.attack))]:
+        _, case_labels = case_feeder.test_indices(range(case_feeder.get_test_size()))
+        inverse_hvps = last_layer_insp.load_or_calc_inverse_hvps(workspace, x_train_features, case_features, case_labels)
+        start_time = time.time()
+        for start in tqdm(range(0, len(sub_relevant_indices), scores_block_size)):
+            block = range(start, min(start + scores_block_size, len(sub_relevant_indices)))
+            scores = last_layer_insp.scores(x_train_features, y_train,
+                                            inverse_hvps[[sub_relevant_indices[i] for i in block]])
+            for k, i in enumerate(block):
+                if score_stores is not None:
+                    score_stores[case].write(sub_relevant_indices[i], scores[k])
+                    continue
+                dir = scores_dir(model_dir, FLAGS.set, relevant_indices[i], case, FLAGS.attack)
+                if not os.path.exists(dir):
+                    os.makedirs(dir)
+                save_scores(dir, scores[k], FLAGS.influence_params, FLAGS.scores_top_k)
+        print('last layer scores calculation time: {} secs for {} samples, case: {}'
+              .format(time.time() - start_time, len(sub_relevant_indices), case))
+    print('All tasks completed.')
+elif FLAGS.influence_params != 'all':
+    raise AssertionError('influence_params {} is not supported'.format(FLAGS.influence_params))
+elif FLAGS.num_processes > 0:
+    print('Start setting up the worker processes...')
+    # private to this run: other runs on the same checkpoint (set, attack, shard) have their own arrays mapped
+    if not os.path.exists(workspace_dir):
+        os.makedirs(workspace_dir)
+    shared_dir = tempfile.mkdtemp(prefix='shared_arrays_{}_{}{}_'.format(FLAGS.set, FLAGS.attack, SHARD_SUFFIX),
+                                  dir=workspace_dir)
+    X_pred, y_pred = pred_feeder.test_indices(range(pred_feeder.get_test_size()))
+    X_adv , y_adv  = adv_feeder.test_indices(range(adv_feeder.get_test_size()))
+    save_shared_arrays(shared_dir, {'X_train': X_train, 'y_train': y_train,
+                                    'X_pred' : X_pred , 'y_pred' : y_pred,
+                                    'X_adv'  : X_adv  , 'y_adv'  : y_adv})
+    spec = {
+        'shared_dir': shared_dir,
+        'seed': superseed,
+        'arch_name': ARCH_NAME[FLAGS.dataset],
+        'label_smoothing': LABEL_SMOOTHING[FLAGS.dataset],
+        'weight_decay': weight_decay,
+        'checkpoint_path': checkpoint_path,
+        'workspaces': {'pred': os.path.join(workspace_dir, 'pred'),
+                       'adv' : os.path.join(workspace_dir, 'adv', FLAGS.attack)},
+        'model_dir': model_dir,
+        'set': FLAGS.set,
+        'attack': FLAGS.attack,
+        'testset_batch_size': testset_batch_size,
+        'train_batch_size': train_batch_size,
+        'train_iterations': train_iterations,
+        'per_example_grads': FLAGS.per_example_grads,
+        'approx_params': approx_params,
+        'global_indices': {sub_index: info[FLAGS.set][sub_index]['global_index'] for sub_index in sub_relevant_indices},
+        'ledger': {'path': ledger.path, 'max_attempts': ledger.max_attempts},
+        'scores_top_k': FLAGS.scores_top_k,
+        'scores_name': SCORES_NAME,
+        'ihvp_store_dtype': FLAGS.ihvp_store or None,
+        'result_cache': None if result_cache is None else
+                        {'dir': result_cache.dir, 'checkpoint_key': result_cache.checkpoint_key,
+                         'config_key': result_cache.config_key},
+        'influence_scope': parse_scope(FLAGS.influence_scope),
+        'score_store': None if score_stores is None else {case: score_stores[case].dir for case in score_stores},
+        'train_grad_cache': None if train_grad_cache is None else
+                            {'path': train_grad_cache.path, 'num_train': train_grad_cache.num_train,
+                             'num_params': train_grad_cache.num_params, 'dtype': train_grad_cache.dtype,
+                             'sketch_dim': train_grad_cache.sketch_dim},
+        'ihvp_solver': {'name': FLAGS.ihvp_solver, 'approx_params': approx_params, 'max_iters': FLAGS.ihvp_max_iters,
+                        'tol': FLAGS.ihvp_tol, 'top_k': FLAGS.arnoldi_top_k, 'num_batches': FLAGS.hvp_num_batches,
+                        'cache_dir': os.path.join(model_dir, 'ihvp_' + FLAGS.ihvp_solver), 'lissa_tol': FLAGS.lissa_tol,
+                        'lissa_repeats_tol': FLAGS.lissa_repeats_tol, 'lissa_min_repeats': FLAGS.lissa_min_repeats}
+    }
+    try:
+        worker_pool.run(spec)
+    finally:
+        shutil.rmtree(shared_dir, ignore_errors=True)
+    report_ledger()
+else:
+    if FLAGS.pipeline:
+        run_pipeline()  # the threads below only retry the items that failed in the pipeline
+    workers = []
+    for thread_id in range(FLAGS.num_threads):
+        print('Starting thread {}'.format(thread_id))
+        worker = Thread(target=collect_influence, args=(thread_id,))
+        worker.setDaemon(True)
+        worker.start()
+        workers.append(worker)
+
+    for worker in workers:
+        worker.join()
+    report_ledger()
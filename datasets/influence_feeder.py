@@ -193,3 +193,47 @@ class MyFeederValTest(darkon.InfluenceFeeder):
             else:
                 setattr(result, k, v)
         return result
+
+
+class MyFeederSharedArrays(darkon.InfluenceFeeder):
+    def __init__(self, train_data, train_label, test_data, test_label):
+        """
+        A lightweight feeder over existing arrays (e.g. read-only np.memmap arrays shared by several processes).
+        It serves batches exactly as MyFeederValTest does, without loading or copying the dataset.
+        :param train_data: training images. Only the training samples used for the influence (49k or 5k mini)
+        :param train_label: training labels, as fed to the loss (one hot)
+        :param test_data: val/test images
+        :param test_label: val/test labels, as fed to the loss (one hot)
+        """
+        self.train_data  = train_data
+        self.train_label = train_label
+        self.test_data   = test_data
+        self.test_label  = test_label
+
+        self.train_batch_offset = 0
+
+    def train_indices(self, indices):
+        return self.train_data[indices], self.train_label[indices]
+
+    def test_indices(self, indices):
+        return self.test_data[indices], self.test_label[indices]
+
+    def train_batch(self, batch_size):
+        # calculate offset
+        start = self.train_batch_offset
+        end = start + batch_size
+        self.train_batch_offset += batch_size
+
+        return self.train_data[start:end, ...], self.train_label[start:end, ...]
+
+    def train_one(self, idx):
+        return self.train_data[idx, ...], self.train_label[idx, ...]
+
+    def reset(self):
+        self.train_batch_offset = 0
+
+    def get_train_size(self):
+        return len(self.train_data)
+
+    def get_test_size(self):
+        return len(self.test_data)
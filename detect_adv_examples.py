@@ -15,6 +15,7 @@ from sklearn.preprocessing import MinMaxScaler
 from sklearn.metrics import accuracy_score, precision_score, recall_score
 from sklearn.decomposition import PCA
 from NNIF_adv_defense.tools.utils import train_lr, compute_roc
+from NNIF_adv_defense.influence.param_scope import parse_scope, scope_scores_name
 
 from tensorflow.python.platform import flags
 
@@ -37,6 +38,9 @@ flags.DEFINE_float('magnitude', 0.002, 'magnitude for mahalanobis detection')
 # FOR NNIF
 flags.DEFINE_integer('max_indices', 200, 'maximum number of helpful indices to use in NNIF detection')
 flags.DEFINE_string('ablation', '1111', 'for ablation test')
+flags.DEFINE_string('influence_params', 'all', 'parameters of the influence scores: all or last_layer')
+flags.DEFINE_string('influence_scope', '', 'the --influence_scope of the scores (comma separated variable scopes). '
+                                            'Empty for all the parameters')
 
 flags.DEFINE_string('mode', 'null', 'to bypass pycharm bug')
 flags.DEFINE_string('port', 'null', 'to bypass pycharm bug')
@@ -92,6 +96,11 @@ if FLAGS.only_last:
     train_characteristics_file = train_characteristics_file + '_only_last'
     test_characteristics_file  = test_characteristics_file  + '_only_last'
 
+SCORES_NAME = scope_scores_name(FLAGS.influence_params, parse_scope(FLAGS.influence_scope))
+if FLAGS.characteristics == 'nnif' and SCORES_NAME != 'all':
+    train_characteristics_file = train_characteristics_file + '_' + SCORES_NAME
+    test_characteristics_file  = test_characteristics_file  + '_' + SCORES_NAME
+
 train_characteristics_file = train_characteristics_file + '.npy'
 test_characteristics_file  = test_characteristics_file  + '.npy'
 
@@ -19,8 +19,13 @@ from tensorflow.python.platform import flags
 from NNIF_adv_defense.models.darkon_resnet34_model import DarkonReplica
 from NNIF_adv_defense.datasets.influence_feeder import MyFeederValTest
 from NNIF_adv_defense.tools.utils import mle_batch
+from NNIF_adv_defense.influence.score_files import load_helpful_harmful, helpful_harmful
+from NNIF_adv_defense.influence.score_store import ScoreStore, store_dir
+from NNIF_adv_defense.influence.param_scope import parse_scope, scope_scores_name
+from NNIF_adv_defense.influence.rank_lookup import RankLookup
+from NNIF_adv_defense.influence.feature_store import FeatureStore, FEATURE_STORE_DIR
+from NNIF_adv_defense.influence.train_grad_cache import checkpoint_key
 import sklearn.covariance
-from sklearn.neighbors import NearestNeighbors
 from sklearn.neighbors import KNeighborsClassifier
 from cleverhans.evaluation import batch_eval
 from cleverhans.utils import set_log_level
@@ -39,14 +44,6 @@ STDEVS = {
 }
 
 
-num_of_spatial_activations = {
-    'layer0': 32 * 32, 'layer1': 32 * 32, 'layer2': 32 * 32, 'layer3': 32 * 32, 'layer4': 32 * 32, 'layer5': 32 * 32,
-    'layer6': 32 * 32, 'layer7': 32 * 32, 'layer8': 32 * 32, 'layer9': 32 * 32, 'layer10': 32 * 32, 'layer11': 16 * 16,
-    'layer12': 16 * 16, 'layer13': 16 * 16, 'layer14': 16 * 16, 'layer15': 16 * 16, 'layer16': 16 * 16, 'layer17': 16 * 16,
-    'layer18': 16 * 16, 'layer19': 16 * 16, 'layer20': 16 * 16, 'layer21': 8 * 8, 'layer22': 8 * 8, 'layer23': 8 * 8,
-    'layer24': 8 * 8, 'layer25': 8 * 8, 'layer26': 8 * 8, 'layer27': 8 * 8, 'layer28': 8 * 8, 'layer29': 8 * 8, 'layer30': 8 * 8
-}
-
 FLAGS = flags.FLAGS
 flags.DEFINE_integer('batch_size', 125, 'Size of training batches')
 flags.DEFINE_string('dataset', 'cifar10', 'dataset: cifar10/100 or svhn')
@@ -65,6 +62,9 @@ flags.DEFINE_float('magnitude', -1, 'magnitude for mahalanobis detection')
 # FOR NNIF
 flags.DEFINE_integer('max_indices', -1, 'maximum number of helpful indices to use in NNIF detection')
 flags.DEFINE_string('ablation', '1111', 'for ablation test')
+flags.DEFINE_string('influence_params', 'all', 'parameters of the influence scores: all or last_layer')
+flags.DEFINE_string('influence_scope', '', 'the --influence_scope of the scores (comma separated variable scopes). '
+                                            'Empty for all the parameters')
 
 #TODO: remove when done debugging
 flags.DEFINE_string('mode', 'null', 'to bypass pycharm bug')
@@ -83,6 +83,7 @@ else:
     USE_TRAIN_MINI = True
 
 TARGETED = FLAGS.attack != 'deepfool'  # we use targeted attacks everywhere except deepfool
+SCORES_NAME = scope_scores_name(FLAGS.influence_params, parse_scope(FLAGS.influence_scope))  # the scores files/stores
 
 _classes = {
     'cifar10': (
@@ -233,6 +234,7 @@ embeddings = model.get_embeddings(x)
 saver = tf.train.Saver()
 checkpoint_path = os.path.join(model_dir, 'best_model.ckpt')
 saver.restore(sess, checkpoint_path)
+CHECKPOINT_KEY = checkpoint_key(sess, tf.trainable_variables())  # the feature stores are kept per checkpoint
 
 # get noisy images
 def get_noisy_samples(X, std):
@@ -336,6 +338,7 @@ print("X_test_adv: "  , X_test_adv.shape)
 if FLAGS.only_last:
     print('Keeping only the embedding layer in model.net')
     model.net = {'layer31': model.net['layer31']}
+    model.pooled_net = {'layer31': model.pooled_net['layer31']}
     assert embeddings is model.net['layer31']
 
 def merge_and_generate_labels(X_pos, X_neg):
@@ -470,7 +473,7 @@ def get_mahalanobis(X, X_noisy, X_adv, magnitude, sample_mean, precision, set):
 
     return characteristics, labels
 
-def sample_estimator(num_classes, X, Y):
+def sample_estimator(num_classes, X, Y, split='train'):
     num_output           = len(model.net)
     feature_list         = np.zeros(num_output, dtype=np.int32)   # indicates the number of features in every layer
     num_sample_per_class = np.zeros(num_classes)  # how many samples are per class
@@ -486,15 +489,7 @@ def sample_estimator(num_classes, X, Y):
             temp_list.append([])
         list_features.append(temp_list)
 
-    out_features = batch_eval(sess, [x], model.net.values(), [X], FLAGS.batch_size)
-    for i in range(num_output):
-        if len(out_features[i].shape) == 4:
-            out_features[i] = np.asarray(out_features[i], dtype=np.float32).reshape((X.shape[0], -1, out_features[i].shape[-1]))
-            out_features[i] = np.mean(out_features[i], axis=1)
-        elif len(out_features[i].shape) == 2:
-            pass  # leave as is
-        else:
-            raise AssertionError('Expecting size of 2 or 4 but got {} for i={}'.format(len(out_features[i].shape), i))
+    out_features = calc_all_layer_features(X, split)
 
     for i in range(X.shape[0]):
         label = Y[i]
@@ -578,15 +573,7 @@ def get_mahanabolis_tensors(sample_mean, precision, num_classes, layer):
             precision_mat      = tf.convert_to_tensor(precision[layer_index]    , dtype=tf.float32)
             sample_mean_tensor = tf.convert_to_tensor(sample_mean[layer_index]  , dtype=tf.float32)
 
-        out_features       = model.net[layer]
-        if len(out_features.shape) == 4:
-            num_spatial = num_of_spatial_activations[layer]
-            out_features = tf.reshape(out_features, [-1, num_spatial, out_features.shape[-1].value])
-            out_features = tf.reduce_mean(out_features, axis=1)
-        elif len(out_features.shape) == 2:
-            pass  # leave as is
-        else:
-            raise AssertionError('Expecting size of 2 or 4 but got {} for {}'.format(len(out_features.shape), layer))
+        out_features       = model.pooled_net[layer]
 
         for i in range(num_classes):
             batch_sample_mean = sample_mean_tensor[i]
@@ -612,35 +599,42 @@ def get_mahanabolis_tensors(sample_mean, precision, num_classes, layer):
 
     return gaussian_score, grads
 
-def find_ranks(sub_index, sorted_influence_indices, adversarial=False):
-
+def find_ranks(sub_index, sorted_influence_indices_list, max_indices_vec, adversarial=False):
+    """
+    The mean rank and distance of training indices lists (e.g. [helpful, harmful]) at every layer, for every
+    max_indices: the mean over the first max_indices entries of the list. The rank table of every layer is calculated
+    once per sample, and every list is a single lookup in it. Returns a list of [num_output, len(max_indices_vec)]
+    (ranks_mean, dists_mean) pairs
+    """
     if adversarial:
-        ni = all_adv_ranks
-        nd = all_adv_dists
+        features = all_adv_features
     else:
-        ni = all_normal_ranks
-        nd = all_normal_dists
+        features = all_normal_features
 
     num_output = len(model.net)
-    ranks = -1 * np.ones((num_output, len(sorted_influence_indices)), dtype=np.int32)
-    dists = -1 * np.ones((num_output, len(sorted_influence_indices)), dtype=np.float32)
+    ranks = [-1 * np.ones((num_output, len(indices)), dtype=np.int32) for indices in sorted_influence_indices_list]
+    dists = [-1 * np.ones((num_output, len(indices)), dtype=np.float32) for indices in sorted_influence_indices_list]
 
     print('Finding ranks for sub_index={} (adversarial={})'.format(sub_index, adversarial))
-    for target_idx in range(len(sorted_influence_indices)):  # for only some indices (say, 0:50 only)
-        idx = sorted_influence_indices[target_idx]  # selecting training sample index
-        for layer_index in range(num_output):
-            loc_in_knn = np.where(ni[sub_index, layer_index] == idx)[0][0]
-            knn_dist   = nd[sub_index, layer_index, loc_in_knn]
-            ranks[layer_index, target_idx] = loc_in_knn
-            dists[layer_index, target_idx] = knn_dist
+    for layer_index, layer in enumerate(model.net.keys()):
+        layer_dists, layer_ranks = knn_layers[layer].rank_table(features[layer_index][sub_index])
+        for k, indices in enumerate(sorted_influence_indices_list):
+            ranks[k][layer_index] = layer_ranks[indices]
+            dists[k][layer_index] = layer_dists[indices]
 
-    ranks_mean = np.mean(ranks, axis=1)
-    dists_mean = np.mean(dists, axis=1)
+    # the lists are sorted from the most helpful/harmful, so every max_indices is the mean of a prefix
+    max_indices_vec = np.asarray(max_indices_vec)
+    def prefix_means(values):
+        return np.cumsum(values, axis=1, dtype=np.float64)[:, max_indices_vec - 1] / max_indices_vec
 
-    return ranks_mean, dists_mean
+    return [(prefix_means(ranks[k]), prefix_means(dists[k])) for k in range(len(sorted_influence_indices_list))]
 
-def get_nnif(X, subset, max_indices):
-    """Returns the knn rank of every testing sample"""
+def get_nnif(X, subset, max_indices_vec):
+    """
+    Returns the knn rank of every testing sample, for every max_indices of max_indices_vec: ranks and ranks_adv of
+    shape [len(max_indices_vec), len(X), num_output, 4]. The ranks of the largest max_indices are looked up once, and
+    the smaller max_indices are derived from them
+    """
     if subset == 'val':
         inds_correct = val_inds_correct
         y_sparse     = y_val_sparse
@@ -651,13 +645,19 @@ def get_nnif(X, subset, max_indices):
         y_sparse     = y_test_sparse
         x_preds      = x_test_preds
         x_preds_adv  = x_test_preds_adv
+    sub_inds_correct = inds_correct
     inds_correct = feeder.get_global_index(subset, inds_correct)
+    max_indices = max(max_indices_vec)
+
+    # use the consolidated score stores if calc_scores.py wrote them (--score_store)
+    pred_store = ScoreStore(store_dir(model_dir, subset, 'pred', FLAGS.attack, SCORES_NAME))
+    adv_store  = ScoreStore(store_dir(model_dir, subset, 'adv' , FLAGS.attack, SCORES_NAME))
 
     # initialize knn for layers
     num_output = len(model.net)
 
-    ranks     = -1 * np.ones((len(X), num_output, 4))
-    ranks_adv = -1 * np.ones((len(X), num_output, 4))
+    ranks     = -1 * np.ones((len(max_indices_vec), len(X), num_output, 4))
+    ranks_adv = -1 * np.ones((len(max_indices_vec), len(X), num_output, 4))
 
     for i in tqdm(range(len(inds_correct))):
         global_index = inds_correct[i]
@@ -668,16 +668,25 @@ def get_nnif(X, subset, max_indices):
         index_dir = os.path.join(model_dir, subset, '{}_index_{}'.format(subset, global_index))
 
         # collect pred scores:
-        scores = np.load(os.path.join(index_dir, 'real', 'scores.npy'))
-        sorted_indices = np.argsort(scores)
-        ranks[i, :, 0], ranks[i, :, 1] = find_ranks(i, sorted_indices[-max_indices:][::-1], adversarial=False)
-        ranks[i, :, 2], ranks[i, :, 3] = find_ranks(i, sorted_indices[:max_indices], adversarial=False)
+        if pred_store.exists() and pred_store.is_done(sub_inds_correct[i]):
+            helpful, harmful = helpful_harmful(pred_store.row(sub_inds_correct[i]), max_indices)
+        else:
+            helpful, harmful = load_helpful_harmful(os.path.join(index_dir, 'real'), max_indices, SCORES_NAME)
+        (helpful_ranks, helpful_dists), (harmful_ranks, harmful_dists) = \
+            find_ranks(i, [helpful, harmful], max_indices_vec, adversarial=False)
+        ranks[:, i, :, 0], ranks[:, i, :, 1] = helpful_ranks.T, helpful_dists.T
+        ranks[:, i, :, 2], ranks[:, i, :, 3] = harmful_ranks.T, harmful_dists.T
 
         # collect adv scores:
-        scores = np.load(os.path.join(index_dir, 'adv', FLAGS.attack, 'scores.npy'))
-        sorted_indices = np.argsort(scores)
-        ranks_adv[i, :, 0], ranks_adv[i, :, 1] = find_ranks(i, sorted_indices[-max_indices:][::-1], adversarial=True)
-        ranks_adv[i, :, 2], ranks_adv[i, :, 3] = find_ranks(i, sorted_indices[:max_indices], adversarial=True)
+        if adv_store.exists() and adv_store.is_done(sub_inds_correct[i]):
+            helpful, harmful = helpful_harmful(adv_store.row(sub_inds_correct[i]), max_indices)
+        else:
+            helpful, harmful = load_helpful_harmful(os.path.join(index_dir, 'adv', FLAGS.attack), max_indices,
+                                                    SCORES_NAME)
+        (helpful_ranks, helpful_dists), (harmful_ranks, harmful_dists) = \
+            find_ranks(i, [helpful, harmful], max_indices_vec, adversarial=True)
+        ranks_adv[:, i, :, 0], ranks_adv[:, i, :, 1] = helpful_ranks.T, helpful_dists.T
+        ranks_adv[:, i, :, 2], ranks_adv[:, i, :, 3] = harmful_ranks.T, harmful_dists.T
 
     print("{} ranks_normal: ".format(subset), ranks.shape)
     print("{} ranks_adv: ".format(subset), ranks_adv.shape)
@@ -720,48 +729,29 @@ def get_dknn_nonconformity(features, calibration_vec, k):
 
     return empirical_p
 
-def get_knn_layers(X, y):
+def get_knn_layers(X, split):
     knn = {}
 
-    train_features = batch_eval(sess, [x], model.net.values(), [X], FLAGS.batch_size)
-    print('Fitting knn models on all layers: {}'.format(model.net.keys()))
+    train_features = calc_all_layer_features(X, split)
+    print('Setting the rank lookups of all layers: {}'.format(model.net.keys()))
     for layer_index, layer in enumerate(model.net.keys()):
-        if len(train_features[layer_index].shape) == 4:
-            train_features[layer_index] = np.asarray(train_features[layer_index], dtype=np.float32).reshape((X.shape[0], -1, train_features[layer_index].shape[-1]))
-            train_features[layer_index] = np.mean(train_features[layer_index], axis=1)
-        elif len(train_features[layer_index].shape) == 2:
-            pass  # leave as is
-        else:
-            raise AssertionError('Expecting size of 2 or 4 but got {} for {}'.format(len(train_features[layer_index].shape), layer))
+        # the ranks of the helpful/harmful training samples are looked up per query, see influence/rank_lookup.py
+        knn[layer] = RankLookup(train_features[layer_index])
 
-        knn[layer] = NearestNeighbors(n_neighbors=X.shape[0], p=2, n_jobs=20, algorithm='brute')
-        knn[layer].fit(train_features[layer_index], y)
-
-    del train_features
     return knn
 
-def calc_all_ranks_and_dists(X, subset, knn):
-    num_output = len(model.net.keys())
-    n_neighbors = knn[knn.keys()[0]].n_neighbors
-    all_neighbor_ranks = -1 * np.ones((len(X), num_output, n_neighbors), dtype=np.int32)
-    all_neighbor_dists = -1 * np.ones((len(X), num_output, n_neighbors), dtype=np.float32)
-
-    features = batch_eval(sess, [x], model.net.values(), [X], FLAGS.batch_size)
-    for layer_index, layer in enumerate(model.net.keys()):
-        print('Calculating ranks and distances for subset {} for layer {}'.format(subset, layer))
-        if len(features[layer_index].shape) == 4:
-            features[layer_index] = np.asarray(features[layer_index], dtype=np.float32).reshape((X.shape[0], -1, features[layer_index].shape[-1]))
-            features[layer_index] = np.mean(features[layer_index], axis=1)
-        elif len(features[layer_index].shape) == 2:
-            pass  # leave as is
-        else:
-            raise AssertionError('Expecting size of 2 or 4 but got {} for {}'.format(len(features[layer_index].shape), layer))
-
-        all_neighbor_dists[:, layer_index], all_neighbor_ranks[:, layer_index] = \
-            knn[layer].kneighbors(features[layer_index], return_distance=True)
-
-    del features
-    return all_neighbor_ranks, all_neighbor_dists
+def calc_all_layer_features(X, subset, adversarial=False):
+    """
+    The (spatially pooled) features of X at all the layers, queried by find_ranks(). They are calculated once per
+    checkpoint into the feature store of the subset (see influence/feature_store.py) and read lazily from it
+    :param X: the images of the subset
+    :param subset: the name of the subset: train, train_mini, val or test
+    :param adversarial: whether X are the adversarial images of the subset (stored under the attack dir)
+    :return: list of [#samples, #channels] read-only memory maps, in the order of model.net
+    """
+    dir = os.path.join(attack_dir if adversarial else model_dir, FEATURE_STORE_DIR, subset)
+    store = FeatureStore(dir).build(sess, x, model.pooled_net, X, FLAGS.batch_size, CHECKPOINT_KEY)
+    return [store.layer(layer) for layer in model.net.keys()]
 
 def append_suffix(f):
     # if with_noisy:
@@ -770,6 +760,8 @@ def append_suffix(f):
         f = f + '_noisy'
     if FLAGS.only_last:
         f = f + '_only_last'
+    if FLAGS.characteristics == 'nnif' and SCORES_NAME != 'all':
+        f = f + '_' + SCORES_NAME
     f = f + '.npy'
     return f
 
@@ -821,19 +813,22 @@ if FLAGS.characteristics == 'nnif':
     else:
         max_indices_vec = [FLAGS.max_indices]
 
-    for max_indices in tqdm(max_indices_vec):
-        print('Extracting NNIF characteristics for max_indices={}'.format(max_indices))
-
-        # training the knn layers
-        knn_large_trainset = get_knn_layers(X_train, y_train_sparse)
-        knn_small_trainset = get_knn_layers(X_train_mini, y_train_mini_sparse)
-
-        # val
-        all_normal_ranks, all_normal_dists = calc_all_ranks_and_dists(X_val, 'val', knn_large_trainset)
-        all_adv_ranks   , all_adv_dists    = calc_all_ranks_and_dists(X_val_adv, 'val', knn_large_trainset)
-        ranks, ranks_adv = get_nnif(X_val, 'val', max_indices)
-        ranks     = ranks[:, :, sel_column]
-        ranks_adv = ranks_adv[:, :, sel_column]
+    # the activations, rank lookups and ranks are calculated once, for the largest max_indices. The characteristics
+    # of every max_indices are then the means over a prefix of the sorted helpful/harmful lists
+    print('Extracting NNIF characteristics for max_indices={}'.format(max_indices_vec))
+
+    # training the knn layers
+    knn_large_trainset = get_knn_layers(X_train, 'train')
+    knn_small_trainset = get_knn_layers(X_train_mini, 'train_mini')
+
+    # val
+    knn_layers          = knn_large_trainset
+    all_normal_features = calc_all_layer_features(X_val, 'val')
+    all_adv_features    = calc_all_layer_features(X_val_adv, 'val', adversarial=True)
+    all_ranks, all_ranks_adv = get_nnif(X_val, 'val', max_indices_vec)
+    for j, max_indices in enumerate(max_indices_vec):
+        ranks     = all_ranks[j][:, :, sel_column]
+        ranks_adv = all_ranks_adv[j][:, :, sel_column]
         characteristics, labels = merge_and_generate_labels(ranks_adv, ranks)
         print("NNIF train: [characteristic shape: ", characteristics.shape, ", label shape: ", labels.shape)
         file_name = 'max_indices_{}_ablation_{}_train'.format(max_indices, FLAGS.ablation)
@@ -841,19 +836,21 @@ if FLAGS.characteristics == 'nnif':
         file_name = os.path.join(characteristics_dir, file_name)
         data = np.concatenate((characteristics, labels), axis=1)
         np.save(file_name, data)
-        end_val = time.time()
-        print('total feature extraction time for val: {} sec'.format(end_val - start))
-
-        # test
-        all_normal_ranks, all_normal_dists = calc_all_ranks_and_dists(X_test, 'test', knn_small_trainset)
-        all_adv_ranks   , all_adv_dists    = calc_all_ranks_and_dists(X_test_adv, 'test', knn_small_trainset)
-        ranks, ranks_adv = get_nnif(X_test, 'test', max_indices)
-        ranks[:, :, 0] *= (49/5)  # The mini train set contains only 5k images, not 49k images as in the train set
-        ranks[:, :, 2] *= (49/5)  # Therefore, the ranks (both helpful and harmful) are scaled.
-        ranks_adv[:, :, 0] *= (49/5)
-        ranks_adv[:, :, 2] *= (49/5)
-        ranks     = ranks[:, :, sel_column]
-        ranks_adv = ranks_adv[:, :, sel_column]
+    end_val = time.time()
+    print('total feature extraction time for val: {} sec'.format(end_val - start))
+
+    # test
+    knn_layers          = knn_small_trainset
+    all_normal_features = calc_all_layer_features(X_test, 'test')
+    all_adv_features    = calc_all_layer_features(X_test_adv, 'test', adversarial=True)
+    all_ranks, all_ranks_adv = get_nnif(X_test, 'test', max_indices_vec)
+    all_ranks[:, :, :, 0] *= (49/5)  # The mini train set contains only 5k images, not 49k images as in the train set
+    all_ranks[:, :, :, 2] *= (49/5)  # Therefore, the ranks (both helpful and harmful) are scaled.
+    all_ranks_adv[:, :, :, 0] *= (49/5)
+    all_ranks_adv[:, :, :, 2] *= (49/5)
+    for j, max_indices in enumerate(max_indices_vec):
+        ranks     = all_ranks[j][:, :, sel_column]
+        ranks_adv = all_ranks_adv[j][:, :, sel_column]
         characteristics, labels = merge_and_generate_labels(ranks_adv, ranks)
         print("NNIF test: [characteristic shape: ", characteristics.shape, ", label shape: ", labels.shape)
         file_name = 'max_indices_{}_ablation_{}_test'.format(max_indices, FLAGS.ablation)
@@ -861,8 +858,8 @@ if FLAGS.characteristics == 'nnif':
         file_name = os.path.join(characteristics_dir, file_name)
         data = np.concatenate((characteristics, labels), axis=1)
         np.save(file_name, data)
-        end_test = time.time()
-        print('total feature extraction time for test: {} sec'.format(end_test - end_val))
+    end_test = time.time()
+    print('total feature extraction time for test: {} sec'.format(end_test - end_val))
 
 if FLAGS.characteristics == 'mahalanobis':
 
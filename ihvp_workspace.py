@@ -0,0 +1,143 @@
+"""
+Managing the inverse HVPs of the darkon workspaces of a set (<checkpoint_dir>/influence_workspace_validation or
+influence_workspace_test_mini, with the pred and adv/<attack> workspaces), see influence/ihvp_store.py.
+
+Commands (--command):
+    stats:  the number and disk size of the loose darkon .npz files and of the packed store entries.
+    pack:   moving the loose darkon ihvp.*.npz files into the packed store (--ihvp_store float32/float16), so that
+            calc_scores.py --ihvp_store reads them. The files are removed once they are packed.
+    gc:     removing the inverse HVPs whose scores are already materialized (in the score store of the set or in the
+            per-index directories), and compacting the store. The entries of a packed .npz file do not know their test
+            index, so they are removed (like the loose .npz files) only once all the samples of --selection are scored.
+Run with:
+python NNIF_adv_defense/ihvp_workspace.py --dataset cifar10 --set val --attack cw --command gc
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import os
+import glob
+import pickle
+import numpy as np
+from tensorflow.python.platform import flags
+from NNIF_adv_defense.influence.ihvp_store import IHVPStore, IHVP_STORE_DIR
+from NNIF_adv_defense.influence.score_files import scores_complete
+from NNIF_adv_defense.influence.score_store import ScoreStore, store_dir
+from NNIF_adv_defense.influence.score_workers import scores_dir
+from NNIF_adv_defense.influence.shards import select_indices
+from NNIF_adv_defense.influence.param_scope import parse_scope, scope_scores_name
+
+FLAGS = flags.FLAGS
+
+flags.DEFINE_string('dataset', 'cifar10', 'dataset: cifar10/100 or svhn')
+flags.DEFINE_string('set', 'val', 'val or test set of the workspace')
+flags.DEFINE_string('attack', 'deepfool', 'adversarial attack: deepfool, jsma, cw, cw_nnif')
+flags.DEFINE_string('checkpoint_dir', '', 'Checkpoint dir, the path to the saved model architecture and weights')
+flags.DEFINE_string('command', 'stats', 'stats, pack or gc')
+flags.DEFINE_string('ihvp_store', 'float16', 'storage dtype of the packed inverse HVPs (pack): float32 or float16')
+flags.DEFINE_string('influence_params', 'all', 'parameters of the influence scores: all or last_layer')
+flags.DEFINE_string('influence_scope', '', 'the --influence_scope of the scores (comma separated variable scopes). '
+                                            'Empty for all the parameters')
+flags.DEFINE_string('selection', 'all', 'the --selection of the run: gc removes the inverse HVPs of unknown samples '
+                                        'once all these samples are scored')
+
+TARGETED = FLAGS.attack != 'deepfool'  # we use targeted attacks everywhere except deepfool
+SCORES_NAME = scope_scores_name(FLAGS.influence_params, parse_scope(FLAGS.influence_scope))  # the scores files/stores
+
+if FLAGS.checkpoint_dir != '':
+    model_dir = FLAGS.checkpoint_dir                          # set user specified dir
+else:
+    model_dir = os.path.join(FLAGS.dataset, 'trained_model')  # set default dir
+
+if FLAGS.set == 'val':
+    WORKSPACE = 'influence_workspace_validation'
+else:
+    WORKSPACE = 'influence_workspace_test_mini'
+workspace_dir = os.path.join(model_dir, WORKSPACE)
+workspaces = {'pred': os.path.join(workspace_dir, 'pred'),
+              'adv' : os.path.join(workspace_dir, 'adv', FLAGS.attack)}
+
+
+def loose_files(workspace):
+    """darkon's inverse HVP files of a workspace"""
+    return sorted(glob.glob(os.path.join(workspace, 'ihvp.*.npz')))
+
+
+def size_str(num_bytes):
+    return '{:.2f} GB'.format(num_bytes / float(1 << 30))
+
+
+if FLAGS.command == 'stats':
+    for case, workspace in workspaces.items():
+        files = loose_files(workspace)
+        print('{} workspace {}: {} loose .npz files ({})'
+              .format(case, workspace, len(files), size_str(sum(os.path.getsize(f) for f in files))))
+        if os.path.isdir(os.path.join(workspace, IHVP_STORE_DIR)):
+            store = IHVPStore(os.path.join(workspace, IHVP_STORE_DIR))
+            entries = store.entries()
+            live_bytes = sum(length for _, _, length in entries)
+            print('    packed store: {} entries, {} on disk, {} of them live'
+                  .format(len(entries), size_str(store.disk_bytes()), size_str(live_bytes)))
+
+elif FLAGS.command == 'pack':
+    for case, workspace in workspaces.items():
+        store = IHVPStore(os.path.join(workspace, IHVP_STORE_DIR), FLAGS.ihvp_store)
+        files = loose_files(workspace)
+        freed = 0
+        for path in files:
+            name = os.path.basename(path)
+            if not store.contains(name):
+                store.put(name, np.load(path, encoding='bytes', allow_pickle=True)['inverse_hvp'], test_indices=[])
+            freed += os.path.getsize(path)
+            os.remove(path)
+        print('{}: packed {} files ({}) into {}. The store takes {}'
+              .format(case, len(files), size_str(freed), store.dir, size_str(store.disk_bytes())))
+
+elif FLAGS.command == 'gc':
+    attack_dir = os.path.join(model_dir, FLAGS.attack)
+    if TARGETED:
+        attack_dir = attack_dir + '_targeted'
+    info_file = os.path.join(attack_dir, 'info.pkl')
+    print('loading info as pickle from {}'.format(info_file))
+    with open(info_file, 'rb') as handle:
+        info = pickle.load(handle)
+
+    for case, workspace in workspaces.items():
+        stores = []  # the score store of the set, and the per-shard stores not merged yet
+        for dir in [store_dir(model_dir, FLAGS.set, case, FLAGS.attack, SCORES_NAME)] + \
+                sorted(glob.glob(store_dir(model_dir, FLAGS.set, case, FLAGS.attack, SCORES_NAME) + '_shard*')):
+            score_store = ScoreStore(dir)
+            if score_store.exists():
+                stores.append(score_store.open())
+
+        def is_scored(sub_index):
+            if any(score_store.is_done(sub_index) for score_store in stores):
+                return True
+            return scores_complete(scores_dir(model_dir, FLAGS.set, info[FLAGS.set][sub_index]['global_index'], case,
+                                              FLAGS.attack), SCORES_NAME)
+
+        all_scored = all(is_scored(sub_index) for sub_index in select_indices(info[FLAGS.set], FLAGS.selection))
+        freed = 0
+        if os.path.isdir(os.path.join(workspace, IHVP_STORE_DIR)):
+            store = IHVPStore(os.path.join(workspace, IHVP_STORE_DIR))
+            garbage = [name for name, test_indices, _ in store.entries()
+                       if (len(test_indices) == 0 and all_scored) or
+                       (len(test_indices) > 0 and all(is_scored(sub_index) for sub_index in test_indices))]
+            store.delete(garbage)
+            freed += store.compact()
+            print('{}: removed {} packed inverse HVPs'.format(case, len(garbage)))
+        if all_scored:
+            files = loose_files(workspace)
+            for path in files:
+                freed += os.path.getsize(path)
+                os.remove(path)
+            print('{}: all the {} samples are scored, removed {} loose .npz files'.format(case, FLAGS.set, len(files)))
+        else:
+            print('{}: not all the {} samples are scored, the loose .npz files are kept'.format(case, FLAGS.set))
+        print('{}: freed {}'.format(case, size_str(freed)))
+
+else:
+    raise AssertionError('command {} is not supported'.format(FLAGS.command))
@@ -0,0 +1,129 @@
+"""
+A persistent store of the spatially pooled activations of every layer of DarkonReplica (model.net), per checkpoint and
+dataset split, shared by the characteristics extractors (see extract_characteristics.py).
+
+The NNIF rank lookups and the Mahalanobis estimator all need the same pooled activations of the train/val/test images
+and of their adversarial versions. Instead of a forward pass over the split in every function and every run, the
+activations of a split are calculated once into a store directory (<model_dir>/feature_store/<split> for the natural
+images, <attack_dir>/feature_store/<split> for the adversarial/noisy images) with:
+    <layer>.npy:    a [num_samples, num_channels] float32 matrix per layer, the mean over the spatial axes of the
+                    activations (2-D outputs such as the embedding are kept as is).
+    manifest.json:  the checkpoint key (train_grad_cache.checkpoint_key), the sha1 of the images, the number of samples
+                    and the layers that were written. It is written last, so a killed build is never read.
+The layer matrices are opened as read-only memory maps, so the readers only page in the rows they slice. A store of
+another checkpoint or other images is rebuilt, and layers missing from a store (e.g. after --only_last) are added.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import os
+import json
+import hashlib
+import numpy as np
+from NNIF_adv_defense.influence.score_files import atomic_write
+
+FEATURE_STORE_DIR = 'feature_store'
+BUILD_CHUNK_SIZE = 1000
+
+
+def data_key(X):
+    """The sha1 of the images of a split"""
+    return hashlib.sha1(np.ascontiguousarray(X, dtype=np.float32).data).hexdigest()
+
+
+def pool_features(features):
+    """The mean over the spatial axes of [batch, height, width, channels] activations. 2-D activations are kept"""
+    features = np.asarray(features, dtype=np.float32)
+    if features.ndim == 4:
+        return features.reshape((features.shape[0], -1, features.shape[-1])).mean(axis=1)
+    assert features.ndim == 2, 'Expecting size of 2 or 4 but got {}'.format(features.ndim)
+    return features
+
+
+class FeatureStore(object):
+    def __init__(self, dir):
+        """
+        :param dir: the directory of the store of a split
+        """
+        self.dir           = dir
+        self.manifest_path = os.path.join(dir, 'manifest.json')
+        self.layers        = {}  # the opened memory maps
+
+    def manifest(self):
+        if not os.path.isfile(self.manifest_path):
+            return None
+        with open(self.manifest_path, 'r') as f:
+            return json.load(f)
+
+    def layer_path(self, layer):
+        return os.path.join(self.dir, '{}.npy'.format(layer))
+
+    def is_valid(self, checkpoint_key, images_key, num_samples, layers):
+        """True if the store holds all the layers of these images, calculated with this checkpoint"""
+        manifest = self.manifest()
+        return manifest is not None and manifest['checkpoint'] == checkpoint_key and \
+            manifest['data'] == images_key and manifest['num_samples'] == num_samples and \
+            all(layer in manifest['layers'] for layer in layers)
+
+    def build(self, sess, x, net, X, batch_size, checkpoint_key, chunk_size=BUILD_CHUNK_SIZE):
+        """
+        Calculating the pooled activations of X, unless the store already holds them
+        :param sess: the session with the checkpoint loaded
+        :param x: the input placeholder
+        :param net: dict of layer name -> activations tensor. Preferably model.pooled_net, so that only the pooled
+                    [batch, channels] features are fetched; 4-D activations are pooled here
+        :param X: the images of the split
+        :param batch_size: the batch size of the forward pass
+        :param checkpoint_key: the key of the checkpoint loaded in sess
+        :param chunk_size: number of images whose fetched activations are held at a time
+        """
+        from cleverhans.evaluation import batch_eval
+
+        images_key = data_key(X)
+        if self.is_valid(checkpoint_key, images_key, len(X), net.keys()):
+            return self
+        manifest = self.manifest()
+        if manifest is None or manifest['checkpoint'] != checkpoint_key or manifest['data'] != images_key or \
+                manifest['num_samples'] != len(X):
+            manifest = {'checkpoint': checkpoint_key, 'data': images_key, 'num_samples': len(X), 'layers': {}}
+        if os.path.isfile(self.manifest_path):
+            os.remove(self.manifest_path)  # the store is invalid until the new manifest is written
+        if not os.path.exists(self.dir):
+            os.makedirs(self.dir)
+
+        layers = [layer for layer in net.keys() if layer not in manifest['layers']]
+        print('Calculating the pooled features of {} layers into the feature store {}...'.format(len(layers), self.dir))
+        outputs = {}
+        for start in range(0, len(X), chunk_size):
+            features = batch_eval(sess, [x], [net[layer] for layer in layers], [X[start:start + chunk_size]],
+                                  batch_size)
+            for layer, layer_features in zip(layers, features):
+                layer_features = pool_features(layer_features)
+                if layer not in outputs:
+                    outputs[layer] = np.lib.format.open_memmap(self.layer_path(layer), mode='w+', dtype=np.float32,
+                                                               shape=(len(X), layer_features.shape[1]))
+                outputs[layer][start:start + len(layer_features)] = layer_features
+            del features
+        for layer in layers:
+            outputs[layer].flush()
+            manifest['layers'][layer] = int(outputs[layer].shape[1])
+        del outputs
+        self.layers = {}
+        atomic_write(self.manifest_path, lambda path: self._write_manifest(path, manifest))
+        return self
+
+    @staticmethod
+    def _write_manifest(path, manifest):
+        with open(path, 'w') as f:
+            json.dump(manifest, f, indent=2)
+
+    def layer(self, layer):
+        """The [num_samples, num_channels] pooled features of a layer, as a read-only memory map"""
+        if layer not in self.layers:
+            assert os.path.isfile(self.manifest_path) and layer in self.manifest()['layers'], \
+                'layer {} is not in the feature store {}'.format(layer, self.dir)
+            self.layers[layer] = np.load(self.layer_path(layer), mmap_mode='r')
+        return self.layers[layer]
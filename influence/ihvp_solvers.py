@@ -0,0 +1,459 @@
+"""
+Inverse HVP solvers for NNIFInfluence.
+
+darkon only implements the LiSSA recursion (approx_params). Here the inverse HVP (H + damping * I)^-1 g of a test
+gradient g is computed by one of:
+    lissa:   darkon's LiSSA recursion (the default), with per-step convergence tracking and an optional early exit.
+             The number of repeats can be adaptive: they stop once the averaged estimate is stable.
+    cg:      truncated conjugate gradient, stopped when ||r|| <= tol * ||g|| or after max_iters iterations.
+    arnoldi: a low-rank eigen-decomposition of H (Arnoldi iteration, top_k eigenpairs by magnitude), calculated once
+             per checkpoint and saved to disk. Every inverse HVP is then two dense products with the eigenbasis.
+    kfac:    a Kronecker-factored approximation of the curvature, one block per conv/fc layer (see kfac.py),
+             calculated once per checkpoint from the whole training set and saved to disk. Every inverse HVP is then a
+             few small matrix products per layer.
+    ekfac:   kfac with the eigenvalues corrected to the per-sample gradients in the Kronecker eigenbasis.
+The cg and arnoldi solvers use the Hessian of the training loss averaged over the first num_batches training
+mini-batches, and by default the damping LiSSA effectively uses (damping * scale).
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import os
+import json
+import time
+import hashlib
+import logging
+import threading
+from abc import ABCMeta, abstractmethod
+import numpy as np
+from NNIF_adv_defense.influence.train_grad_cache import checkpoint_key
+from NNIF_adv_defense.influence.last_layer import lissa_damping
+from NNIF_adv_defense.influence.kfac import KFACFactors
+from NNIF_adv_defense.influence.score_files import atomic_write
+
+IHVP_SOLVERS = ['lissa', 'cg', 'arnoldi', 'kfac', 'ekfac']
+KFAC_SOLVERS = ['kfac', 'ekfac']
+ARNOLDI_SEED = 123456789
+
+_solver_log_lock = threading.Lock()  # the pipeline producer threads share a single solver log
+
+
+def flatten(arrays):
+    """Concatenating a list of arrays into a single float64 vector"""
+    return np.concatenate([np.asarray(a, dtype=np.float64).reshape(-1) for a in arrays])
+
+
+def unflatten(vector, shapes):
+    """Splitting a vector into float32 arrays with the given shapes, in darkon's inverse_hvp format"""
+    arrays = np.empty(len(shapes), dtype=object)
+    offset = 0
+    for i, shape in enumerate(shapes):
+        size = int(np.prod(shape))
+        arrays[i] = vector[offset:offset + size].reshape(shape).astype(np.float32)
+        offset += size
+    assert offset == len(vector), 'vector of size {} does not match the shapes ({} params)'.format(len(vector), offset)
+    return arrays
+
+
+def append_solver_log(path, record):
+    """Appending a record as a single json line to the (machine readable) solver log. Thread safe"""
+    line = json.dumps(record, sort_keys=True) + '\n'
+    with _solver_log_lock:
+        with open(path, 'a') as f:
+            f.write(line)
+
+
+class DampedHessian(object):
+    def __init__(self, insp, batch_size, num_batches, damping):
+        """
+        The operator v -> (H + damping * I) v, where H is the Hessian of the training loss of insp averaged over the
+        first num_batches training mini-batches of its feeder.
+        :param insp: a darkon.Influence (its feeder, placeholders and hessian_vector_op are used)
+        :param batch_size: training mini-batch size
+        :param num_batches: number of training mini-batches
+        :param damping: damping added to the Hessian diagonal
+        """
+        self.insp    = insp
+        self.damping = damping
+        self.shapes  = [v.get_shape().as_list() for v in insp.trainable_variables]
+        self.num_params = int(sum(np.prod(shape) for shape in self.shapes))
+
+        insp.feeder.reset()
+        self.batches = [insp.feeder.train_batch(batch_size) for _ in range(num_batches)]
+        insp.feeder.reset()
+
+    def dot(self, sess, vector):
+        arrays = unflatten(vector, self.shapes)
+        hessian_vector = np.zeros(self.num_params)
+        for train_batch_data, train_batch_label in self.batches:
+            feed_dict = self.insp._make_train_feed_dict(train_batch_data, train_batch_label)
+            for placeholder, var in zip(self.insp.v_cur_estimated, arrays):
+                feed_dict[placeholder] = var
+            hessian_vector += flatten(sess.run(self.insp.hessian_vector_op, feed_dict=feed_dict))
+        return hessian_vector / len(self.batches) + self.damping * np.asarray(vector, dtype=np.float64)
+
+
+class IHVPSolver(object):
+    __metaclass__ = ABCMeta
+    name = None
+
+    @abstractmethod
+    def config(self):
+        """The solver parameters. They are part of the inverse HVP file names"""
+
+    @abstractmethod
+    def solve(self, sess, insp, test_grad_loss):
+        """
+        :param sess: TF session
+        :param insp: the NNIFInfluence calling the solver
+        :param test_grad_loss: list of arrays, the gradient of the test loss
+        :return: the inverse HVP (in darkon's format) and a dict of statistics (at least 'iterations')
+        """
+
+
+class LissaSolver(IHVPSolver):
+    name = 'lissa'
+
+    def __init__(self, tol=0.0, repeats_tol=0.0, min_repeats=2):
+        """
+        darkon's LiSSA recursion, configured by the approx_params, with the convergence of every repeat tracked.
+        :param tol: if > 0, a repeat stops early once the relative change of the estimate in a single recursion step,
+                    ||cur_j - cur_j-1|| / ||cur_j||, drops below tol. With tol=0 the result is identical to darkon's
+        :param repeats_tol: if > 0, no more repeats are run (out of num_repeats) once the relative standard error of
+                            the averaged estimate, ||std of the repeats|| / sqrt(repeats) / ||mean||, drops below
+                            repeats_tol. With repeats_tol=0 all the num_repeats repeats are run
+        :param min_repeats: minimal number of repeats before the repeats may stop
+        """
+        assert min_repeats >= 2, 'the spread of the repeats requires min_repeats >= 2'
+        self.tol         = tol
+        self.repeats_tol = repeats_tol
+        self.min_repeats = min_repeats
+
+    def config(self):
+        config = {}  # empty: same inverse HVP file names as darkon
+        if self.tol > 0:
+            config['tol'] = self.tol
+        if self.repeats_tol > 0:
+            config.update({'repeats_tol': self.repeats_tol, 'min_repeats': self.min_repeats})
+        return config
+
+    @staticmethod
+    def repeats_spread(estimates):
+        """The relative standard error of the mean of the flattened per-repeat estimates"""
+        estimates = np.asarray(estimates)
+        mean = estimates.mean(axis=0)
+        variance = np.sum((estimates - mean) ** 2) / (len(estimates) - 1)
+        return float(np.sqrt(variance / len(estimates)) / max(np.linalg.norm(mean), 1e-12))
+
+    def solve(self, sess, insp, test_grad_loss):
+        ihvp_config = insp.ihvp_config
+        inverse_hvp = None
+        steps  = []
+        deltas = []
+        estimates = []  # the flattened estimate of every repeat, for the adaptive number of repeats
+        spreads   = []
+        for _ in range(ihvp_config['num_repeats']):
+            cur_estimate = test_grad_loss
+            cur_norm = np.linalg.norm(flatten(cur_estimate))
+            repeat_deltas = []
+            for _ in range(ihvp_config['recursion_depth']):
+                train_batch_data, train_batch_label = insp.feeder.train_batch(ihvp_config['recursion_batch_size'])
+                feed_dict = insp._make_train_feed_dict(train_batch_data, train_batch_label)
+                feed_dict = insp._update_feed_dict(feed_dict, cur_estimate, test_grad_loss)
+                feed_dict.update({
+                    insp.v_param_damping: 1 - ihvp_config['damping'],
+                    insp.v_param_scale: ihvp_config['scale']
+                })
+                new_estimate = sess.run(insp.estimation_op, feed_dict=feed_dict)
+                new_norm = np.linalg.norm(flatten(new_estimate))
+                delta = np.linalg.norm(flatten(new_estimate) - flatten(cur_estimate)) / max(new_norm, 1e-12)
+                repeat_deltas.append(float(delta))
+                cur_estimate, cur_norm = new_estimate, new_norm
+                if delta < self.tol:
+                    break
+            logging.info('LiSSA repeat stopped after {} steps: norm is {}, relative change {}'
+                         .format(len(repeat_deltas), cur_norm, repeat_deltas[-1] if repeat_deltas else 0.0))
+            steps.append(len(repeat_deltas))
+            deltas.append(repeat_deltas)
+
+            if inverse_hvp is None:
+                inverse_hvp = np.array(cur_estimate) / ihvp_config['scale']
+            else:
+                inverse_hvp += np.array(cur_estimate) / ihvp_config['scale']
+
+            if self.repeats_tol > 0:
+                estimates.append(flatten(cur_estimate))
+                if len(estimates) >= 2:
+                    spreads.append(self.repeats_spread(estimates))
+                if len(estimates) >= self.min_repeats and spreads[-1] < self.repeats_tol:
+                    break
+
+        repeats = len(steps)
+        inverse_hvp /= repeats
+        if repeats < ihvp_config['num_repeats']:
+            logging.info('LiSSA stopped after {}/{} repeats: relative spread {}'
+                         .format(repeats, ihvp_config['num_repeats'], spreads[-1]))
+        final_delta = deltas[-1][-1] if len(deltas) > 0 and len(deltas[-1]) > 0 else 0.0
+        return inverse_hvp, {'iterations': int(sum(steps)), 'steps': steps, 'final_delta': final_delta,
+                             'deltas': deltas, 'repeats': repeats, 'spreads': spreads}
+
+
+class ConjugateGradientSolver(IHVPSolver):
+    name = 'cg'
+
+    def __init__(self, damping, max_iters=100, tol=1e-3, batch_size=200, num_batches=5):
+        """
+        :param damping: damping added to the Hessian diagonal
+        :param max_iters: maximum number of CG iterations (one Hessian-vector product each)
+        :param tol: relative residual tolerance
+        :param batch_size: training mini-batch size of the Hessian
+        :param num_batches: number of training mini-batches of the Hessian
+        """
+        self.damping     = damping
+        self.max_iters   = max_iters
+        self.tol         = tol
+        self.batch_size  = batch_size
+        self.num_batches = num_batches
+
+    def config(self):
+        return {'damping': self.damping, 'max_iters': self.max_iters, 'tol': self.tol,
+                'batch_size': self.batch_size, 'num_batches': self.num_batches}
+
+    def _operator(self, insp):
+        # kept on the inspector (every thread/case has its own feeder), so it is released together with the inspector
+        if getattr(insp, '_cg_operator', None) is None:
+            insp._cg_operator = DampedHessian(insp, self.batch_size, self.num_batches, self.damping)
+        return insp._cg_operator
+
+    def solve(self, sess, insp, test_grad_loss):
+        operator = self._operator(insp)
+        b = flatten(test_grad_loss)
+        b_norm = np.linalg.norm(b)
+        x = np.zeros_like(b)
+        r = b.copy()
+        p = r.copy()
+        rs = r.dot(r)
+
+        iterations = 0
+        while iterations < self.max_iters and np.sqrt(rs) > self.tol * b_norm:
+            Ap = operator.dot(sess, p)
+            pAp = p.dot(Ap)
+            if pAp <= 0:
+                logging.warning('CG stopped at iteration {}: the damped Hessian is not positive definite '
+                                '(p^T A p = {}). Consider a larger damping'.format(iterations, pAp))
+                break
+            alpha = rs / pAp
+            x += alpha * p
+            r -= alpha * Ap
+            rs_new = r.dot(r)
+            p = r + (rs_new / rs) * p
+            rs = rs_new
+            iterations += 1
+
+        relative_residual = np.sqrt(rs) / b_norm if b_norm > 0 else 0.0
+        return unflatten(x, operator.shapes), {'iterations': iterations, 'relative_residual': float(relative_residual)}
+
+
+class ArnoldiSolver(IHVPSolver):
+    name = 'arnoldi'
+
+    def __init__(self, damping, cache_dir, num_iters=100, top_k=50, batch_size=200, num_batches=5,
+                 seed=ARNOLDI_SEED):
+        """
+        :param damping: damping added to the eigenvalues
+        :param cache_dir: directory of the eigenbasis files
+        :param num_iters: number of Arnoldi iterations (dimension of the Krylov subspace)
+        :param top_k: number of eigenpairs kept
+        :param batch_size: training mini-batch size of the Hessian
+        :param num_batches: number of training mini-batches of the Hessian
+        :param seed: seed of the initial Arnoldi vector
+        """
+        assert top_k <= num_iters, 'top_k ({}) must not exceed num_iters ({})'.format(top_k, num_iters)
+        self.damping     = damping
+        self.cache_dir   = cache_dir
+        self.num_iters   = num_iters
+        self.top_k       = top_k
+        self.batch_size  = batch_size
+        self.num_batches = num_batches
+        self.seed        = seed
+        self.eigvals     = None
+        self.basis       = None
+        self.basis_key   = None
+        self.lock        = threading.Lock()  # the inspectors of all threads share the solver
+
+    def config(self):
+        return {'damping': self.damping, 'num_iters': self.num_iters, 'top_k': self.top_k,
+                'batch_size': self.batch_size, 'num_batches': self.num_batches, 'seed': self.seed}
+
+    def basis_path(self, sess, insp):
+        """The eigenbasis file of the checkpoint loaded in sess and the training set of insp"""
+        sha = hashlib.sha1()
+        basis_config = dict(self.config(), train_size=insp.feeder.get_train_size())
+        del basis_config['damping']  # the eigenbasis does not depend on the damping
+        sha.update(json.dumps(basis_config, sort_keys=True).encode('utf-8'))
+        file_name = 'arnoldi_{}_{}.npz'.format(checkpoint_key(sess, insp.trainable_variables), sha.hexdigest()[:16])
+        return os.path.join(self.cache_dir, file_name)
+
+    def _arnoldi(self, sess, operator):
+        """The top_k eigenpairs of the (undamped) Hessian in the Krylov subspace of num_iters iterations"""
+        rand_gen = np.random.RandomState(self.seed)
+        vectors = np.zeros((self.num_iters + 1, operator.num_params), dtype=np.float32)
+        hessenberg = np.zeros((self.num_iters + 1, self.num_iters))
+        v = rand_gen.normal(size=operator.num_params)
+        vectors[0] = v / np.linalg.norm(v)
+
+        num_iters = self.num_iters
+        for i in range(self.num_iters):
+            w = operator.dot(sess, vectors[i])
+            for j in range(i + 1):  # modified Gram-Schmidt
+                hessenberg[j, i] = w.dot(vectors[j])
+                w -= hessenberg[j, i] * vectors[j]
+            hessenberg[i + 1, i] = np.linalg.norm(w)
+            if hessenberg[i + 1, i] < 1e-10:  # the Krylov subspace is invariant
+                num_iters = i + 1
+                break
+            vectors[i + 1] = w / hessenberg[i + 1, i]
+            if (i + 1) % 10 == 0:
+                print('Arnoldi iteration {}/{}'.format(i + 1, self.num_iters))
+
+        # H is symmetric, so the Hessenberg matrix is tridiagonal up to round-off errors
+        hessenberg = hessenberg[:num_iters, :num_iters]
+        eigvals, eigvecs = np.linalg.eigh((hessenberg + hessenberg.T) / 2.0)
+        order = np.argsort(-np.abs(eigvals))[:self.top_k]
+        basis = eigvecs[:, order].T.dot(vectors[:num_iters]).astype(np.float32)
+        return eigvals[order], basis, num_iters
+
+    def prepare(self, sess, insp):
+        """
+        Loading the eigenbasis of the checkpoint, or calculating (and saving) it. The file is written atomically, but
+        concurrent processes would all calculate it, so call it once before the worker processes start scoring.
+        """
+        with self.lock:
+            path = self.basis_path(sess, insp)
+            if self.basis_key == path:
+                return 0
+            if os.path.isfile(path):
+                print('loading Arnoldi eigenbasis from {}'.format(path))
+                data = np.load(path)
+                eigvals, basis = data['eigvals'], data['basis']
+                num_iters = 0
+            else:
+                print('Calculating the Arnoldi eigenbasis {}...'.format(path))
+                operator = DampedHessian(insp, self.batch_size, self.num_batches, damping=0.0)
+                eigvals, basis, num_iters = self._arnoldi(sess, operator)
+                if not os.path.exists(self.cache_dir):
+                    os.makedirs(self.cache_dir)
+                atomic_write(path, lambda tmp_path: np.savez(tmp_path, eigvals=eigvals, basis=basis))
+                print('top eigenvalues: {}'.format(eigvals[:10]))
+            self.eigvals, self.basis, self.basis_key = eigvals, basis, path
+            return num_iters
+
+    def solve(self, sess, insp, test_grad_loss):
+        basis_iterations = self.prepare(sess, insp)
+        coeffs = self.basis.dot(flatten(test_grad_loss)) / (self.eigvals + self.damping)
+        inverse_hvp = self.basis.T.dot(coeffs)
+        shapes = [v.get_shape().as_list() for v in insp.trainable_variables]
+        return unflatten(inverse_hvp, shapes), {'iterations': 0, 'basis_iterations': basis_iterations}
+
+
+class KFACSolver(IHVPSolver):
+    def __init__(self, damping, cache_dir, ekfac=False, batch_size=200):
+        """
+        :param damping: damping added to the eigenvalues of every block
+        :param cache_dir: directory of the factors files
+        :param ekfac: use the eigenvalue corrected factors (EK-FAC)
+        :param batch_size: training mini-batch size of the factors calculation
+        """
+        self.name        = 'ekfac' if ekfac else 'kfac'
+        self.damping     = damping
+        self.cache_dir   = cache_dir
+        self.ekfac       = ekfac
+        self.batch_size  = batch_size
+        self.factors     = None
+        self.factors_key = None
+        self.lock        = threading.Lock()  # the inspectors of all threads share the solver
+
+    def config(self):
+        return {'damping': self.damping, 'ekfac': self.ekfac, 'batch_size': self.batch_size}
+
+    def factors_path(self, sess, variables, train_size):
+        """The factors file of the checkpoint loaded in sess and a training set of train_size samples"""
+        sha = hashlib.sha1()
+        factors_config = dict(self.config(), train_size=train_size)
+        del factors_config['damping']  # the factors do not depend on the damping
+        sha.update(json.dumps(factors_config, sort_keys=True).encode('utf-8'))
+        file_name = '{}_{}_{}.npz'.format(self.name, checkpoint_key(sess, variables), sha.hexdigest()[:16])
+        return os.path.join(self.cache_dir, file_name)
+
+    def prepare_factors(self, sess, loss_op, x_placeholder, y_placeholder, variables, feeder, feed_options=None):
+        """
+        Loading the factors of the checkpoint, or calculating (and saving) them. Calculating the factors adds ops to
+        the graph, so call it once before the graph is finalized (e.g. before the worker threads/processes start).
+        See KFACFactors.compute() for the parameters.
+        """
+        with self.lock:
+            path = self.factors_path(sess, variables, feeder.get_train_size())
+            if self.factors_key == path:
+                return
+            factors = KFACFactors(path)
+            if factors.exists():
+                print('loading {} factors from {}'.format(self.name, path))
+                factors.load()
+            else:
+                print('Calculating the {} factors {}...'.format(self.name, path))
+                factors.compute(sess, loss_op, x_placeholder, y_placeholder, variables, feeder, self.batch_size,
+                                ekfac=self.ekfac, feed_options=feed_options)
+                factors.save()
+            self.factors, self.factors_key = factors, path
+
+    def prepare(self, sess, insp):
+        self.prepare_factors(sess, insp.loss_op_train, insp.x_placeholder, insp.y_placeholder,
+                             insp.trainable_variables, insp.feeder, insp.train_feed_options)
+
+    def solve(self, sess, insp, test_grad_loss):
+        self.prepare(sess, insp)
+        return self.factors.inverse_hvp(test_grad_loss, self.damping), {'iterations': 0}
+
+
+def make_solver(name, approx_params, max_iters=100, tol=1e-3, top_k=50, num_batches=5, cache_dir=None, lissa_tol=0.0,
+                lissa_repeats_tol=0.0, lissa_min_repeats=2):
+    """
+    Building a solver from the command line flags.
+    :param name: lissa, cg, arnoldi, kfac or ekfac
+    :param approx_params: the LiSSA approx_params. The other solvers use their damping and recursion_batch_size
+    :param max_iters: maximum CG iterations / number of Arnoldi iterations
+    :param tol: CG relative residual tolerance
+    :param top_k: number of Arnoldi eigenpairs
+    :param num_batches: number of training mini-batches of the Hessian (cg/arnoldi)
+    :param cache_dir: directory of the Arnoldi eigenbasis / K-FAC factors files
+    :param lissa_tol: LiSSA relative change tolerance for an early exit (0 disables it)
+    :param lissa_repeats_tol: LiSSA relative spread of the repeats below which no more repeats are run (0 disables it)
+    :param lissa_min_repeats: minimal number of LiSSA repeats with lissa_repeats_tol
+    """
+    damping = lissa_damping(approx_params)
+    batch_size = approx_params['recursion_batch_size']
+    if name == 'lissa':
+        return LissaSolver(tol=lissa_tol, repeats_tol=lissa_repeats_tol, min_repeats=lissa_min_repeats)
+    elif name == 'cg':
+        return ConjugateGradientSolver(damping, max_iters=max_iters, tol=tol, batch_size=batch_size,
+                                       num_batches=num_batches)
+    elif name == 'arnoldi':
+        assert cache_dir is not None, 'the arnoldi solver requires a cache_dir'
+        return ArnoldiSolver(damping, cache_dir, num_iters=max_iters, top_k=top_k, batch_size=batch_size,
+                             num_batches=num_batches)
+    elif name in KFAC_SOLVERS:
+        assert cache_dir is not None, 'the {} solver requires a cache_dir'.format(name)
+        return KFACSolver(damping, cache_dir, ekfac=name == 'ekfac', batch_size=batch_size)
+    raise AssertionError('ihvp solver {} is not supported'.format(name))
+
+
+def solve_timed(solver, sess, insp, test_grad_loss):
+    """Running the solver and adding its name and wall time to the statistics"""
+    start_time = time.time()
+    inverse_hvp, stats = solver.solve(sess, insp, test_grad_loss)
+    stats['solver'] = solver.name
+    stats['time'] = time.time() - start_time
+    return inverse_hvp, stats
@@ -0,0 +1,200 @@
+"""
+A packed store of the inverse HVPs of a darkon workspace (--ihvp_store), replacing darkon's .npz file per sample.
+
+darkon saves every inverse HVP as a full-size float32 (object array) .npz file that is never removed. Here the inverse
+HVPs of a workspace (<workspace>/ihvp_store) are:
+    encoded as float32, or as float16 scaled by their max abs value (half the size, ~1e-3 relative precision),
+    zlib compressed,
+    appended as blocks to a few large pack files (pack_<n>.bin, up to pack_bytes each),
+    indexed in a small SQLite database (index.sqlite): name (darkon's file name), test indices, pack, offset, length.
+Appending a block and indexing it is a single transaction, so threads and worker processes share a store. A block of
+a killed run that was never indexed is dead space, and so are the blocks of deleted entries: compact() rewrites the
+packs with only the live blocks. Reading a block holds a shared lock on packs.lock, and compact() holds an exclusive
+one, so it waits for the running reads and never removes a pack under a reader (e.g. a gc while calc_scores.py runs).
+See ihvp_workspace.py for the pack and gc commands.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import os
+import json
+import zlib
+import fcntl
+import sqlite3
+import contextlib
+import numpy as np
+from NNIF_adv_defense.influence.ihvp_solvers import unflatten
+
+IHVP_STORE_DIR = 'ihvp_store'
+IHVP_STORE_DTYPES = ['float32', 'float16']
+PACK_BYTES = 1 << 30
+
+
+class IHVPStore(object):
+    def __init__(self, dir, dtype='float32', pack_bytes=PACK_BYTES):
+        """
+        :param dir: the directory of the store. Created if it does not exist
+        :param dtype: storage dtype of the new blocks, float32 or float16. Blocks of either dtype are read
+        :param pack_bytes: a new pack file is started once a pack exceeds this size
+        """
+        assert dtype in IHVP_STORE_DTYPES, 'dtype {} is not supported'.format(dtype)
+        self.dir        = dir
+        self.dtype      = dtype
+        self.pack_bytes = pack_bytes
+        self.index_path = os.path.join(dir, 'index.sqlite')
+        self.lock_path  = os.path.join(dir, 'packs.lock')
+        if not os.path.exists(dir):
+            os.makedirs(dir)
+        with self._transaction() as conn:
+            conn.execute('CREATE TABLE IF NOT EXISTS blocks ('
+                         'name TEXT PRIMARY KEY, test_indices TEXT NOT NULL, pack INTEGER NOT NULL, '
+                         'offset INTEGER NOT NULL, length INTEGER NOT NULL, dtype TEXT NOT NULL, scale REAL NOT NULL, '
+                         'shapes TEXT NOT NULL)')
+
+    @contextlib.contextmanager
+    def _transaction(self):
+        """A write transaction on a fresh connection. Connections are never shared between threads or processes"""
+        conn = sqlite3.connect(self.index_path, timeout=600, isolation_level=None)
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                yield conn
+            except Exception:
+                conn.execute('ROLLBACK')
+                raise
+            conn.execute('COMMIT')
+        finally:
+            conn.close()
+
+    @contextlib.contextmanager
+    def _packs_lock(self, exclusive=False):
+        """A lock on the pack files: shared while reading blocks, exclusive while compacting"""
+        with open(self.lock_path, 'a') as f:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+            try:
+                yield
+            finally:
+                fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+    def pack_path(self, pack):
+        return os.path.join(self.dir, 'pack_{}.bin'.format(pack))
+
+    def _encode(self, inverse_hvp, dtype):
+        vector = np.concatenate([np.asarray(a, dtype=np.float32).reshape(-1) for a in inverse_hvp])
+        scale = 1.0
+        if dtype == 'float16':
+            scale = max(float(np.abs(vector).max()), 1e-30)
+            vector = vector / scale
+        return zlib.compress(vector.astype(dtype).tobytes(), 1), scale
+
+    def contains(self, name):
+        with self._transaction() as conn:
+            return conn.execute('SELECT 1 FROM blocks WHERE name = ?', (name,)).fetchone() is not None
+
+    def put(self, name, inverse_hvp, test_indices):
+        """
+        :param name: the name of the inverse HVP (darkon's file name)
+        :param inverse_hvp: the inverse HVP, in darkon's format (list of per-variable arrays)
+        :param test_indices: the test indices of the inverse HVP
+        """
+        data, scale = self._encode(inverse_hvp, self.dtype)
+        shapes = json.dumps([list(np.shape(a)) for a in inverse_hvp])
+        with self._transaction() as conn:  # the transaction also serializes the appends
+            pack = conn.execute('SELECT MAX(pack) FROM blocks').fetchone()[0] or 0
+            path = self.pack_path(pack)
+            if os.path.isfile(path) and os.path.getsize(path) > 0 and \
+                    os.path.getsize(path) + len(data) > self.pack_bytes:
+                pack += 1
+                path = self.pack_path(pack)
+            with open(path, 'ab') as f:
+                f.seek(0, os.SEEK_END)
+                offset = f.tell()
+                f.write(data)
+                f.flush()
+                os.fsync(f.fileno())
+            conn.execute('INSERT OR REPLACE INTO blocks (name, test_indices, pack, offset, length, dtype, scale, shapes) '
+                         'VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                         (name, json.dumps([int(i) for i in test_indices]), pack, offset, len(data), self.dtype, scale,
+                          shapes))
+
+    def _read(self, pack, offset, length):
+        with open(self.pack_path(pack), 'rb') as f:
+            f.seek(offset)
+            data = f.read(length)
+        assert len(data) == length, 'pack {} of {} is truncated'.format(pack, self.dir)
+        return data
+
+    def get(self, name):
+        """The inverse HVP in darkon's format (object array of float32 arrays)"""
+        with self._packs_lock():  # the block is not moved by compact() until it was read
+            with self._transaction() as conn:
+                row = conn.execute('SELECT pack, offset, length, dtype, scale, shapes FROM blocks WHERE name = ?',
+                                   (name,)).fetchone()
+            assert row is not None, 'inverse HVP {} is not in the store {}'.format(name, self.dir)
+            pack, offset, length, dtype, scale, shapes = row
+            data = self._read(pack, offset, length)
+        vector = np.frombuffer(zlib.decompress(data), dtype=dtype).astype(np.float32)
+        return unflatten(vector * np.float32(scale), json.loads(shapes))
+
+    def entries(self):
+        """All the entries, as a list of (name, test_indices, length)"""
+        with self._transaction() as conn:
+            rows = conn.execute('SELECT name, test_indices, length FROM blocks ORDER BY pack, offset').fetchall()
+        return [(str(name), json.loads(test_indices), length) for name, test_indices, length in rows]
+
+    def delete(self, names):
+        """Removing entries from the index. Their blocks are dead space until compact()"""
+        with self._transaction() as conn:
+            conn.executemany('DELETE FROM blocks WHERE name = ?', [(name,) for name in names])
+
+    def disk_bytes(self):
+        """The size of all the pack files"""
+        return sum(os.path.getsize(os.path.join(self.dir, f)) for f in os.listdir(self.dir)
+                   if f.startswith('pack_') and f.endswith('.bin'))
+
+    def compact(self):
+        """
+        Rewriting the packs that hold dead space with only their live blocks, into new packs. The store is locked
+        during the compaction (it waits for the running reads, and new reads wait for it), and a killed compaction
+        leaves the old packs in use. Returns the number of bytes freed.
+        """
+        with self._packs_lock(exclusive=True):
+            return self._compact()
+
+    def _compact(self):
+        freed = 0
+        removed = []
+        with self._transaction() as conn:
+            rows = conn.execute('SELECT name, pack, offset, length FROM blocks ORDER BY pack, offset').fetchall()
+            live = {}
+            for name, pack, offset, length in rows:
+                live.setdefault(pack, []).append((name, offset, length))
+            packs = sorted(int(f[len('pack_'):-len('.bin')]) for f in os.listdir(self.dir)
+                           if f.startswith('pack_') and f.endswith('.bin'))
+            next_pack = max(packs + [-1]) + 1
+            for pack in packs:
+                blocks = live.get(pack, [])
+                pack_size = os.path.getsize(self.pack_path(pack))
+                if pack_size == sum(length for _, _, length in blocks):
+                    continue  # no dead space
+                if len(blocks) > 0:
+                    new_path = self.pack_path(next_pack)
+                    with open(new_path, 'wb') as f:
+                        for name, offset, length in blocks:
+                            new_offset = f.tell()
+                            f.write(self._read(pack, offset, length))
+                            conn.execute('UPDATE blocks SET pack = ?, offset = ? WHERE name = ?',
+                                         (next_pack, new_offset, name))
+                        f.flush()
+                        os.fsync(f.fileno())
+                    freed += pack_size - os.path.getsize(new_path)
+                    next_pack += 1
+                else:
+                    freed += pack_size
+                removed.append(pack)
+        for pack in removed:  # only once the index points to the new packs
+            os.remove(self.pack_path(pack))
+        return freed
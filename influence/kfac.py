@@ -0,0 +1,255 @@
+"""
+Kronecker-factored (K-FAC) and eigenvalue-corrected (EK-FAC) curvature of DarkonReplica, for the inverse HVPs.
+
+Every conv layer and the fc layer is a block of the curvature, approximated by A (x) G: A is the second moment of the
+layer inputs (the im2col patches of a conv layer, summed over the output positions; the embedding vector and a constant
+1 for the fc bias) and G the second moment of the per-sample gradients w.r.t. the layer outputs (averaged over the
+output positions). With the eigendecompositions A = Q_A diag(e_A) Q_A^T and G = Q_G diag(e_G) Q_G^T, the damped inverse
+of a block applied to a gradient V, as a [dim A, dim G] matrix, is
+    Q_A ((Q_A^T V Q_G) / (e_A e_G^T + damping)) Q_G^T
+so an inverse HVP costs a few small matrix products per layer. EK-FAC replaces e_A e_G^T by the second moments of the
+per-sample gradients in the Kronecker eigenbasis, which takes a second pass over the training set.
+The batch norm parameters (beta, gamma) are not part of any layer block. They get a diagonal approximation.
+
+The factors approximate the (empirical Fisher) curvature of the training loss at a checkpoint. They are calculated
+once by streaming over the training set in mini-batches, and saved to a .npz file that KFACFactors.load() reads without
+TensorFlow, so any consumer of the checkpoint (calc_hvp.py, calc_scores.py, an online detector) can reuse them.
+Since the batch norm layers normalize with the statistics of the fed batch, the per-sample gradients w.r.t. the layer
+outputs are taken from the mini-batch loss (scaled by the batch size), ignoring the coupling of the samples.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import os
+import json
+import numpy as np
+from NNIF_adv_defense.influence.score_files import atomic_write
+
+KFAC_LAYER_OPS = ['Conv2D', 'MatMul']
+
+
+def _loss_ops(loss_op):
+    """All the ops the loss depends on"""
+    ops = set()
+    stack = [loss_op.op]
+    while len(stack) > 0:
+        op = stack.pop()
+        if op in ops:
+            continue
+        ops.add(op)
+        stack.extend(t.op for t in op.inputs)
+        stack.extend(op.control_inputs)
+    return ops
+
+
+def _as_str(value):
+    return value.decode('utf-8') if isinstance(value, bytes) else value
+
+
+def find_layers(loss_op, variables):
+    """
+    The conv and fc layers of the loss whose weights are in variables.
+    :param loss_op: the training loss tensor
+    :param variables: the variables of the inverse HVPs (darkon's trainable_variables)
+    :return: list of dicts of: name, type (conv/fc), weights and bias (indices in variables, bias may be None),
+             inputs and outputs (the layer input tensor and its output before the bias), strides and padding (conv)
+    """
+    ops = _loss_ops(loss_op)
+    index_of = {v.value().name: i for i, v in enumerate(variables)}
+    layers = []
+    for op in ops:
+        if op.type not in KFAC_LAYER_OPS or op.inputs[1].name not in index_of:
+            continue
+        weights = index_of[op.inputs[1].name]
+        layer = {'name': variables[weights].op.name, 'weights': weights, 'bias': None,
+                 'inputs': op.inputs[0], 'outputs': op.outputs[0]}
+        if op.type == 'Conv2D':
+            assert _as_str(op.get_attr('data_format')) == 'NHWC', 'only NHWC convolutions are supported'
+            assert list(op.get_attr('dilations')) == [1, 1, 1, 1], 'dilated convolutions are not supported'
+            layer.update({'type': 'conv', 'strides': list(op.get_attr('strides')),
+                          'padding': _as_str(op.get_attr('padding'))})
+        else:
+            assert not op.get_attr('transpose_a') and not op.get_attr('transpose_b'), \
+                'transposed matmul of {} is not supported'.format(layer['name'])
+            layer['type'] = 'fc'
+            for consumer in op.outputs[0].consumers():
+                if consumer not in ops or consumer.type not in ['Add', 'AddV2', 'BiasAdd']:
+                    continue
+                for t in consumer.inputs:
+                    if t.name in index_of and len(variables[index_of[t.name]].get_shape()) == 1:
+                        layer['bias'] = index_of[t.name]
+        layers.append(layer)
+    assert len(layers) > 0, 'no conv/fc layer of the variables was found in the loss'
+    return sorted(layers, key=lambda layer: layer['weights'])
+
+
+class KFACFactors(object):
+    def __init__(self, path):
+        """
+        :param path: path of the .npz factors file
+        """
+        self.path    = path
+        self.layers  = None  # list of dicts: name, type, weights, bias, shape of the [dim A, dim G] block
+        self.factors = None  # per layer: (Q_A, Q_G, scales), where scales is the [dim A, dim G] eigenvalues matrix
+        self.diag    = None  # {variable index: diagonal curvature} of the variables that are not in a layer
+
+    def exists(self):
+        return os.path.isfile(self.path)
+
+    def load(self):
+        data = np.load(self.path)
+        meta = json.loads(str(data['meta']))
+        self.layers = meta['layers']
+        self.factors = [(data['q_a_{}'.format(i)], data['q_g_{}'.format(i)], data['scales_{}'.format(i)])
+                        for i in range(len(self.layers))]
+        self.diag = {i: data['diag_{}'.format(i)] for i in meta['diag']}
+        return self
+
+    def save(self):
+        dir = os.path.dirname(self.path)
+        if dir != '' and not os.path.exists(dir):
+            os.makedirs(dir)
+        arrays = {'meta': np.array(json.dumps({'layers': self.layers, 'diag': sorted(self.diag)}))}
+        for i, (q_a, q_g, scales) in enumerate(self.factors):
+            arrays['q_a_{}'.format(i)] = q_a
+            arrays['q_g_{}'.format(i)] = q_g
+            arrays['scales_{}'.format(i)] = scales
+        for i in self.diag:
+            arrays['diag_{}'.format(i)] = self.diag[i]
+        atomic_write(self.path, lambda p: np.savez(p, **arrays))
+
+    def compute(self, sess, loss_op, x_placeholder, y_placeholder, variables, feeder, batch_size, ekfac=False,
+                feed_options=None):
+        """
+        Calculating the factors of the training loss, streaming over the training set of the feeder.
+        :param sess: TF session with the checkpoint loaded
+        :param loss_op: the training loss tensor (mean over the batch)
+        :param x_placeholder: input placeholder
+        :param y_placeholder: label placeholder
+        :param variables: the variables of the inverse HVPs (darkon's trainable_variables)
+        :param feeder: feeder of the training set (train_batch() and reset())
+        :param batch_size: training mini-batch size
+        :param ekfac: also calculate the eigenvalue corrections (a second pass over the training set)
+        :param feed_options: optional extra feed dict
+        """
+        import tensorflow as tf
+
+        layers = find_layers(loss_op, variables)
+        in_layer = set([layer['weights'] for layer in layers] + [layer['bias'] for layer in layers])
+        rest = [i for i in range(len(variables)) if i not in in_layer]
+        num_batches = feeder.get_train_size() // batch_size
+        assert num_batches > 0, 'the training set is smaller than a mini-batch of {}'.format(batch_size)
+
+        with tf.name_scope('nnif_kfac'):
+            batch = tf.cast(tf.shape(x_placeholder)[0], tf.float32)
+            grads = tf.gradients(loss_op, [layer['outputs'] for layer in layers] + [variables[i] for i in rest])
+            a_ops, g_ops, moments_ops, q_placeholders = [], [], [], []
+            for layer, output_grads in zip(layers, grads[:len(layers)]):
+                if layer['type'] == 'conv':
+                    kernel_shape = variables[layer['weights']].get_shape().as_list()
+                    patches = tf.extract_image_patches(layer['inputs'], ksizes=[1] + kernel_shape[:2] + [1],
+                                                       strides=layer['strides'], rates=[1, 1, 1, 1],
+                                                       padding=layer['padding'])
+                    dim_a = int(np.prod(kernel_shape[:3]))
+                    a = tf.reshape(patches, [tf.shape(patches)[0], -1, dim_a])
+                else:
+                    inputs = layer['inputs']
+                    if layer['bias'] is not None:
+                        inputs = tf.concat([inputs, tf.ones_like(inputs[:, :1])], axis=1)
+                    a = tf.expand_dims(inputs, 1)
+                dim_a = a.get_shape().as_list()[-1]
+                dim_g = output_grads.get_shape().as_list()[-1]
+                # the loss is a batch mean, so the gradients of a single sample are batch * output_grads
+                g = tf.reshape(output_grads * batch, [tf.shape(output_grads)[0], -1, dim_g])
+                num_positions = tf.cast(tf.shape(g)[1], tf.float32)
+                a_flat = tf.reshape(a, [-1, dim_a])
+                g_flat = tf.reshape(g, [-1, dim_g])
+                a_ops.append(tf.matmul(a_flat, a_flat, transpose_a=True))
+                g_ops.append(tf.matmul(g_flat, g_flat, transpose_a=True) / num_positions)
+                if ekfac:
+                    q_a = tf.placeholder(tf.float32, shape=[dim_a, dim_a])
+                    q_g = tf.placeholder(tf.float32, shape=[dim_g, dim_g])
+                    projected_a = tf.reshape(tf.matmul(a_flat, q_a), tf.shape(a))
+                    projected_g = tf.reshape(tf.matmul(g_flat, q_g), tf.shape(g))
+                    per_sample = tf.matmul(projected_a, projected_g, transpose_a=True)  # [batch, dim A, dim G]
+                    moments_ops.append(tf.reduce_sum(tf.square(per_sample), axis=0))
+                    q_placeholders.extend([q_a, q_g])
+            # the batch gradients are means of batch per-sample gradients, so E[g_sample^2] ~ batch * E[g_batch^2]
+            diag_ops = [tf.square(g) * batch for g in grads[len(layers):]]
+
+        def run_batches(fetches, extra_feed, description):
+            sums = None
+            feeder.reset()
+            for it in range(num_batches):
+                train_batch_data, train_batch_label = feeder.train_batch(batch_size)
+                feed_dict = {x_placeholder: train_batch_data, y_placeholder: train_batch_label}
+                feed_dict.update(extra_feed)
+                if feed_options is not None:
+                    feed_dict.update(feed_options)
+                values = sess.run(fetches, feed_dict=feed_dict)
+                if sums is None:
+                    sums = [np.asarray(v, dtype=np.float64) for v in values]
+                else:
+                    for s, v in zip(sums, values):
+                        s += v
+                if (it + 1) % 50 == 0:
+                    print('{}: batch {}/{}'.format(description, it + 1, num_batches))
+            feeder.reset()
+            return sums
+
+        num_samples = float(num_batches * batch_size)
+        sums = run_batches(a_ops + g_ops + diag_ops, {}, 'K-FAC factors')
+        self.factors = []
+        for i in range(len(layers)):
+            e_a, q_a = np.linalg.eigh(sums[i] / num_samples)
+            e_g, q_g = np.linalg.eigh(sums[len(layers) + i] / num_samples)
+            # the factors are PSD, negative eigenvalues are round-off errors
+            scales = np.outer(np.maximum(e_a, 0.0), np.maximum(e_g, 0.0))
+            self.factors.append((q_a.astype(np.float32), q_g.astype(np.float32), scales.astype(np.float32)))
+        self.diag = {i: (sums[2 * len(layers) + j] / num_batches).astype(np.float32) for j, i in enumerate(rest)}
+
+        if ekfac:
+            q_feed = {}
+            for i, (q_a, q_g, _) in enumerate(self.factors):
+                q_feed[q_placeholders[2 * i]] = q_a
+                q_feed[q_placeholders[2 * i + 1]] = q_g
+            moments = run_batches(moments_ops, q_feed, 'EK-FAC eigenvalue corrections')
+            self.factors = [(q_a, q_g, (m / num_samples).astype(np.float32))
+                            for (q_a, q_g, _), m in zip(self.factors, moments)]
+
+        self.layers = [{'name': layer['name'], 'type': layer['type'], 'weights': layer['weights'],
+                        'bias': layer['bias'], 'shape': [int(q_a.shape[0]), int(q_g.shape[0])]}
+                       for layer, (q_a, q_g, _) in zip(layers, self.factors)]
+        return self
+
+    def _block(self, arrays, layer):
+        """The [dim A, dim G] matrix of a layer, from the arrays of all the variables"""
+        weights = np.asarray(arrays[layer['weights']], dtype=np.float64).reshape(-1, layer['shape'][1])
+        if layer['bias'] is not None:
+            weights = np.concatenate([weights, np.asarray(arrays[layer['bias']], dtype=np.float64)[None, :]])
+        return weights
+
+    def inverse_hvp(self, vectors, damping):
+        """
+        (F + damping * I)^-1 v, where F is the factored curvature.
+        :param vectors: list of arrays, v as darkon's per-variable arrays (e.g. a test loss gradient)
+        :param damping: damping added to the eigenvalues
+        :return: the inverse HVP in darkon's format (object array of float32 arrays)
+        """
+        result = np.empty(len(vectors), dtype=object)
+        for layer, (q_a, q_g, scales) in zip(self.layers, self.factors):
+            block = self._block(vectors, layer)
+            projected = q_a.T.dot(block).dot(q_g) / (scales + damping)
+            block = q_a.dot(projected).dot(q_g.T)
+            if layer['bias'] is not None:
+                result[layer['bias']] = block[-1].astype(np.float32)
+                block = block[:-1]
+            shape = np.shape(vectors[layer['weights']])
+            result[layer['weights']] = block.reshape(shape).astype(np.float32)
+        for i in self.diag:
+            result[i] = (np.asarray(vectors[i], dtype=np.float64) / (self.diag[i] + damping)).astype(np.float32)
+        assert all(r is not None for r in result), 'the factors do not cover all the variables'
+        return result
@@ -0,0 +1,166 @@
+"""
+Exact influence functions w.r.t. the DarkonReplica output layer only (fc_weights and fc_bias).
+
+For the output layer Y = h W + b with a softmax cross entropy loss, the gradient and Hessian have closed forms in the
+embedding vector h (the global pooling output, see x_train_features.npy):
+    grad_i = [h_i, 1] (x) (p_i - y_i)                           (+ weight_decay * W for the training loss)
+    H      = mean_i [h_i, 1][h_i, 1]^T (x) (diag(p_i) - p_i p_i^T) + weight_decay * I_W
+The Hessian is only (64+1)*num_classes wide, so it is formed and inverted exactly once. Like darkon's LiSSA recursion,
+whose fixed point is (H + damping * scale * I)^-1, the inverse is damped by damping * scale of the approx_params.
+The parameters are flattened as the rows of the augmented [(d+1), num_classes] matrix [[W], [b]].
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import os
+import json
+import hashlib
+import numpy as np
+from NNIF_adv_defense.influence.score_files import atomic_write
+
+
+def lissa_damping(approx_params, default_damping=0.01):
+    """The damping that darkon's LiSSA recursion effectively adds to the Hessian: damping * scale"""
+    return approx_params.get('damping', default_damping) * approx_params['scale']
+
+
+def softmax(logits):
+    logits = logits - logits.max(axis=1, keepdims=True)
+    exp_logits = np.exp(logits)
+    return exp_logits / exp_logits.sum(axis=1, keepdims=True)
+
+
+def get_fc_params(sess, model):
+    """Fetching the fc_weights and fc_bias values of a DarkonReplica model"""
+    fc_weights = [v for v in model.get_params() if v.name.endswith('fc_weights:0')]
+    fc_bias    = [v for v in model.get_params() if v.name.endswith('fc_bias:0')]
+    assert len(fc_weights) == 1 and len(fc_bias) == 1, 'could not find the fc layer params of the model'
+    return sess.run([fc_weights[0], fc_bias[0]])
+
+
+class LastLayerInfluence(object):
+    def __init__(self, fc_weights, fc_bias, label_smoothing, weight_decay, damping, chunk_size=1000):
+        """
+        :param fc_weights: [d, num_classes] output layer weights
+        :param fc_bias: [num_classes] output layer bias
+        :param label_smoothing: label smoothing of the CrossEntropy loss
+        :param weight_decay: weight decay coefficient of the training loss (applied to fc_weights only)
+        :param damping: damping added to the Hessian diagonal. Must be positive: the loss is invariant to adding the
+                        same constant to all the biases, so the undamped Hessian is singular
+        :param chunk_size: number of samples processed at a time
+        """
+        assert damping > 0, 'damping must be positive, got {}'.format(damping)
+        self.fc_weights      = np.asarray(fc_weights, dtype=np.float64)
+        self.fc_bias         = np.asarray(fc_bias, dtype=np.float64)
+        self.label_smoothing = label_smoothing
+        self.weight_decay    = weight_decay
+        self.damping         = damping
+        self.chunk_size      = chunk_size
+
+        self.d, self.num_classes = self.fc_weights.shape
+        self.num_params = (self.d + 1) * self.num_classes
+        self.inverse_hessian = None
+
+    def key(self):
+        """A short hash of the fc params and the loss/damping parameters"""
+        sha = hashlib.sha1()
+        sha.update(np.ascontiguousarray(self.fc_weights).data)
+        sha.update(np.ascontiguousarray(self.fc_bias).data)
+        sha.update(json.dumps([self.label_smoothing, self.weight_decay, self.damping]).encode('utf-8'))
+        return sha.hexdigest()[:16]
+
+    def inverse_hvps_path(self, workspace):
+        """The path of the inverse HVPs matrix of all the val/test samples of a workspace"""
+        return os.path.join(workspace, 'last_layer_ihvp.{}.npy'.format(self.key()))
+
+    def _augment(self, features):
+        features = np.asarray(features, dtype=np.float64)
+        return np.concatenate([features, np.ones((features.shape[0], 1))], axis=1)
+
+    def _probs(self, features):
+        return softmax(np.asarray(features, dtype=np.float64).dot(self.fc_weights) + self.fc_bias)
+
+    def _smooth(self, labels):
+        labels = np.asarray(labels, dtype=np.float64)
+        return labels - self.label_smoothing * (labels - 1.0 / self.num_classes)
+
+    def per_sample_grads(self, features, labels, train=False):
+        """
+        :param features: [n, d] embedding vectors
+        :param labels: [n, num_classes] one hot labels (before smoothing)
+        :param train: whether to add the weight decay gradient of the training loss
+        :return: [n, num_params] gradients
+        """
+        residuals = self._probs(features) - self._smooth(labels)
+        grads = np.einsum('na,nc->nac', self._augment(features), residuals).reshape(len(features), -1)
+        if train:
+            grads[:, :self.d * self.num_classes] += self.weight_decay * self.fc_weights.reshape(-1)
+        return grads
+
+    def fit(self, train_features):
+        """Forming the damped Hessian of the mean training loss and inverting it"""
+        n = len(train_features)
+        D, C = self.d + 1, self.num_classes
+        per_class = np.zeros((C, D, D))  # sum_i p_ic h_i h_i^T
+        outer = np.zeros((D * C, D * C))  # sum_i vec(h_i p_i^T) vec(h_i p_i^T)^T
+        for start in range(0, n, self.chunk_size):
+            features = train_features[start:start + self.chunk_size]
+            h = self._augment(features)
+            p = self._probs(features)
+            for c in range(C):
+                per_class[c] += (h * p[:, c:c + 1]).T.dot(h)
+            m = np.einsum('na,nc->nac', h, p).reshape(len(h), -1)
+            outer += m.T.dot(m)
+
+        hessian = -outer
+        hessian_4d = hessian.reshape(D, C, D, C)
+        for c in range(C):
+            hessian_4d[:, c, :, c] += per_class[c]
+        hessian /= n
+        hessian[np.arange(self.d * C), np.arange(self.d * C)] += self.weight_decay
+        hessian[np.arange(D * C), np.arange(D * C)] += self.damping
+        self.inverse_hessian = np.linalg.inv(hessian)
+        return self
+
+    def inverse_hvp(self, test_features, test_labels):
+        """
+        :param test_features: [m, d] embedding vectors of the val/test samples
+        :param test_labels: [m, num_classes] labels used for the test loss (one hot)
+        :return: [m, num_params] inverse HVPs, one per test sample
+        """
+        assert self.inverse_hessian is not None, 'call fit() first'
+        return self.per_sample_grads(test_features, test_labels).dot(self.inverse_hessian)
+
+    def load_or_calc_inverse_hvps(self, workspace, train_features, test_features, test_labels):
+        """Loading the inverse HVPs of a workspace, or calculating (and saving) them if they do not exist"""
+        path = self.inverse_hvps_path(workspace)
+        if os.path.isfile(path):
+            print('loading last layer inverse HVPs from {}'.format(path))
+            return np.load(path)
+        if self.inverse_hessian is None:
+            self.fit(train_features)
+        inverse_hvps = self.inverse_hvp(test_features, test_labels)
+        if not os.path.exists(workspace):
+            os.makedirs(workspace)
+        atomic_write(path, lambda p: np.save(p, inverse_hvps))  # a killed run must not leave a truncated file
+        print('saved last layer inverse HVPs to {}'.format(path))
+        return inverse_hvps
+
+    def scores(self, train_features, train_labels, inverse_hvps):
+        """
+        The I_up_loss scores of all the training samples for a batch of test samples, normalized as in darkon
+        :param train_features: [n, d] embedding vectors of the training samples
+        :param train_labels: [n, num_classes] one hot labels of the training samples
+        :param inverse_hvps: [m, num_params] inverse HVPs of the test samples
+        :return: [m, n] scores
+        """
+        n = len(train_features)
+        scores = np.zeros((len(inverse_hvps), n))
+        for start in range(0, n, self.chunk_size):
+            end = min(start + self.chunk_size, n)
+            grads = self.per_sample_grads(train_features[start:end], train_labels[start:end], train=True)
+            scores[:, start:end] = inverse_hvps.dot(grads.T)
+        return scores / n
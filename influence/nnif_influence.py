@@ -0,0 +1,282 @@
+"""
+An extension of darkon's Influence class used by calc_hvp.py, calc_scores.py and attack.py.
+The inverse HVP files written here use darkon's own naming (see darkon.Influence._approx_filename), so any
+darkon.Influence built on the same workspace/checkpoint/approx_params loads them transparently.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import os
+import copy
+import time
+import json
+import hashlib
+import logging
+import numpy as np
+import tensorflow as tf
+import darkon
+from NNIF_adv_defense.influence.ihvp_solvers import solve_timed, flatten
+from NNIF_adv_defense.influence.ihvp_store import IHVPStore, IHVP_STORE_DIR
+
+
+class NNIFInfluence(darkon.Influence):
+    def __init__(self, workspace, feeder, loss_op_train, loss_op_test, x_placeholder, y_placeholder,
+                 block_size=1, solver=None, ihvp_store_dtype=None, **kwargs):
+        """
+        :param workspace: path to the darkon workspace where the inverse HVP files are saved
+        :param feeder: a MyFeederValTest feeder
+        :param loss_op_train: loss tensor used for training (including regularization)
+        :param loss_op_test: loss tensor used for inference
+        :param x_placeholder: input placeholder
+        :param y_placeholder: label placeholder
+        :param block_size: number of test points that share a single LiSSA recursion in prepare_block()
+        :param solver: an IHVPSolver (see ihvp_solvers.py). If None, darkon's LiSSA recursion is used
+        :param ihvp_store_dtype: if float32/float16, the inverse HVPs are kept in a packed IHVPStore (see ihvp_store.py)
+                                 in the workspace instead of darkon's .npz file per test point
+        :param kwargs: other darkon.Influence arguments (test_feed_options, train_feed_options, trainable_variables)
+        """
+        darkon.Influence.__init__(self, workspace, feeder, loss_op_train, loss_op_test, x_placeholder, y_placeholder,
+                                  **kwargs)
+        self.block_size = block_size
+        self.solver     = solver
+        self.ihvp_store = None if ihvp_store_dtype is None else \
+            IHVPStore(os.path.join(workspace, IHVP_STORE_DIR), ihvp_store_dtype)
+        # the inverse HVPs of a parameter subset (see param_scope.py) are saved apart from those of all the parameters
+        all_variables = tf.get_collection(tf.GraphKeys.TRAINABLE_VARIABLES) + \
+                        tf.get_collection(tf.GraphKeys.TRAINABLE_RESOURCE_VARIABLES)
+        variable_names = [v.name for v in self.trainable_variables]
+        self.variables_key = None
+        if variable_names != [v.name for v in all_variables]:
+            self.variables_key = hashlib.sha1(','.join(variable_names).encode('utf-8')).hexdigest()[:16]
+        self.last_solve_stats = None  # statistics of the last inverse HVP calculated (not loaded) by _prepare()
+        self._cg_operator     = None  # the DampedHessian of a ConjugateGradientSolver (see ihvp_solvers.py)
+
+        if block_size > 1:
+            # One recursion step for a block of test points: the forward pass and the first order gradients of the
+            # training mini-batch (self.grad_op_train) are shared, only the second backward pass is done per column.
+            with tf.name_scope('nnif_block_ihvp'):
+                self.v_block_cur_estimated = []
+                self.v_block_test_grad     = []
+                self.block_estimation_op   = []
+                for _ in range(block_size):
+                    cur_estimated = [tf.placeholder(tf.float32, shape=a.get_shape()) for a in self.trainable_variables]
+                    test_grad     = [tf.placeholder(tf.float32, shape=a.get_shape()) for a in self.trainable_variables]
+                    elemwise_products = [tf.multiply(g, tf.stop_gradient(v))
+                                         for g, v in zip(self.grad_op_train, cur_estimated) if g is not None]
+                    hessian_vector = tf.gradients(elemwise_products, self.trainable_variables)
+                    self.v_block_cur_estimated.append(cur_estimated)
+                    self.v_block_test_grad.append(test_grad)
+                    self.block_estimation_op.append([
+                        a + (b * self.v_param_damping) - (c / self.v_param_scale)
+                        for a, b, c in zip(test_grad, cur_estimated, hessian_vector)
+                    ])
+
+    def clone(self, workspace, feeder):
+        """
+        A new inspector on the same graph: the loss, gradient and HVP ops (and the placeholders) are shared, only the
+        workspace, the feeder and the LiSSA state are its own. Use it instead of building another NNIFInfluence for
+        every thread/case, which would add a copy of the whole forward/backward graph each time.
+        :param workspace: path to the darkon workspace of the new inspector
+        :param feeder: the feeder of the new inspector. Must not be shared with another thread
+        :return: NNIFInfluence
+        """
+        insp = copy.copy(self)
+        insp.workspace        = workspace
+        insp.feeder           = feeder
+        insp.ihvp_config      = dict(self.ihvp_config)
+        insp.inverse_hvp      = None
+        insp.last_solve_stats = None
+        insp._cg_operator     = None  # built from the training batches of the new feeder
+        if not os.path.exists(workspace):
+            os.makedirs(workspace)
+        if self.ihvp_store is not None:
+            insp.ihvp_store = IHVPStore(os.path.join(workspace, IHVP_STORE_DIR), self.ihvp_store.dtype)
+        return insp
+
+    def _approx_filename(self, sess, test_indices):
+        """
+        darkon's file name, extended with the solver config unless the solver reproduces darkon's LiSSA, and with the
+        trainable variables if they are a subset of the parameters
+        """
+        file_name = darkon.Influence._approx_filename(self, sess, test_indices)
+        solver_config = {} if self.solver is None else self.solver.config()
+        if not solver_config and self.variables_key is None:
+            return file_name
+        sha = hashlib.sha1(file_name.encode('utf-8'))
+        if solver_config:
+            sha.update(json.dumps(solver_config, sort_keys=True).encode('utf-8'))
+        if self.variables_key is not None:
+            sha.update(self.variables_key.encode('utf-8'))
+        solver_name = 'lissa' if self.solver is None else self.solver.name
+        return 'ihvp.{}.{}.npz'.format(solver_name, sha.hexdigest())
+
+    def _prepare(self, sess, test_indices, test_batch_size, approx_params, force_refresh):
+        """darkon's _prepare(), reading and writing the inverse HVP in the IHVPStore if set"""
+        self.last_solve_stats = None
+        if self.ihvp_store is None:
+            darkon.Influence._prepare(self, sess, test_indices, test_batch_size, approx_params, force_refresh)
+            return
+        self.update_approx_params(approx_params)
+        name = self._approx_filename(sess, test_indices)
+        if force_refresh or not self.ihvp_store.contains(name):
+            self.feeder.reset()
+            test_grad_loss = self._get_test_grad_loss(sess, test_indices, test_batch_size)
+            self.inverse_hvp = self._get_inverse_hvp_lissa(sess, test_grad_loss)
+            self.ihvp_store.put(name, self.inverse_hvp, test_indices)
+            logging.info('Saved inverse HVP {} to {}'.format(name, self.ihvp_store.dir))
+        else:
+            self.inverse_hvp = self.ihvp_store.get(name)
+            logging.info('Loaded inverse HVP {} from {}'.format(name, self.ihvp_store.dir))
+
+    def _get_inverse_hvp_lissa(self, sess, test_grad_loss):
+        """Called by darkon's _prepare(). Dispatching to the solver, if set"""
+        if self.solver is None:
+            return darkon.Influence._get_inverse_hvp_lissa(self, sess, test_grad_loss)
+        inverse_hvp, self.last_solve_stats = solve_timed(self.solver, sess, self, test_grad_loss)
+        return inverse_hvp
+
+    def update_approx_params(self, approx_params):
+        """Updating the ihvp config exactly as darkon does in _prepare()"""
+        if approx_params is not None:
+            for param_key in approx_params.keys():
+                if param_key not in self.ihvp_config:
+                    raise RuntimeError('unknown ihvp config param is approx_params')
+            self.ihvp_config.update(approx_params)
+
+    def inverse_hvp_path(self, sess, test_index):
+        """The darkon workspace path of the inverse HVP of a single test index"""
+        return self._path(self._approx_filename(sess, [test_index]))
+
+    def has_inverse_hvp(self, sess, test_index):
+        """True if the inverse HVP of a single test index was already saved (as a file or in the IHVPStore)"""
+        if self.ihvp_store is not None:
+            return self.ihvp_store.contains(self._approx_filename(sess, [test_index]))
+        return os.path.exists(self.inverse_hvp_path(sess, test_index))
+
+    def save_inverse_hvp(self, sess, test_index, inverse_hvp):
+        """Saving the inverse HVP of a single test index, as _prepare() does"""
+        if self.ihvp_store is not None:
+            self.ihvp_store.put(self._approx_filename(sess, [test_index]), inverse_hvp, [test_index])
+            return
+        inv_hvp_path = self.inverse_hvp_path(sess, test_index)
+        np.savez(inv_hvp_path, inverse_hvp=inverse_hvp, encoding='bytes')
+        logging.info('Saved inverse HVP to {}'.format(inv_hvp_path))
+
+    def upweighting_influence_cached(self, sess, test_indices, test_batch_size, approx_params, train_grad_cache,
+                                     force_refresh=False):
+        """
+        Same scores as upweighting_influence_batch(), but using the precomputed per-training-sample gradients.
+        :param sess: TF session
+        :param test_indices: list of test indices
+        :param test_batch_size: batch size for the test gradients
+        :param approx_params: LiSSA parameters
+        :param train_grad_cache: a complete TrainGradientCache of the training set of self.feeder
+        :param force_refresh: if True, recalculating the inverse HVP even if it was already saved
+        :return: numpy array with the score of every training sample
+        """
+        self._prepare(sess, test_indices, test_batch_size, approx_params, force_refresh)
+        inverse_hvp = np.concatenate([a.reshape(-1) for a in self.inverse_hvp])
+        return train_grad_cache.dot(inverse_hvp)
+
+    def upweighting_influence_vectorized(self, sess, test_indices, test_batch_size, approx_params, scorer,
+                                         train_iterations, force_refresh=False):
+        """
+        Same scores as upweighting_influence_batch(), but with the per-training-sample gradients of a whole training
+        batch calculated in a single graph execution.
+        :param sess: TF session
+        :param test_indices: list of test indices
+        :param test_batch_size: batch size for the test gradients
+        :param approx_params: LiSSA parameters
+        :param scorer: a PerExampleScorer (see per_example_grads.py) of the train batch size
+        :param train_iterations: number of training batches
+        :param force_refresh: if True, recalculating the inverse HVP even if it was already saved
+        :return: numpy array with the score of every training sample
+        """
+        self._prepare(sess, test_indices, test_batch_size, approx_params, force_refresh)
+        inverse_hvp = np.concatenate([a.reshape(-1) for a in self.inverse_hvp])
+        return scorer.scores(sess, self.feeder, inverse_hvp, train_iterations, self.train_feed_options)
+
+    def prepare_block(self, sess, test_indices, test_batch_size, approx_params, force_refresh=False):
+        """
+        Calculating the inverse HVP of many test points, self.block_size test points per LiSSA recursion.
+        Each test point gets its own inverse HVP file, identical to what _prepare(test_indices=[index]) would have
+        saved, since every recursion starts from feeder.reset() and consumes the same training batches.
+        :param sess: TF session
+        :param test_indices: list of test indices (in the feeder's test set)
+        :param test_batch_size: batch size for the test gradients
+        :param approx_params: LiSSA parameters
+        :param force_refresh: if False, test indices with existing inverse HVP files are skipped
+        :return: dict of test index -> solver statistics (as in last_solve_stats) of the calculated test indices. The
+                 wall time of a block is split evenly between its test points
+        """
+        assert self.block_size > 1, 'prepare_block() requires block_size > 1'
+        self.update_approx_params(approx_params)
+
+        pending_indices = [idx for idx in test_indices
+                           if force_refresh or not self.has_inverse_hvp(sess, idx)]
+        solve_stats = {}
+        for start in range(0, len(pending_indices), self.block_size):
+            block = pending_indices[start:start + self.block_size]
+            start_time = time.time()
+            self.feeder.reset()
+            test_grad_losses = [self._get_test_grad_loss(sess, [idx], test_batch_size) for idx in block]
+            inverse_hvps, final_deltas = self._get_inverse_hvp_lissa_block(sess, test_grad_losses)
+            block_time = time.time() - start_time
+            for idx, inverse_hvp, deltas in zip(block, inverse_hvps, final_deltas):
+                self.save_inverse_hvp(sess, idx, inverse_hvp)
+                steps = [self.ihvp_config['recursion_depth']] * self.ihvp_config['num_repeats']
+                solve_stats[idx] = {'solver': 'lissa', 'iterations': int(sum(steps)), 'steps': steps,
+                                    'final_delta': deltas[-1] if len(deltas) > 0 else 0.0, 'final_deltas': deltas,
+                                    'repeats': len(steps),
+                                    'time': block_time / len(block), 'block_size': len(block)}
+            self.inverse_hvp = inverse_hvps[-1]
+        return solve_stats
+
+    def _get_inverse_hvp_lissa_block(self, sess, test_grad_losses):
+        """
+        Same as darkon's _get_inverse_hvp_lissa(), but for a list of up to self.block_size test gradients
+        :return: the inverse HVPs, and per test gradient the relative change of the estimate in the last recursion
+                 step of every repeat
+        """
+        ihvp_config = self.ihvp_config
+        num_vectors = len(test_grad_losses)
+        assert num_vectors <= self.block_size
+        estimation_op = self.block_estimation_op[:num_vectors]
+
+        inverse_hvps = [None] * num_vectors
+        final_deltas = [[] for _ in range(num_vectors)]
+        for _ in range(ihvp_config['num_repeats']):
+            cur_estimates = list(test_grad_losses)
+            prev_estimates = cur_estimates
+            for _ in range(ihvp_config['recursion_depth']):
+                train_batch_data, train_batch_label = self.feeder.train_batch(ihvp_config['recursion_batch_size'])
+                feed_dict = self._make_train_feed_dict(train_batch_data, train_batch_label)
+                for k in range(num_vectors):
+                    for placeholder, var in zip(self.v_block_cur_estimated[k], cur_estimates[k]):
+                        feed_dict[placeholder] = var
+                    for placeholder, var in zip(self.v_block_test_grad[k], test_grad_losses[k]):
+                        feed_dict[placeholder] = var
+                feed_dict.update({
+                    self.v_param_damping: 1 - ihvp_config['damping'],
+                    self.v_param_scale: ihvp_config['scale']
+                })
+                prev_estimates = cur_estimates
+                cur_estimates = sess.run(estimation_op, feed_dict=feed_dict)
+
+            for k in range(num_vectors):
+                # the same relative change as tracked by LissaSolver, measured at the last step only
+                new_estimate = flatten(cur_estimates[k])
+                delta = np.linalg.norm(new_estimate - flatten(prev_estimates[k])) / \
+                    max(np.linalg.norm(new_estimate), 1e-12)
+                final_deltas[k].append(float(delta))
+                if inverse_hvps[k] is None:
+                    inverse_hvps[k] = np.array(cur_estimates[k]) / ihvp_config['scale']
+                else:
+                    inverse_hvps[k] += np.array(cur_estimates[k]) / ihvp_config['scale']
+
+        for k in range(num_vectors):
+            inverse_hvps[k] /= ihvp_config['num_repeats']
+        return inverse_hvps, final_deltas
@@ -0,0 +1,63 @@
+"""
+Restricting the influence functions to a subset of the model parameters (--influence_scope).
+
+By default the inverse HVPs and the scores are taken w.r.t. all the trainable variables of DarkonReplica (every conv,
+batch norm and fc variable). A scope is a comma separated list of variable scope patterns, relative to the model scope
+and matched with fnmatch against every leading part of a variable name, e.g.:
+    fc                        the output block (batch norm, fc_weights and fc_bias)
+    conv3_*,fc                the last residual stage and the output block
+    conv3_4/conv2_in_block    a single convolution (and its batch norm)
+The cost of the inverse HVPs and of the scores scales with the number of parameters in the scope. The scores of a scope
+are saved next to the full scores, under the name returned by scope_scores_name().
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import re
+import fnmatch
+import hashlib
+import numpy as np
+from NNIF_adv_defense.influence.score_files import SCOPE_PREFIX
+
+
+def parse_scope(scope):
+    """The patterns of a --influence_scope flag. An empty flag means all the parameters"""
+    return [pattern.strip().strip('/') for pattern in scope.split(',') if pattern.strip() != '']
+
+
+def in_scope(variable_name, patterns):
+    """True if a leading part of the variable name (without the model scope) matches one of the patterns"""
+    parts = variable_name.split(':')[0].split('/')[1:]  # dropping the model scope and the output index
+    prefixes = ['/'.join(parts[:i]) for i in range(1, len(parts) + 1)]
+    return any(fnmatch.fnmatchcase(prefix, pattern) for pattern in patterns for prefix in prefixes)
+
+
+def scope_variables(variables, patterns):
+    """
+    :param variables: all the trainable variables, in darkon's order
+    :param patterns: the scope patterns. If empty, all the variables are kept
+    :return: the variables in the scope, in the same order
+    """
+    if len(patterns) == 0:
+        return list(variables)
+    selected = [v for v in variables if in_scope(v.name, patterns)]
+    assert len(selected) > 0, 'no trainable variable matches the influence scope {}'.format(','.join(patterns))
+    num_params = int(sum(np.prod(v.get_shape().as_list()) for v in selected))
+    print('influence scope {}: {} variables, {} parameters'.format(','.join(patterns), len(selected), num_params))
+    return selected
+
+
+def scope_scores_name(influence_params, patterns):
+    """
+    The name of the scores (see score_files.scores_file_name and score_store.store_dir) of the influence_params and
+    scope: influence_params itself for all the parameters, or scope_<patterns>_<hash> for a subset of them.
+    """
+    if len(patterns) == 0:
+        return influence_params
+    assert influence_params == 'all', '--influence_scope requires --influence_params all'
+    scope = ','.join(patterns)
+    readable = re.sub('[^A-Za-z0-9_]+', '-', scope.replace('*', 'x')).strip('-')
+    return '{}{}_{}'.format(SCOPE_PREFIX, readable, hashlib.sha1(scope.encode('utf-8')).hexdigest()[:8])
@@ -0,0 +1,113 @@
+"""
+Vectorized per-training-sample gradients for the I_up_loss scores.
+
+darkon's upweighting_influence_batch() runs the gradient of the training loss once per training sample, since the
+batch norm layers of DarkonReplica always normalize with the statistics of the fed batch and the influence is defined
+for a batch of a single sample. Here the loss of every sample of a training batch is built on its own slice x[i:i+1]
+inside a parallel-for loop, so the batch norm statistics are still per sample, but the [batch, num_params] gradients
+block (the batch Jacobian) is calculated in a single graph execution and multiplied by the inverse HVP in the graph.
+
+Two loop implementations are available:
+    pfor:    tensorflow's parallel_for vectorization (the loop becomes batched ops). Falls back to map_fn if an op of
+             the loss is not supported.
+    map_fn:  a tf.map_fn (while loop) over the batch samples, with parallel iterations.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import numpy as np
+import tensorflow as tf
+from tensorflow.python.ops.parallel_for.control_flow_ops import pfor
+
+PER_EXAMPLE_METHODS = ['pfor', 'map_fn']
+
+
+class PerExampleScorer(object):
+    def __init__(self, loss_fn, x_placeholder, y_placeholder, variables, batch_size, method='pfor',
+                 parallel_iterations=32):
+        """
+        :param loss_fn: function (x, y) -> the scalar training loss of a batch, e.g. lambda x, y: full_loss.fprop(x=x, y=y)
+        :param x_placeholder: input placeholder
+        :param y_placeholder: label placeholder
+        :param variables: the variables the gradients are taken w.r.t. (darkon's trainable_variables)
+        :param batch_size: number of training samples fed at a time. Every batch is padded to it
+        :param method: pfor or map_fn
+        :param parallel_iterations: parallel iterations of map_fn
+        """
+        assert method in PER_EXAMPLE_METHODS, 'method {} is not supported'.format(method)
+        self.x_placeholder = x_placeholder
+        self.y_placeholder = y_placeholder
+        self.batch_size    = batch_size
+        self.num_params    = int(sum(np.prod(v.get_shape().as_list()) for v in variables))
+
+        def loop_fn(i):
+            index = tf.expand_dims(i, 0)
+            sample_loss = loss_fn(tf.gather(x_placeholder, index), tf.gather(y_placeholder, index))
+            grads = tf.gradients(sample_loss, variables)
+            return tf.concat([tf.reshape(g, [-1]) for g in grads], 0)
+
+        with tf.name_scope('nnif_per_example_grads'):
+            per_example_grads = None
+            if method == 'pfor':
+                try:
+                    per_example_grads = pfor(loop_fn, batch_size)
+                except (ValueError, NotImplementedError) as e:
+                    print('pfor cannot vectorize the loss ({}). Using map_fn instead'.format(e))
+                    method = 'map_fn'
+            if method == 'map_fn':
+                per_example_grads = tf.map_fn(loop_fn, tf.range(batch_size), dtype=tf.float32,
+                                              parallel_iterations=parallel_iterations, back_prop=False)
+            self.method = method
+            self.per_example_grads = per_example_grads  # [batch_size, num_params]
+
+            # as darkon's grad_diff_op: float64 product, normalized by the total number of training samples
+            self.v_ihvp = tf.placeholder(tf.float64, shape=[self.num_params])
+            self.v_total_trainset = tf.placeholder(tf.float64)
+            self.scores_op = tf.matmul(tf.cast(per_example_grads, tf.float64),
+                                       tf.reshape(self.v_ihvp, [-1, 1]))[:, 0] / self.v_total_trainset
+
+    def batch_scores(self, sess, x, y, inverse_hvp, num_total_train_example, feed_options=None):
+        """
+        The scores of a single training batch of up to batch_size samples.
+        :param x: training samples
+        :param y: training labels
+        :param inverse_hvp: flattened inverse HVP of a test point
+        :param num_total_train_example: normalization, as in darkon
+        :param feed_options: optional extra feed dict
+        :return: numpy array of len(x) scores
+        """
+        num_samples = len(x)
+        assert num_samples <= self.batch_size, 'a batch of {} > {} samples'.format(num_samples, self.batch_size)
+        if num_samples < self.batch_size:  # padding by repeating the first sample. The padded scores are dropped
+            pad = [0] * (self.batch_size - num_samples)
+            x = np.concatenate([x, np.asarray(x)[pad]])
+            y = np.concatenate([y, np.asarray(y)[pad]])
+        feed_dict = {self.x_placeholder: x, self.y_placeholder: y,
+                     self.v_ihvp: inverse_hvp, self.v_total_trainset: num_total_train_example}
+        if feed_options is not None:
+            feed_dict.update(feed_options)
+        return sess.run(self.scores_op, feed_dict=feed_dict)[:num_samples]
+
+    def scores(self, sess, feeder, inverse_hvp, train_iterations, feed_options=None):
+        """
+        The scores of the train_iterations * batch_size first training samples of the feeder, in the same order as
+        darkon's upweighting_influence_batch().
+        :param sess: TF session
+        :param feeder: feeder of the training set (train_batch() and reset())
+        :param inverse_hvp: flattened inverse HVP of a test point
+        :param train_iterations: number of training batches
+        :param feed_options: optional extra feed dict
+        :return: numpy array of the scores (float64)
+        """
+        num_total_train_example = train_iterations * self.batch_size
+        scores = np.zeros([num_total_train_example])
+        feeder.reset()
+        for it in range(train_iterations):
+            train_batch_data, train_batch_label = feeder.train_batch(self.batch_size)
+            start = it * self.batch_size
+            scores[start:start + len(train_batch_data)] = self.batch_scores(
+                sess, train_batch_data, train_batch_label, inverse_hvp, num_total_train_example, feed_options)
+        return scores
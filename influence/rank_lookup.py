@@ -0,0 +1,64 @@
+"""
+The nearest neighbor ranks of the training samples as an inverse-permutation rank table.
+
+NNIF only needs the rank (the location in the nearest neighbors list of the val/test sample) and the distance of its
+most helpful/harmful training samples, at every layer. Instead of fitting NearestNeighbors(n_neighbors=#train) and
+keeping the full [#samples, #layers, #train] neighbors indices and distances, a RankLookup keeps the (pooled) training
+features of a layer and answers a single query at a time: the distances to all the training samples are calculated in
+chunks of chunk_size rows and sorted with a stable argsort (ties are broken by the training index), which gives the
+nearest neighbors list of the query. The list is turned into a rank table (its inverse permutation: train index ->
+rank, uint16 for up to 65536 training samples), so the ranks of any number of training samples are a single
+fancy-indexing operation. The memory of a query is O(#train).
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import numpy as np
+
+CHUNK_SIZE = 8192
+
+
+def rank_table(neighbor_indices):
+    """
+    :param neighbor_indices: the training indices sorted from the nearest neighbor of a query (a permutation)
+    :return: its inverse permutation: the rank of every training index
+    """
+    num_train = len(neighbor_indices)
+    table = np.empty(num_train, dtype=np.uint16 if num_train <= (1 << 16) else np.int32)
+    table[np.asarray(neighbor_indices)] = np.arange(num_train, dtype=table.dtype)
+    return table
+
+
+class RankLookup(object):
+    def __init__(self, train_features, chunk_size=CHUNK_SIZE):
+        """
+        :param train_features: [#train, #features] features of the training samples (at a single layer)
+        :param chunk_size: number of training samples whose distances are calculated at a time
+        """
+        self.train_features = np.asarray(train_features, dtype=np.float32)
+        self.chunk_size     = chunk_size
+        assert self.train_features.ndim == 2, 'expecting [#train, #features] features, got shape {}' \
+            .format(self.train_features.shape)
+
+    def get_train_size(self):
+        return self.train_features.shape[0]
+
+    def distances(self, query):
+        """The L2 distances of a query [#features] to all the training samples"""
+        query = np.asarray(query, dtype=np.float32).reshape(-1)
+        dists = np.empty(self.get_train_size(), dtype=np.float32)
+        for start in range(0, self.get_train_size(), self.chunk_size):
+            diff = self.train_features[start:start + self.chunk_size] - query
+            dists[start:start + self.chunk_size] = np.sqrt(np.einsum('ij,ij->i', diff, diff))
+        return dists
+
+    def rank_table(self, query):
+        """
+        :param query: [#features] features of the val/test sample
+        :return: its distances to all the training samples, and their rank table (see rank_table())
+        """
+        dists = self.distances(query)
+        return dists, rank_table(np.argsort(dists, kind='mergesort'))
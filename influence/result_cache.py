@@ -0,0 +1,90 @@
+"""
+A content-addressed cache of the influence scores of val/test samples (--result_cache).
+
+The scores files of a sample are found by its global_index only, so they are reused after the checkpoint was retrained,
+the approx_params changed or the adversarial images were regenerated. Here the full scores of a sample are saved under
+the sha1 of everything they depend on:
+    the checkpoint weights (train_grad_cache.checkpoint_key of all the trainable variables),
+    the image bytes and the label of the sample (the predicted label of the pred/adv image),
+    the scores config: approx_params, inverse HVP solver, influence parameters, train subset and scoring method.
+The key does not hold the set, attack or index of the sample, so a cache hit is served for every set and attack that
+scores the same image (e.g. the pred scores of a val sample are shared by all the attacks). The cache is kept per model
+dir (<checkpoint_dir>/influence_result_cache/<key[:2]>/<key>.npy), and a key never points to stale scores.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import os
+import json
+import hashlib
+import numpy as np
+from NNIF_adv_defense.influence.score_files import atomic_write
+
+RESULT_CACHE_DIR = 'influence_result_cache'
+
+
+def config_key(config):
+    """
+    The sha1 of the scores config
+    :param config: json serializable dict of everything the scores depend on, except the checkpoint and the sample
+    """
+    return hashlib.sha1(json.dumps(config, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def train_subset_key(train_global_indices):
+    """The sha1 of the global indices of the training samples that are scored, in their order"""
+    return hashlib.sha1(np.asarray(train_global_indices, dtype=np.int64).tobytes()).hexdigest()
+
+
+class InfluenceResultCache(object):
+    def __init__(self, dir, checkpoint_key, config_key):
+        """
+        :param dir: the directory of the cache. Created if it does not exist
+        :param checkpoint_key: the hash of the checkpoint weights, see train_grad_cache.checkpoint_key()
+        :param config_key: see config_key()
+        """
+        self.dir            = dir
+        self.checkpoint_key = checkpoint_key
+        self.config_key     = config_key
+        if not os.path.exists(dir):
+            os.makedirs(dir)
+
+    def key(self, image, label):
+        """
+        :param image: the val/test image that is scored
+        :param label: the label of its test loss (one-hot or sparse)
+        :return: the key of its scores
+        """
+        image = np.ascontiguousarray(image, dtype=np.float32)
+        label = int(np.argmax(label)) if np.ndim(label) > 0 else int(label)
+        sha = hashlib.sha1(self.checkpoint_key.encode('utf-8'))
+        sha.update(self.config_key.encode('utf-8'))
+        sha.update(json.dumps({'shape': list(image.shape), 'label': label}).encode('utf-8'))
+        sha.update(image.tobytes())
+        return sha.hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.dir, key[:2], key + '.npy')
+
+    def contains(self, key):
+        return os.path.isfile(self.path(key))
+
+    def get(self, key):
+        """The scores of a key, or None on a miss (or if the file cannot be read)"""
+        try:
+            return np.load(self.path(key))
+        except (IOError, OSError, ValueError):
+            return None
+
+    def put(self, key, scores):
+        """Saving the full scores of a key, atomically"""
+        dir = os.path.dirname(self.path(key))
+        if not os.path.exists(dir):
+            try:
+                os.makedirs(dir)
+            except OSError:  # created concurrently by another thread or worker
+                pass
+        atomic_write(self.path(key), lambda path: np.save(path, scores))
@@ -0,0 +1,121 @@
+"""
+Reading and writing the influence scores of a single val/test sample.
+
+A sample's scores are saved in <model_dir>/<set>/<set>_index_<global_index>/{pred,adv/<attack>}/ as either:
+    scores.npy:       the full float64 score vector over all the training samples.
+    scores_topk.npz:  only the top_k most helpful and top_k most harmful training samples (int32 indices and float32
+                      scores, sorted from the most helpful/harmful). NNIF only uses these heads and tails of the ranking.
+The readers accept either format. The files are written atomically (to a temporary file that is renamed), so a
+killed run never leaves a truncated scores file behind.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import os
+import numpy as np
+
+INFLUENCE_PARAMS = ['all', 'last_layer']
+SCOPE_PREFIX = 'scope_'  # the scores of a parameter subset, see param_scope.scope_scores_name
+
+
+def scores_file_name(influence_params='all'):
+    """The file name of the full scores of a val/test sample, per --influence_params (and --influence_scope)"""
+    assert influence_params in INFLUENCE_PARAMS or influence_params.startswith(SCOPE_PREFIX), \
+        'influence_params {} is not supported'.format(influence_params)
+    if influence_params == 'all':
+        return 'scores.npy'
+    return 'scores_{}.npy'.format(influence_params)
+
+
+def topk_file_name(influence_params='all'):
+    """The file name of the top-k scores of a val/test sample, per --influence_params"""
+    return scores_file_name(influence_params).replace('.npy', '_topk.npz')
+
+
+def atomic_write(path, write_fn):
+    """
+    Writing a file atomically: write_fn(tmp_path) writes a temporary file in the same directory, which is synced to
+    disk and renamed to path.
+    :param path: the final path
+    :param write_fn: function of the path to write to. The temporary path keeps the extension of path
+    """
+    root, ext = os.path.splitext(path)
+    tmp_path = '{}.tmp{}{}'.format(root, os.getpid(), ext)
+    write_fn(tmp_path)
+    fd = os.open(tmp_path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+    os.rename(tmp_path, path)
+
+
+def scores_exist(dir, influence_params='all'):
+    return os.path.isfile(os.path.join(dir, scores_file_name(influence_params))) or \
+           os.path.isfile(os.path.join(dir, topk_file_name(influence_params)))
+
+
+def scores_complete(dir, influence_params='all'):
+    """True if the scores of a sample exist and can be read. A file truncated by a killed run cannot"""
+    scores_path = os.path.join(dir, scores_file_name(influence_params))
+    topk_path = os.path.join(dir, topk_file_name(influence_params))
+    try:
+        if os.path.isfile(scores_path):
+            np.load(scores_path, mmap_mode='r')  # checks that the file holds the whole array
+            return True
+        if os.path.isfile(topk_path):
+            with np.load(topk_path) as topk:
+                for key in topk.files:
+                    topk[key]
+            return True
+    except Exception:
+        pass
+    return False
+
+
+def save_scores(dir, scores, influence_params='all', top_k=0):
+    """
+    :param dir: the directory of the val/test sample and case
+    :param scores: the scores of all the training samples
+    :param influence_params: all or last_layer
+    :param top_k: if > 0, only the top_k most helpful/harmful training samples are saved
+    """
+    if top_k <= 0:
+        atomic_write(os.path.join(dir, scores_file_name(influence_params)), lambda path: np.save(path, scores))
+        return
+    helpful_indices, harmful_indices = helpful_harmful(scores, top_k)
+    atomic_write(os.path.join(dir, topk_file_name(influence_params)),
+                 lambda path: np.savez(path,
+                                       helpful_indices=helpful_indices.astype(np.int32),
+                                       helpful_scores=scores[helpful_indices].astype(np.float32),
+                                       harmful_indices=harmful_indices.astype(np.int32),
+                                       harmful_scores=scores[harmful_indices].astype(np.float32),
+                                       num_train=len(scores)))
+
+
+def helpful_harmful(scores, max_indices):
+    """The indices of the max_indices most helpful and most harmful training samples of a full scores vector"""
+    sorted_indices = np.argsort(scores)
+    return sorted_indices[-max_indices:][::-1], sorted_indices[:max_indices]
+
+
+def load_helpful_harmful(dir, max_indices, influence_params='all'):
+    """
+    :param dir: the directory of the val/test sample and case
+    :param max_indices: number of helpful/harmful training samples
+    :param influence_params: all or last_layer
+    :return: the indices of the max_indices most helpful and most harmful training samples, each sorted from the
+             most helpful/harmful
+    """
+    scores_path = os.path.join(dir, scores_file_name(influence_params))
+    if os.path.isfile(scores_path):
+        return helpful_harmful(np.load(scores_path), max_indices)
+
+    topk = np.load(os.path.join(dir, topk_file_name(influence_params)))
+    helpful_indices, harmful_indices = topk['helpful_indices'], topk['harmful_indices']
+    assert max_indices <= len(helpful_indices), \
+        'requested {} helpful/harmful indices but {} holds only {}'.format(max_indices, dir, len(helpful_indices))
+    return helpful_indices[:max_indices], harmful_indices[:max_indices]
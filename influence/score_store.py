@@ -0,0 +1,99 @@
+"""
+A consolidated store of the influence scores of all the val/test samples of a (set, case, attack), replacing the
+per-index <set>_index_<global_index>/{pred,adv/<attack>}/scores.npy directories.
+
+The store is a directory <model_dir>/<set>/score_store/<pred|adv_<attack>>[_<influence_params>] with:
+    scores.npy: a preallocated [num_samples, num_train] float64 matrix. Row i holds the scores of the i-th sample of the
+                val/test set (the sub index, as in info.pkl).
+    done.npy:   a [num_samples] uint8 completion map. A row is marked done only after it was flushed.
+Both are opened as memory maps, so the writers (threads or worker processes) write their own rows concurrently and
+the readers slice rows without copying or opening thousands of files.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import os
+import numpy as np
+
+STORE_DIR = 'score_store'
+
+
+def store_dir(model_dir, set, case, attack, influence_params='all'):
+    """The directory of the score store of a (set, case, attack). The pred scores do not depend on the attack"""
+    name = 'pred' if case == 'pred' else 'adv_' + attack
+    if influence_params != 'all':
+        name += '_' + influence_params
+    return os.path.join(model_dir, set, STORE_DIR, name)
+
+
+class ScoreStore(object):
+    def __init__(self, dir):
+        """
+        :param dir: the directory of the store (see store_dir())
+        """
+        self.dir         = dir
+        self.scores_path = os.path.join(dir, 'scores.npy')
+        self.done_path   = os.path.join(dir, 'done.npy')
+        self.scores      = None
+        self.done        = None
+
+    def exists(self):
+        return os.path.isfile(self.scores_path) and os.path.isfile(self.done_path)
+
+    def create(self, num_samples, num_train):
+        """
+        Preallocating an empty store, if it does not exist. Call it once, before any writer opens the store.
+        :param num_samples: number of val/test samples (rows)
+        :param num_train: number of training samples (columns)
+        """
+        if self.exists():
+            shape = np.load(self.scores_path, mmap_mode='r').shape
+            assert shape == (num_samples, num_train), \
+                'score store {} has shape {}, expected {}'.format(self.dir, shape, (num_samples, num_train))
+            return
+        if not os.path.exists(self.dir):
+            os.makedirs(self.dir)
+        for path, dtype, shape in [(self.scores_path, np.float64, (num_samples, num_train)),
+                                   (self.done_path  , np.uint8  , (num_samples,))]:
+            tmp_path = path + '.tmp.npy'
+            array = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=dtype, shape=shape)
+            array.flush()
+            del array
+            os.rename(tmp_path, path)
+        print('created score store {} of {} samples x {} train samples'.format(self.dir, num_samples, num_train))
+
+    def open(self, writable=False):
+        assert self.exists(), 'score store {} does not exist'.format(self.dir)
+        mode = 'r+' if writable else 'r'
+        self.scores = np.load(self.scores_path, mmap_mode=mode)
+        self.done   = np.load(self.done_path, mmap_mode=mode)
+        return self
+
+    def _ensure_open(self):
+        if self.scores is None:
+            self.open()
+
+    def is_done(self, sub_index):
+        self._ensure_open()
+        return bool(self.done[sub_index])
+
+    def num_done(self):
+        self._ensure_open()
+        return int(np.count_nonzero(self.done))
+
+    def write(self, sub_index, scores):
+        """Writing the scores of a single sample. Different rows can be written concurrently"""
+        assert self.scores is not None and self.scores.mode == 'r+', 'open the store with writable=True first'
+        self.scores[sub_index] = scores
+        self.scores.flush()
+        self.done[sub_index] = 1
+        self.done.flush()
+
+    def row(self, sub_index):
+        """The scores of a single sample (a view of the memory map)"""
+        self._ensure_open()
+        assert self.done[sub_index], 'sub index {} is missing in score store {}'.format(sub_index, self.dir)
+        return self.scores[sub_index]
@@ -0,0 +1,260 @@
+"""
+Process-pool backend for calc_scores.py.
+
+Every worker process owns its own TF graph and session, restricted to a few intra-op threads, and scores the
+(val/test sample, case) items it claims from the work ledger (see work_ledger.py). The dataset arrays are not copied
+into the workers; the parent dumps them once to .npy files and every worker opens them as read-only memory maps
+(shared via the page cache).
+
+The workers are forked when the pool is constructed, so construct it before the parent process creates its own TF
+session. The workers then block until run() sends them the job specification.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import os
+import time
+import logging
+import multiprocessing
+import numpy as np
+from NNIF_adv_defense.influence.train_grad_cache import TrainGradientCache
+from NNIF_adv_defense.influence.score_files import save_scores, atomic_write
+from NNIF_adv_defense.influence.score_store import ScoreStore
+from NNIF_adv_defense.influence.result_cache import InfluenceResultCache
+from NNIF_adv_defense.influence.work_ledger import WorkLedger, owner_name
+
+SHARED_ARRAYS = ['X_train', 'y_train', 'X_pred', 'y_pred', 'X_adv', 'y_adv']
+
+
+def save_shared_arrays(shared_dir, arrays):
+    """
+    Dumping the arrays used by the workers to shared_dir/<name>.npy
+    :param shared_dir: directory of the shared arrays. Private to a run, see calc_scores.py
+    :param arrays: dict of name -> numpy array. Must contain all of SHARED_ARRAYS
+    """
+    if not os.path.exists(shared_dir):
+        os.makedirs(shared_dir)
+    for name in SHARED_ARRAYS:
+        array = np.asarray(arrays[name], dtype=np.float32)
+        # atomic, so a worker that memory-maps an existing file never sees it truncated
+        atomic_write(os.path.join(shared_dir, name + '.npy'), lambda path: np.save(path, array))
+
+
+def load_shared_arrays(shared_dir):
+    """Opening the shared arrays as read-only memory maps"""
+    return {name: np.load(os.path.join(shared_dir, name + '.npy'), mmap_mode='r') for name in SHARED_ARRAYS}
+
+
+def scores_dir(model_dir, set, global_index, case, attack):
+    """The directory of the scores of a val/test sample"""
+    dir = os.path.join(model_dir, set, set + '_index_{}'.format(global_index), case)
+    if case == 'adv':
+        dir = os.path.join(dir, attack)
+    return dir
+
+
+def _build_inspectors(spec, threads_per_process):
+    """Building a private graph, session, the pred/adv inspectors and the per-example scorer (if used) of a worker"""
+    # the graph and session are created here, after the fork, so every worker has its own TF runtime
+    import tensorflow as tf
+    from cleverhans.loss import CrossEntropy, WeightDecay, WeightedSum
+    from NNIF_adv_defense.models.darkon_resnet34_model import DarkonReplica
+    from NNIF_adv_defense.datasets.influence_feeder import MyFeederSharedArrays
+    from NNIF_adv_defense.influence.nnif_influence import NNIFInfluence
+    from NNIF_adv_defense.influence.ihvp_solvers import make_solver
+    from NNIF_adv_defense.influence.per_example_grads import PerExampleScorer
+    from NNIF_adv_defense.influence.param_scope import scope_variables
+
+    arrays = load_shared_arrays(spec['shared_dir'])
+    img_rows, img_cols, nchannels = arrays['X_train'].shape[1:4]
+    nb_classes = arrays['y_train'].shape[1]
+
+    graph = tf.Graph()
+    with graph.as_default():
+        tf.set_random_seed(spec['seed'])
+        x = tf.placeholder(tf.float32, shape=(None, img_rows, img_cols, nchannels), name='x')
+        y = tf.placeholder(tf.float32, shape=(None, nb_classes), name='y')
+
+        model = DarkonReplica(scope=spec['arch_name'], nb_classes=nb_classes, n=5, input_shape=[32, 32, 3])
+        loss = CrossEntropy(model, smoothing=spec['label_smoothing'])
+        regu_losses = WeightDecay(model)
+        full_loss = WeightedSum(model, [(1.0, loss), (spec['weight_decay'], regu_losses)])
+
+        config = tf.ConfigProto(allow_soft_placement=True,
+                                intra_op_parallelism_threads=threads_per_process,
+                                inter_op_parallelism_threads=1)
+        sess = tf.Session(graph=graph, config=config)
+        saver = tf.train.Saver()
+        saver.restore(sess, spec['checkpoint_path'])
+
+        ihvp_solver = make_solver(**spec['ihvp_solver'])
+        feeders = {case: MyFeederSharedArrays(arrays['X_train'], arrays['y_train'],
+                                              arrays['X_' + case], arrays['y_' + case]) for case in ['pred', 'adv']}
+        inspectors = {'pred': NNIFInfluence(
+            workspace=spec['workspaces']['pred'],
+            feeder=feeders['pred'],
+            loss_op_train=full_loss.fprop(x=x, y=y),
+            loss_op_test=loss.fprop(x=x, y=y),
+            x_placeholder=x,
+            y_placeholder=y,
+            solver=ihvp_solver,
+            trainable_variables=scope_variables(tf.get_collection(tf.GraphKeys.TRAINABLE_VARIABLES) +
+                                                tf.get_collection(tf.GraphKeys.TRAINABLE_RESOURCE_VARIABLES),
+                                                spec['influence_scope']),
+            ihvp_store_dtype=spec['ihvp_store_dtype'])}
+        # the adv inspector shares the loss, gradient and HVP ops of the pred inspector
+        inspectors['adv'] = inspectors['pred'].clone(workspace=spec['workspaces']['adv'], feeder=feeders['adv'])
+        per_example_scorer = None
+        if spec['per_example_grads'] != '' and spec['train_grad_cache'] is None:
+            per_example_scorer = PerExampleScorer(lambda xx, yy: full_loss.fprop(x=xx, y=yy), x, y,
+                                                  inspectors['pred'].trainable_variables, spec['train_batch_size'],
+                                                  spec['per_example_grads'])
+    graph.finalize()
+    return sess, inspectors, per_example_scorer
+
+
+def save_image(dir, image):
+    """Saving the image of a val/test sample next to its scores"""
+    import imageio
+    atomic_write(os.path.join(dir, 'image.png'), lambda path: imageio.imwrite(path, image))
+    atomic_write(os.path.join(dir, 'image.npy'), lambda path: np.save(path, image))
+
+
+def _score_item(sess, inspectors, train_grad_cache, per_example_scorer, score_stores, result_cache, spec, sub_index,
+                global_index, case):
+    """Calculating and saving the scores (and image) of a single val/test sample and case"""
+    insp = inspectors[case]
+    key    = None
+    scores = None
+    if result_cache is not None:
+        image, label = insp.feeder.test_indices(sub_index)
+        key    = result_cache.key(image, label)
+        scores = result_cache.get(key)
+        if scores is not None:
+            print('scores of global_index: {} (sub: {}), case: {} are served from the result cache'
+                  .format(global_index, sub_index, case))
+    if scores is None:
+        start_time = time.time()
+        if train_grad_cache is not None:
+            scores = insp.upweighting_influence_cached(
+                sess=sess,
+                test_indices=[sub_index],
+                test_batch_size=spec['testset_batch_size'],
+                approx_params=spec['approx_params'],
+                train_grad_cache=train_grad_cache)
+        elif per_example_scorer is not None:
+            scores = insp.upweighting_influence_vectorized(
+                sess=sess,
+                test_indices=[sub_index],
+                test_batch_size=spec['testset_batch_size'],
+                approx_params=spec['approx_params'],
+                scorer=per_example_scorer,
+                train_iterations=spec['train_iterations'])
+        else:
+            scores = insp.upweighting_influence_batch(
+                sess=sess,
+                test_indices=[sub_index],
+                test_batch_size=spec['testset_batch_size'],
+                approx_params=spec['approx_params'],
+                train_batch_size=spec['train_batch_size'],
+                train_iterations=spec['train_iterations'])
+        print('scores calculation time: {} secs. pid: {}, global_index: {} (sub: {}), case: {}'
+              .format(time.time() - start_time, os.getpid(), global_index, sub_index, case))
+        if result_cache is not None:
+            result_cache.put(key, scores)
+
+    if score_stores is not None:
+        score_stores[case].write(sub_index, scores)
+    else:
+        dir = scores_dir(spec['model_dir'], spec['set'], global_index, case, spec['attack'])
+        if not os.path.exists(dir):
+            os.makedirs(dir)
+        image, _ = insp.feeder.test_indices(sub_index)
+        save_image(dir, image)  # before the scores, which mark the sample as complete
+        save_scores(dir, scores, spec['scores_name'], spec['scores_top_k'])
+
+
+def _worker_loop(worker_id, threads_per_process, spec_queue):
+    spec = spec_queue.get()
+    if spec is None:  # the pool was closed without running
+        return
+    sess, inspectors, per_example_scorer = _build_inspectors(spec, threads_per_process)
+    train_grad_cache = None
+    if spec['train_grad_cache'] is not None:
+        train_grad_cache = TrainGradientCache(**spec['train_grad_cache'])
+    score_stores = None
+    if spec['score_store'] is not None:  # created by the parent, every worker writes its own rows
+        score_stores = {case: ScoreStore(dir).open(writable=True) for case, dir in spec['score_store'].items()}
+    result_cache = None
+    if spec['result_cache'] is not None:  # keyed by the parent, see result_cache.py
+        result_cache = InfluenceResultCache(**spec['result_cache'])
+    ledger = WorkLedger(**spec['ledger'])
+    owner = owner_name(worker_id)
+    print('worker {} (pid {}) is ready'.format(worker_id, os.getpid()))
+
+    while True:
+        item = ledger.claim(owner)
+        if item is None:
+            break
+        sub_index, case = item
+        global_index = None
+        try:
+            global_index = spec['global_indices'][sub_index]
+            _score_item(sess, inspectors, train_grad_cache, per_example_scorer, score_stores, result_cache, spec,
+                        sub_index, global_index, case)
+            ledger.done(sub_index, case)
+        except Exception as e:
+            logging.exception('worker {} failed for sub_index={} (global_index={}), case: {}'
+                              .format(worker_id, sub_index, global_index, case))
+            ledger.fail(sub_index, case, str(e))
+    sess.close()
+
+
+class ScoreWorkerPool(object):
+    def __init__(self, num_processes, threads_per_process=1):
+        """
+        Forking the worker processes. Must be called before the parent creates a TF session.
+        :param num_processes: number of worker processes, each with its own TF graph and session
+        :param threads_per_process: intra-op threads of every worker session
+        """
+        self.num_processes = num_processes
+        self.spec_queue    = multiprocessing.Queue()
+        self.workers       = []
+        for worker_id in range(num_processes):
+            worker = multiprocessing.Process(
+                target=_worker_loop,
+                args=(worker_id, threads_per_process, self.spec_queue))
+            worker.daemon = True
+            worker.start()
+            self.workers.append(worker)
+
+    def run(self, spec):
+        """
+        Scoring all the items of the work ledger and waiting for the workers to finish. The workers claim the items
+        from the ledger themselves; the claims of workers that died are released for the next run, and the run raises
+        if any worker exited with an error.
+        :param spec: dict with the job specification (paths, model and darkon parameters). See calc_scores.py
+        """
+        for _ in self.workers:
+            self.spec_queue.put(spec)
+        failed_workers = 0
+        for worker in self.workers:
+            worker.join()
+            if worker.exitcode != 0:
+                print('score worker (pid {}) exited with code {}'.format(worker.pid, worker.exitcode))
+                failed_workers += 1
+        ledger = WorkLedger(**spec['ledger'])
+        ledger.release_dead_claims()
+        if failed_workers > 0:
+            raise AssertionError('{} of {} score workers exited with an error (work ledger: {}). Run again to score '
+                                 'the remaining items'.format(failed_workers, len(self.workers), ledger.summary()))
+
+    def close(self):
+        """Releasing idle workers without running any task"""
+        for _ in self.workers:
+            self.spec_queue.put(None)
+        for worker in self.workers:
+            worker.join()
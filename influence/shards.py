@@ -0,0 +1,84 @@
+"""
+Selecting and partitioning the val/test samples of calc_hvp.py, calc_scores.py and attack.py.
+
+The samples are first selected by --selection, from the net_succ/attack_succ fields of info.pkl:
+    all:                       every sample of the set
+    net_succ:                  the samples the network classified correctly. These are the only samples that
+                               extract_characteristics.py reads
+    net_succ_and_attack_succ:  the correctly classified samples whose attack also succeeded
+Every script then runs only on its shard of the selected sub indices (sub_relevant_indices):
+    --num_shards N --shard_id k:  the sorted sub indices k, k+N, k+2N, ... (round-robin, so every shard gets a similar
+                                  mix of easy and hard samples)
+    --shard_index_file <path>:    an explicit list of sub indices, one index or an inclusive range "<first>-<last>" per
+                                  line. Empty lines and lines starting with # are ignored.
+After all the shards finished, merge_shards.py merges and verifies their outputs.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import os
+
+
+SELECTION_POLICIES = ['all', 'net_succ', 'net_succ_and_attack_succ']
+
+
+def select_indices(set_info, selection='all'):
+    """
+    :param set_info: info[set] of info.pkl: sub_index -> {global_index, net_succ, attack_succ}
+    :param selection: one of SELECTION_POLICIES
+    :return: the selected sub indices, sorted
+    """
+    assert selection in SELECTION_POLICIES, 'selection {} is not supported'.format(selection)
+    sub_indices = sorted(set_info)
+    if selection == 'net_succ':
+        return [ind for ind in sub_indices if set_info[ind]['net_succ']]
+    if selection == 'net_succ_and_attack_succ':
+        return [ind for ind in sub_indices if set_info[ind]['net_succ'] and set_info[ind]['attack_succ']]
+    return sub_indices
+
+
+def read_index_file(path):
+    """Reading the sub indices of a shard index file"""
+    indices = []
+    with open(path, 'r') as f:
+        for line in f:
+            line = line.strip()
+            if line == '' or line.startswith('#'):
+                continue
+            if '-' in line:
+                first, last = line.split('-')
+                indices.extend(range(int(first), int(last) + 1))
+            else:
+                indices.append(int(line))
+    return indices
+
+
+def shard_indices(sub_indices, num_shards=1, shard_id=0, index_file=''):
+    """
+    :param sub_indices: all the (selected) sub indices of the set
+    :param num_shards: number of shards
+    :param shard_id: the shard to return, in [0, num_shards)
+    :param index_file: if given, the shard is the sub indices listed in this file (num_shards/shard_id are ignored)
+    :return: the sub indices of the shard, sorted
+    """
+    if index_file != '':
+        listed = set(read_index_file(index_file))
+        unknown = listed.difference(sub_indices)
+        assert len(unknown) == 0, 'shard index file {} has {} unknown sub indices, e.g. {}'\
+            .format(index_file, len(unknown), sorted(unknown)[:10])
+        return sorted(listed)
+    assert num_shards > 0, 'num_shards must be positive'
+    assert 0 <= shard_id < num_shards, 'shard_id must be in [0, {})'.format(num_shards)
+    return sorted(sub_indices)[shard_id::num_shards]
+
+
+def shard_suffix(num_shards=1, shard_id=0, index_file=''):
+    """The suffix of the per-shard outputs (work ledger, score store). Empty for an unsharded run"""
+    if index_file != '':
+        return '_shard_' + os.path.splitext(os.path.basename(index_file))[0]
+    if num_shards == 1:
+        return ''
+    return '_shard{}of{}'.format(shard_id, num_shards)
@@ -0,0 +1,43 @@
+"""
+Random projections (sketches) of the DarkonReplica parameter space.
+
+The NNIF features only need the ranking of the most helpful/harmful training samples, so the scores
+grad_train . inverse_hvp can be estimated in a low dimensional space. A CountSketch is a sparse random matrix with a
+single +-1 entry per parameter, so projecting a vector costs O(#params) and the matrix itself is never stored.
+For any two vectors a, b: E[<S a, S b>] = <a, b>, with a variance that decreases linearly with the sketch dimension.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import numpy as np
+
+SKETCH_SEED = 123456789
+
+
+class CountSketch(object):
+    def __init__(self, num_params, dim, seed=SKETCH_SEED):
+        """
+        :param num_params: dimension of the original (flattened parameters) space
+        :param dim: dimension of the projected space
+        :param seed: seed of the random matrix. Every vector compared in the projected space must use the same seed
+        """
+        self.num_params = num_params
+        self.dim        = dim
+        self.seed       = seed
+
+        rand_gen = np.random.RandomState(seed)
+        self.buckets = rand_gen.randint(0, dim, size=num_params)
+        self.signs   = rand_gen.choice([-1.0, 1.0], size=num_params)
+
+    def project(self, vector):
+        """
+        :param vector: numpy array of size num_params
+        :return: float32 numpy array of size dim
+        """
+        vector = np.asarray(vector, dtype=np.float64).reshape(-1)
+        assert vector.shape == (self.num_params,), \
+            'expecting a vector of {} params but got {}'.format(self.num_params, vector.shape)
+        return np.bincount(self.buckets, weights=self.signs * vector, minlength=self.dim).astype(np.float32)
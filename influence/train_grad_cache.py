@@ -0,0 +1,176 @@
+"""
+A persistent cache of the per-training-sample gradients of the training loss.
+
+The gradient of every training sample does not depend on the val/test point, yet darkon's
+upweighting_influence_batch() recomputes all of them for every val/test sample. Here they are computed once per
+checkpoint and saved as a [num_train, num_params] memory mapped .npy file. The I_up_loss scores of a test point are
+then a single matrix-vector product of this matrix with the test point's inverse HVP.
+With sketch_dim > 0 every gradient is stored projected to sketch_dim dimensions (see sketch.py), and the inverse HVP
+is projected the same way before the product, which gives an estimate of the scores at a fraction of the cost.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import os
+import json
+import hashlib
+import numpy as np
+from tqdm import tqdm
+from NNIF_adv_defense.influence.sketch import CountSketch, SKETCH_SEED
+
+SUPPORTED_DTYPES = ['float32', 'float16']
+
+
+def checkpoint_key(sess, variables):
+    """A short hash of the variables values, identifying the checkpoint loaded in sess"""
+    sha = hashlib.sha1()
+    for a in sess.run(variables):
+        sha.update(np.ascontiguousarray(a).data)
+    return sha.hexdigest()[:16]
+
+
+class TrainGradientCache(object):
+    def __init__(self, path, num_train, num_params, dtype='float32', sketch_dim=0, sketch_seed=SKETCH_SEED):
+        """
+        :param path: path of the .npy file holding the [num_train, num_columns] gradients matrix
+        :param num_train: number of training samples (rows)
+        :param num_params: number of parameters
+        :param dtype: storage dtype of the gradients, float32 or float16
+        :param sketch_dim: if > 0, the gradients are stored projected to sketch_dim dimensions
+        :param sketch_seed: seed of the projection
+        """
+        assert dtype in SUPPORTED_DTYPES, 'dtype {} is not supported'.format(dtype)
+        self.path        = path
+        self.meta_path   = path + '.json'
+        self.num_train   = num_train
+        self.num_params  = num_params
+        self.dtype       = dtype
+        self.sketch_dim  = sketch_dim
+        self.sketch_seed = sketch_seed
+        self.grads       = None
+
+        if sketch_dim > 0:
+            self.projection  = CountSketch(num_params, sketch_dim, sketch_seed)
+            self.num_columns = sketch_dim
+        else:
+            self.projection  = None
+            self.num_columns = num_params
+
+    @classmethod
+    def for_checkpoint(cls, cache_dir, sess, variables, train_set, num_train, dtype='float32', sketch_dim=0):
+        """
+        The cache file of the checkpoint currently loaded in sess.
+        :param cache_dir: directory of all the gradients caches of a model (e.g. <model_dir>/train_grad_cache)
+        :param sess: TF session with the loaded checkpoint
+        :param variables: the variables the gradients are taken w.r.t.
+        :param train_set: 'train' or 'train_mini'
+        :param num_train: number of training samples
+        :param dtype: storage dtype
+        :param sketch_dim: if > 0, the dimension of the projected gradients
+        """
+        num_params = int(sum(np.prod(v.get_shape().as_list()) for v in variables))
+        file_name = '{}_{}_{}'.format(checkpoint_key(sess, variables), train_set, dtype)
+        if sketch_dim > 0:
+            file_name += '_sketch_{}_seed_{}'.format(sketch_dim, SKETCH_SEED)
+        return cls(os.path.join(cache_dir, file_name + '.npy'), num_train, num_params, dtype, sketch_dim)
+
+    def _read_meta(self):
+        if not os.path.isfile(self.meta_path):
+            return {'rows_done': 0}
+        with open(self.meta_path, 'r') as f:
+            return json.load(f)
+
+    def _write_meta(self, rows_done):
+        tmp_path = self.meta_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump({'rows_done': rows_done, 'num_train': self.num_train, 'num_params': self.num_params,
+                       'dtype': self.dtype, 'sketch_dim': self.sketch_dim, 'sketch_seed': self.sketch_seed}, f)
+        os.rename(tmp_path, self.meta_path)
+
+    def is_complete(self):
+        return os.path.isfile(self.path) and self._read_meta()['rows_done'] == self.num_train
+
+    def build(self, sess, grad_op, x_placeholder, y_placeholder, feeder, train_batch_size, feed_options=None):
+        """
+        Calculating the per-training-sample gradients, one sample at a time exactly as darkon does (the batch norm
+        statistics are of a batch of a single sample). Resumes a partially built cache.
+        :param sess: TF session
+        :param grad_op: list of gradient tensors of the training loss w.r.t. the variables
+        :param x_placeholder: input placeholder
+        :param y_placeholder: label placeholder
+        :param feeder: feeder of the training set (train_batch() and reset())
+        :param train_batch_size: number of samples read from the feeder at once
+        :param feed_options: optional extra feed dict
+        """
+        if self.is_complete():
+            print('train gradients cache {} is complete'.format(self.path))
+            return
+
+        cache_dir = os.path.dirname(self.path)
+        if cache_dir != '' and not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+        rows_done = self._read_meta()['rows_done']
+        if rows_done == 0 or not os.path.isfile(self.path):
+            rows_done = 0
+            grads = np.lib.format.open_memmap(self.path, mode='w+', dtype=self.dtype,
+                                              shape=(self.num_train, self.num_columns))
+        else:
+            print('resuming train gradients cache {} from row {}'.format(self.path, rows_done))
+            grads = np.load(self.path, mmap_mode='r+')
+
+        feeder.reset()
+        num_iters = int(np.ceil(self.num_train / train_batch_size))
+        for _ in tqdm(range(num_iters), desc='Train gradients cache'):
+            start = feeder.train_batch_offset
+            train_batch_data, train_batch_label = feeder.train_batch(train_batch_size)
+            end = start + len(train_batch_data)
+            if end <= rows_done:
+                continue
+            for row in range(max(start, rows_done), end):
+                feed_dict = {x_placeholder: train_batch_data[row - start:row - start + 1],
+                             y_placeholder: train_batch_label[row - start:row - start + 1]}
+                if feed_options is not None:
+                    feed_dict.update(feed_options)
+                grad = sess.run(grad_op, feed_dict=feed_dict)
+                grad = np.concatenate([a.reshape(-1) for a in grad])
+                if self.projection is not None:
+                    grad = self.projection.project(grad)
+                grads[row] = grad
+            grads.flush()
+            rows_done = end
+            self._write_meta(rows_done)
+        feeder.reset()
+        del grads
+
+    def load(self):
+        """Opening the complete cache as a read-only memory map"""
+        assert self.is_complete(), 'train gradients cache {} is not complete'.format(self.path)
+        if self.grads is None:
+            self.grads = np.load(self.path, mmap_mode='r')
+        return self.grads
+
+    def dot(self, vector, num_total_train_example=None, chunk_size=200):
+        """
+        The I_up_loss scores of all the training samples: (grads / num_total_train_example) . vector
+        :param vector: flattened inverse HVP of a test point (of size num_params, also when sketched)
+        :param num_total_train_example: normalization, as in darkon. Defaults to the number of training samples
+        :param chunk_size: number of rows multiplied at a time (bounds the memory of the float64 copy of the rows)
+        :return: numpy array of size num_train (float64, as darkon's scores). The products are calculated in float64,
+                 the cached gradients themselves are float32/float16 (and the sketched vector float32)
+        """
+        grads = self.load()
+        if num_total_train_example is None:
+            num_total_train_example = self.num_train
+        vector = np.asarray(vector, dtype=np.float64)
+        assert vector.shape == (self.num_params,), \
+            'expecting a vector of {} params but got {}'.format(self.num_params, vector.shape)
+        if self.projection is not None:
+            vector = np.asarray(self.projection.project(vector), dtype=np.float64)
+        scores = np.zeros([self.num_train])
+        for start in range(0, self.num_train, chunk_size):
+            end = min(start + chunk_size, self.num_train)
+            scores[start:end] = np.asarray(grads[start:end], dtype=np.float64).dot(vector)
+        return scores / num_total_train_example
@@ -0,0 +1,195 @@
+"""
+A durable ledger of the work items of calc_scores.py, one item per (sub_index, case), kept in a small SQLite database.
+
+Every item is pending, claimed (by a thread or worker process of a running job), done or failed. Claiming an item is a
+single transaction, so the threads and processes of a job never score the same item twice, and an item is marked done
+only after its scores were written atomically (see score_files.atomic_write). A run that is killed therefore never
+leaves an item that looks done but is not. On restart, the claims of dead processes are turned into failures, and
+failed items are retried until they used max_attempts attempts.
+
+A ledger serves a single host: claims made on other hosts are never released.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import os
+import errno
+import time
+import socket
+import sqlite3
+import contextlib
+
+PENDING = 'pending'
+CLAIMED = 'claimed'
+DONE    = 'done'
+FAILED  = 'failed'
+
+
+def owner_name(thread_id=0):
+    """The owner of the claims of a thread: <host>:<pid>:<thread_id>"""
+    return '{}:{}:{}'.format(socket.gethostname(), os.getpid(), thread_id)
+
+
+def _owner_alive(owner):
+    host, pid, _ = owner.rsplit(':', 2)
+    if host != socket.gethostname():
+        return True  # cannot tell, keep the claim
+    if int(pid) == os.getpid():
+        return False  # a claim of a previous run whose pid was reused by this process
+    try:
+        os.kill(int(pid), 0)
+    except OSError as e:
+        return e.errno == errno.EPERM
+    return True
+
+
+class WorkLedger(object):
+    def __init__(self, path, max_attempts=3):
+        """
+        :param path: path of the SQLite database. Created if it does not exist
+        :param max_attempts: number of times an item is claimed before it is given up
+        """
+        assert max_attempts > 0, 'max_attempts must be positive'
+        self.path = path
+        self.max_attempts = max_attempts
+        dir = os.path.dirname(path)
+        if dir != '' and not os.path.exists(dir):
+            os.makedirs(dir)
+        with self._transaction() as conn:
+            conn.execute('CREATE TABLE IF NOT EXISTS items ('
+                         'sub_index INTEGER NOT NULL, case_name TEXT NOT NULL, state TEXT NOT NULL, '
+                         'attempts INTEGER NOT NULL, owner TEXT, error TEXT, updated REAL, '
+                         'PRIMARY KEY (sub_index, case_name))')
+
+    @contextlib.contextmanager
+    def _transaction(self):
+        """A write transaction on a fresh connection. Connections are never shared between threads or processes"""
+        conn = sqlite3.connect(self.path, timeout=600, isolation_level=None)
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                yield conn
+            except Exception:
+                conn.execute('ROLLBACK')
+                raise
+            conn.execute('COMMIT')
+        finally:
+            conn.close()
+
+    def _set_state(self, conn, sub_index, case, state, owner=None, error=None):
+        conn.execute('UPDATE items SET state = ?, owner = ?, error = ?, updated = ? WHERE sub_index = ? AND case_name = ?',
+                     (state, owner, error, time.time(), int(sub_index), case))
+
+    def register(self, items):
+        """
+        Adding new items as pending. Items that are already in the ledger keep their state, and items that are not
+        in items (e.g. left by a run with another --selection) are removed, unless a running process claimed them.
+        Their scores on disk are kept, and reconcile() marks them done if they are registered again.
+        :param items: list of (sub_index, case)
+        """
+        items = set((int(sub_index), case) for sub_index, case in items)
+        with self._transaction() as conn:
+            rows = conn.execute('SELECT sub_index, case_name, state, owner FROM items').fetchall()
+            stale = [(sub_index, case) for sub_index, case, state, owner in rows
+                     if (sub_index, case) not in items and (state != CLAIMED or not _owner_alive(owner))]
+            conn.executemany('DELETE FROM items WHERE sub_index = ? AND case_name = ?', stale)
+            conn.executemany('INSERT OR IGNORE INTO items (sub_index, case_name, state, attempts, updated) '
+                             'VALUES (?, ?, ?, 0, ?)',
+                             [(sub_index, case, PENDING, time.time()) for sub_index, case in sorted(items)])
+        if len(stale) > 0:
+            print('removed {} items that are not in this run from the work ledger {}'.format(len(stale), self.path))
+
+    def release_dead_claims(self):
+        """Turning the claims of dead processes into failures, so they are retried. Returns the number of claims"""
+        with self._transaction() as conn:
+            rows = conn.execute('SELECT sub_index, case_name, owner FROM items WHERE state = ?', (CLAIMED,)).fetchall()
+            dead = [(sub_index, case) for sub_index, case, owner in rows if not _owner_alive(owner)]
+            for sub_index, case in dead:
+                self._set_state(conn, sub_index, case, FAILED, error='interrupted')
+        return len(dead)
+
+    def reconcile(self, is_complete):
+        """
+        Syncing the ledger with the outputs on disk. Call once before claiming any item.
+        Items that were never attempted but have complete outputs (e.g. from runs before the ledger existed) are marked
+        done, and done items whose outputs are gone are scored again.
+        :param is_complete: function (sub_index, case) -> True if the item has complete scores on disk
+        """
+        self.release_dead_claims()
+        with self._transaction() as conn:
+            rows = conn.execute('SELECT sub_index, case_name, state, attempts FROM items '
+                                'WHERE state = ? OR (state = ? AND attempts = 0)', (DONE, PENDING)).fetchall()
+        updates = []
+        for sub_index, case, state, attempts in rows:
+            complete = is_complete(sub_index, case)
+            if state == DONE and not complete:
+                updates.append((sub_index, case, PENDING, 'scores are missing'))
+            elif state == PENDING and complete:
+                updates.append((sub_index, case, DONE, None))
+        with self._transaction() as conn:
+            for sub_index, case, state, error in updates:
+                self._set_state(conn, sub_index, case, state, error=error)
+
+    def claim(self, owner):
+        """
+        Claiming the next item: pending items first (by sub_index, pred before adv), then failed items that have
+        attempts left.
+        :param owner: the claiming thread, see owner_name()
+        :return: (sub_index, case), or None if there is nothing left to do
+        """
+        with self._transaction() as conn:
+            row = conn.execute('SELECT sub_index, case_name FROM items WHERE state = ? OR (state = ? AND attempts < ?) '
+                               'ORDER BY state = ?, sub_index, case_name DESC LIMIT 1',
+                               (PENDING, FAILED, self.max_attempts, FAILED)).fetchone()
+            if row is None:
+                return None
+            sub_index, case = row
+            conn.execute('UPDATE items SET state = ?, attempts = attempts + 1, owner = ?, updated = ? '
+                         'WHERE sub_index = ? AND case_name = ?', (CLAIMED, owner, time.time(), sub_index, case))
+        return int(sub_index), str(case)
+
+    def claim_item(self, sub_index, case, owner):
+        """
+        Claiming a specific item, if it is pending or failed with attempts left.
+        :return: True if the item was claimed by owner
+        """
+        with self._transaction() as conn:
+            cursor = conn.execute('UPDATE items SET state = ?, attempts = attempts + 1, owner = ?, updated = ? '
+                                  'WHERE sub_index = ? AND case_name = ? '
+                                  'AND (state = ? OR (state = ? AND attempts < ?))',
+                                  (CLAIMED, owner, time.time(), int(sub_index), case, PENDING, FAILED,
+                                   self.max_attempts))
+            return cursor.rowcount == 1
+
+    def state(self, sub_index, case):
+        with self._transaction() as conn:
+            row = conn.execute('SELECT state FROM items WHERE sub_index = ? AND case_name = ?',
+                               (int(sub_index), case)).fetchone()
+        assert row is not None, 'sub_index={}, case: {} is not in the ledger {}'.format(sub_index, case, self.path)
+        return str(row[0])
+
+    def done(self, sub_index, case):
+        with self._transaction() as conn:
+            self._set_state(conn, sub_index, case, DONE)
+
+    def fail(self, sub_index, case, error):
+        with self._transaction() as conn:
+            self._set_state(conn, sub_index, case, FAILED, error=error)
+
+    def summary(self):
+        """Number of items per state"""
+        with self._transaction() as conn:
+            rows = conn.execute('SELECT state, COUNT(*) FROM items GROUP BY state').fetchall()
+        counts = {state: 0 for state in [PENDING, CLAIMED, DONE, FAILED]}
+        counts.update({str(state): count for state, count in rows})
+        return counts
+
+    def failures(self):
+        """The items that failed, as a list of (sub_index, case, attempts, error)"""
+        with self._transaction() as conn:
+            rows = conn.execute('SELECT sub_index, case_name, attempts, error FROM items WHERE state = ? '
+                                'ORDER BY sub_index, case_name DESC', (FAILED,)).fetchall()
+        return [(int(sub_index), str(case), attempts, error) for sub_index, case, attempts, error in rows]
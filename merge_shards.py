@@ -0,0 +1,109 @@
+"""
+Merging and verifying the outputs of a sharded run (--num_shards/--shard_id or --shard_index_file of calc_scores.py
+and attack.py), before extract_characteristics.py runs.
+
+The per-shard score stores (<checkpoint_dir>/<set>/score_store/<case>_shard*) are merged into the store of the set.
+Then every sample of the set (selected by --selection) is checked to have complete pred and adv scores, either in the
+store or in its per-index directory. Missing samples are reported per shard, so only the failed shards need to be run
+again.
+Run with:
+python NNIF_adv_defense/merge_shards.py --dataset cifar10 --set val --attack cw --num_shards 8
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import os
+import glob
+import shutil
+import pickle
+import numpy as np
+from tensorflow.python.platform import flags
+from NNIF_adv_defense.influence.score_files import scores_complete
+from NNIF_adv_defense.influence.score_store import ScoreStore, store_dir
+from NNIF_adv_defense.influence.param_scope import parse_scope, scope_scores_name
+from NNIF_adv_defense.influence.score_workers import scores_dir
+from NNIF_adv_defense.influence.shards import select_indices, shard_indices
+
+FLAGS = flags.FLAGS
+
+flags.DEFINE_string('dataset', 'cifar10', 'dataset: cifar10/100 or svhn')
+flags.DEFINE_string('set', 'val', 'val or test set to merge')
+flags.DEFINE_string('attack', 'deepfool', 'adversarial attack: deepfool, jsma, cw, cw_nnif')
+flags.DEFINE_string('checkpoint_dir', '', 'Checkpoint dir, the path to the saved model architecture and weights')
+flags.DEFINE_string('influence_params', 'all', 'parameters of the influence scores: all or last_layer')
+flags.DEFINE_string('influence_scope', '', 'the --influence_scope of the scores (comma separated variable scopes). '
+                                            'Empty for all the parameters')
+flags.DEFINE_string('selection', 'all', 'the --selection of the run: only these samples are verified')
+flags.DEFINE_integer('num_shards', 1, 'number of shards of the run, used to report the shards of missing samples')
+flags.DEFINE_bool('remove_shards', False, 'remove the per-shard score stores after they were merged')
+
+TARGETED = FLAGS.attack != 'deepfool'  # we use targeted attacks everywhere except deepfool
+SCORES_NAME = scope_scores_name(FLAGS.influence_params, parse_scope(FLAGS.influence_scope))  # the scores files/stores
+
+if FLAGS.checkpoint_dir != '':
+    model_dir = FLAGS.checkpoint_dir                          # set user specified dir
+else:
+    model_dir = os.path.join(FLAGS.dataset, 'trained_model')  # set default dir
+
+attack_dir = os.path.join(model_dir, FLAGS.attack)
+if TARGETED:
+    attack_dir = attack_dir + '_targeted'
+
+info_file = os.path.join(attack_dir, 'info.pkl')
+print('loading info as pickle from {}'.format(info_file))
+with open(info_file, 'rb') as handle:
+    info = pickle.load(handle)
+
+sub_indices = select_indices(info[FLAGS.set], FLAGS.selection)
+shard_of = {}
+for shard_id in range(FLAGS.num_shards):
+    for sub_index in shard_indices(sub_indices, FLAGS.num_shards, shard_id):
+        shard_of[sub_index] = shard_id
+
+num_missing = 0
+for case in ['pred', 'adv']:
+    store = ScoreStore(store_dir(model_dir, FLAGS.set, case, FLAGS.attack, SCORES_NAME))
+    shard_stores = [ScoreStore(dir) for dir in sorted(glob.glob(store.dir + '_shard*'))]
+    shard_stores = [shard_store for shard_store in shard_stores if shard_store.exists()]
+
+    if len(shard_stores) > 0:
+        num_train = np.load(shard_stores[0].scores_path, mmap_mode='r').shape[1]
+        store.create(num_samples=len(info[FLAGS.set]), num_train=num_train)
+        store.open(writable=True)
+        for shard_store in shard_stores:
+            shard_store.open()
+            rows = [sub_index for sub_index in np.flatnonzero(shard_store.done) if not store.is_done(sub_index)]
+            for sub_index in rows:
+                store.write(sub_index, shard_store.scores[sub_index])
+            print('case {}: merged {} samples from {}'.format(case, len(rows), shard_store.dir))
+        if FLAGS.remove_shards:
+            for shard_store in shard_stores:
+                shutil.rmtree(shard_store.dir)
+
+    # verify that every sample has complete scores, in the store or in its per-index directory
+    missing = []
+    for sub_index in sub_indices:
+        if store.exists() and store.is_done(sub_index):
+            continue
+        dir = scores_dir(model_dir, FLAGS.set, info[FLAGS.set][sub_index]['global_index'], case, FLAGS.attack)
+        if not scores_complete(dir, SCORES_NAME):
+            missing.append(sub_index)
+
+    if len(missing) == 0:
+        print('case {}: all {} {} samples have scores'.format(case, len(sub_indices), FLAGS.set))
+        continue
+    num_missing += len(missing)
+    missing_per_shard = {}
+    for sub_index in missing:
+        missing_per_shard[shard_of[sub_index]] = missing_per_shard.get(shard_of[sub_index], 0) + 1
+    print('case {}: {}/{} {} samples are missing, e.g. sub indices {}'
+          .format(case, len(missing), len(sub_indices), FLAGS.set, missing[:10]))
+    for shard_id in sorted(missing_per_shard):
+        print('    shard {}/{}: {} missing samples'.format(shard_id, FLAGS.num_shards, missing_per_shard[shard_id]))
+
+if num_missing > 0:
+    raise AssertionError('{} (sample, case) scores are missing. Run the shards above again'.format(num_missing))
+print('All the shards are complete.')
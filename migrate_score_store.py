@@ -0,0 +1,97 @@
+"""
+Migrating the scores of existing per-index directories (<model_dir>/<set>/<set>_index_<global_index>/...) into the
+consolidated score stores read by extract_characteristics.py and white_box_attack.py (see influence/score_store.py).
+
+Run after calc_scores.py/attack.py, for every set and attack:
+python NNIF_adv_defense/migrate_score_store.py --dataset cifar10 --set val --attack cw
+Samples that only have a top-k scores file (--scores_top_k) cannot be migrated and are reported.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import os
+import pickle
+import numpy as np
+from tqdm import tqdm
+from tensorflow.python.platform import flags
+from NNIF_adv_defense.influence.score_files import scores_file_name, topk_file_name
+from NNIF_adv_defense.influence.score_store import ScoreStore, store_dir
+from NNIF_adv_defense.influence.param_scope import parse_scope, scope_scores_name
+from NNIF_adv_defense.influence.score_workers import scores_dir
+
+FLAGS = flags.FLAGS
+
+flags.DEFINE_string('dataset', 'cifar10', 'dataset: cifar10/100 or svhn')
+flags.DEFINE_string('set', 'val', 'val or test set to migrate')
+flags.DEFINE_string('attack', 'deepfool', 'adversarial attack: deepfool, jsma, cw, cw_nnif')
+flags.DEFINE_string('checkpoint_dir', '', 'Checkpoint dir, the path to the saved model architecture and weights')
+flags.DEFINE_string('influence_params', 'all', 'parameters of the influence scores: all or last_layer')
+flags.DEFINE_string('influence_scope', '', 'the --influence_scope of the scores (comma separated variable scopes). '
+                                            'Empty for all the parameters')
+flags.DEFINE_bool('remove_old', False, 'remove the migrated per-index scores/images and the empty index directories')
+
+TARGETED = FLAGS.attack != 'deepfool'  # we use targeted attacks everywhere except deepfool
+SCORES_NAME = scope_scores_name(FLAGS.influence_params, parse_scope(FLAGS.influence_scope))  # the scores files/stores
+
+if FLAGS.checkpoint_dir != '':
+    model_dir = FLAGS.checkpoint_dir                          # set user specified dir
+else:
+    model_dir = os.path.join(FLAGS.dataset, 'trained_model')  # set default dir
+
+attack_dir = os.path.join(model_dir, FLAGS.attack)
+if TARGETED:
+    attack_dir = attack_dir + '_targeted'
+
+info_file = os.path.join(attack_dir, 'info.pkl')
+print('loading info as pickle from {}'.format(info_file))
+with open(info_file, 'rb') as handle:
+    info = pickle.load(handle)
+
+sub_relevant_indices = [ind for ind in info[FLAGS.set]]
+set_dir = os.path.join(model_dir, FLAGS.set)
+
+
+def remove_index_dir(dir):
+    """Removing the migrated files of a per-index directory, and the directories left empty"""
+    for file_name in [scores_file_name(SCORES_NAME), 'image.npy', 'image.png']:
+        if os.path.isfile(os.path.join(dir, file_name)):
+            os.remove(os.path.join(dir, file_name))
+    while os.path.abspath(dir) != os.path.abspath(set_dir):
+        try:
+            os.rmdir(dir)
+        except OSError:  # not empty
+            break
+        dir = os.path.dirname(dir)
+
+
+for case in ['pred', 'adv']:
+    dirs = {sub_index: scores_dir(model_dir, FLAGS.set, info[FLAGS.set][sub_index]['global_index'], case, FLAGS.attack)
+            for sub_index in sub_relevant_indices}
+    existing = [sub_index for sub_index in sub_relevant_indices
+                if os.path.isfile(os.path.join(dirs[sub_index], scores_file_name(SCORES_NAME)))]
+    if len(existing) == 0:
+        print('no {} scores to migrate for case {}'.format(FLAGS.set, case))
+        continue
+
+    num_train = len(np.load(os.path.join(dirs[existing[0]], scores_file_name(SCORES_NAME)), mmap_mode='r'))
+    store = ScoreStore(store_dir(model_dir, FLAGS.set, case, FLAGS.attack, SCORES_NAME))
+    store.create(num_samples=len(sub_relevant_indices), num_train=num_train)
+    store.open(writable=True)
+
+    num_migrated = 0
+    for sub_index in tqdm(existing, desc='Migrating {} scores'.format(case)):
+        if not store.is_done(sub_index):
+            store.write(sub_index, np.load(os.path.join(dirs[sub_index], scores_file_name(SCORES_NAME))))
+            num_migrated += 1
+        if FLAGS.remove_old:
+            remove_index_dir(dirs[sub_index])
+
+    topk_only = [sub_index for sub_index in sub_relevant_indices if not store.is_done(sub_index) and
+                 os.path.isfile(os.path.join(dirs[sub_index], topk_file_name(SCORES_NAME)))]
+    print('case {}: migrated {} samples to {}. {}/{} samples are done'
+          .format(case, num_migrated, store.dir, store.num_done(), len(sub_relevant_indices)))
+    if len(topk_only) > 0:
+        print('case {}: {} samples only have top-k scores and were not migrated'.format(case, len(topk_only)))
@@ -167,6 +167,7 @@ class DarkonReplica(Model):
         Model.__init__(self, scope, nb_classes, locals())
         self.n = n
         self.net = OrderedDict()
+        self.pooled_net = OrderedDict()  # the activations of self.net, averaged over the spatial axes
 
         # Do a dummy run of fprop to create the variables from the start
         self.fprop(tf.placeholder(tf.float32, [32] + input_shape))
@@ -224,6 +225,14 @@ class DarkonReplica(Model):
                 self.net['layer{}'.format(layer_cnt)] = logits  # 32
                 layer_cnt += 1
 
+            # pooling inside the graph, so that only [batch, channels] features are fetched from the session
+            with tf.name_scope('pooled_net'):
+                for layer, activations in self.net.items():
+                    if len(activations.shape) == 4:
+                        self.pooled_net[layer] = tf.reduce_mean(activations, [1, 2], name=layer)
+                    else:
+                        self.pooled_net[layer] = activations
+
             return {self.O_EMBEDDINGS: embedding_vector,
                     self.O_LOGITS: logits,
                     self.O_PROBS: tf.nn.softmax(logits=logits)}
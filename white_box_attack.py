@@ -24,6 +24,8 @@ from tqdm import tqdm
 from tensorflow.python.platform import flags
 from NNIF_adv_defense.models.darkon_resnet34_model import DarkonReplica
 from NNIF_adv_defense.datasets.influence_feeder import MyFeederValTest
+from NNIF_adv_defense.influence.score_files import load_helpful_harmful, helpful_harmful
+from NNIF_adv_defense.influence.score_store import ScoreStore, store_dir
 from NNIF_adv_defense.white_box.cw_opt_attack import CarliniNNIF
 from cleverhans.utils import random_targets
 from cleverhans.evaluation import batch_eval
@@ -257,6 +259,7 @@ if not os.path.exists(helpful_npy_path):
     # loading the embedding vectors of all the val's/test's most harmful/helpful training examples
     most_helpful_list = []
     most_harmful_list = []
+    pred_store = ScoreStore(store_dir(model_dir, FLAGS.set, 'pred', attack=None))
 
     for i in tqdm(range(len(sub_relevant_indices))):
         sub_index = sub_relevant_indices[i]
@@ -286,10 +289,10 @@ if not os.path.exists(helpful_npy_path):
 
         # creating the relevant index folders
         dir = os.path.join(model_dir, FLAGS.set, FLAGS.set + '_index_{}'.format(global_index), 'pred')
-        scores = np.load(os.path.join(dir, 'scores.npy'))
-        sorted_indices = np.argsort(scores)
-        harmful_inds = sorted_indices[:NUM_INDICES[FLAGS.dataset]]
-        helpful_inds = sorted_indices[-NUM_INDICES[FLAGS.dataset]:][::-1]
+        if pred_store.exists() and pred_store.is_done(sub_index):
+            helpful_inds, harmful_inds = helpful_harmful(pred_store.row(sub_index), NUM_INDICES[FLAGS.dataset])
+        else:
+            helpful_inds, harmful_inds = load_helpful_harmful(dir, NUM_INDICES[FLAGS.dataset])
 
         # find out the embedding space of the train images in the tanh space
         # first we calculate the tanh transformation: